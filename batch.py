@@ -0,0 +1,178 @@
+# 大量のゲームをヘッドレスで並列に回して集計する (出現率・アイテム確率・ボス体力の調整用)
+# 1ゲーム = 1シード。ゲームオーバー・クリア・フレーム上限のどれかで終わる
+# 結果は列ごとのバイナリファイル (列指向) に、終わったゲームから順に追記していく
+#
+#   python batch.py run results --games 1000 --policy random --seed 0   全コアで実行して集計を表示
+#   python batch.py summary results                                     書き出した結果を集計し直す
+#
+# 出力ディレクトリ:
+#   schema.json    列の名前・型・カテゴリ値の一覧
+#   <列名>.bin     その列の値をリトルエンディアンで並べたもの (行の順番はゲームが終わった順)
+import argparse
+import json
+import os
+import sys
+import time
+from array import array
+from multiprocessing import Pool
+
+import numpy as np
+
+import headless
+
+POLICIES = sorted(headless.POLICIES)
+RESULTS = ('timeout', 'gameover', 'clear')
+CAUSES = ('none', 'enemy', 'bullet', 'boss_bullet')
+
+# (列名, array の型コード)
+COLUMNS = (
+    ('seed', 'q'),
+    ('policy', 'b'),
+    ('result', 'b'),             # RESULTS のインデックス
+    ('death_cause', 'b'),        # CAUSES のインデックス
+    ('frames', 'i'),             # 終わるまでのフレーム数
+    ('score', 'q'),
+    ('life', 'b'),
+    ('boss_trigger_frame', 'i'), # スコア 100000 でボス導入に入ったフレーム (-1 は到達せず)
+    ('boss_spawn_frame', 'i'),   # ボスが出現したフレーム
+    ('boss_kill_frame', 'i'),    # ボスを倒したフレーム
+    ('boss_health', 'i'),        # 終了時のボスの体力 (ボスがいなければ -1)
+)
+FLUSH_ROWS = 256 # これだけ溜まったらファイルに書き出す
+
+
+def play_game(job):
+    # ワーカープロセスで 1 ゲームを最後まで進めて 1 行分の値を返す
+    seed, policy, max_frames = job
+    app = headless.create_app(headless.POLICIES[policy](seed), seed=seed)
+    boss_trigger = boss_spawn = boss_kill = -1
+    frame = 0
+    while frame < max_frames:
+        app.update()
+        frame += 1
+        phase = app.game_phase
+        if boss_trigger < 0 and phase == 'boss_intro':
+            boss_trigger = frame
+        if boss_spawn < 0 and app.boss:
+            boss_spawn = frame
+        if phase == 'gameover' or phase == 'clear':
+            if phase == 'clear' and app.boss:
+                boss_kill = frame
+            break
+    result = RESULTS.index(app.game_phase) if app.game_phase in RESULTS else 0
+    return (seed, POLICIES.index(policy), result, CAUSES.index(app.death_cause or 'none'), frame, app.score, app.player.life,
+            boss_trigger, boss_spawn, boss_kill, app.boss.health if app.boss else -1)
+
+
+class ColumnWriter:
+    # 行を受け取って列ごとのバッファに溜め、FLUSH_ROWS 行ごとに各列のファイルへ追記する
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.buffers = [array(code) for _, code in COLUMNS]
+        self.files = [open(os.path.join(path, name + '.bin'), 'wb') for name, _ in COLUMNS]
+        self.rows = 0
+        self.schema = {
+            'columns': [{'name': name, 'type': np.dtype(code).newbyteorder('<').str} for name, code in COLUMNS],
+            'categories': {'policy': POLICIES, 'result': list(RESULTS), 'death_cause': list(CAUSES)},
+            'rows': 0,
+        }
+
+    def append(self, row):
+        for buf, value in zip(self.buffers, row):
+            buf.append(value)
+        self.rows += 1
+        if len(self.buffers[0]) >= FLUSH_ROWS:
+            self.flush()
+
+    def flush(self):
+        for buf, f in zip(self.buffers, self.files):
+            if sys.byteorder != 'little':
+                buf.byteswap()
+            f.write(buf.tobytes())
+            f.flush()
+            del buf[:]
+        # 途中で止めても読めるように行数を毎回書き直す
+        self.schema['rows'] = self.rows
+        with open(os.path.join(self.path, 'schema.json'), 'w') as f:
+            json.dump(self.schema, f, indent=2)
+
+    def close(self):
+        self.flush()
+        for f in self.files:
+            f.close()
+
+
+def load_columns(path):
+    # 列名 -> numpy 配列 (schema.json の行数まで)
+    with open(os.path.join(path, 'schema.json')) as f:
+        schema = json.load(f)
+    columns = {}
+    for column in schema['columns']:
+        data = np.fromfile(os.path.join(path, column['name'] + '.bin'), dtype=np.dtype(column['type']))
+        columns[column['name']] = data[:schema['rows']]
+    return columns, schema
+
+
+def summarize(columns, schema):
+    n = len(columns['seed'])
+    lines = [f"games: {n}"]
+    if not n:
+        return '\n'.join(lines)
+
+    def dist(values):
+        if not len(values):
+            return '-'
+        p10, p50, p90 = np.percentile(values, (10, 50, 90))
+        return f"mean {values.mean():.0f}  p10 {p10:.0f}  p50 {p50:.0f}  p90 {p90:.0f}  max {values.max()}"
+
+    for name in ('result', 'death_cause'):
+        counts = np.bincount(columns[name], minlength=len(schema['categories'][name]))
+        lines.append(name + ': ' + '  '.join(f"{label} {count} ({count / n:.1%})"
+                                             for label, count in zip(schema['categories'][name], counts) if count))
+    lines.append(f"score: {dist(columns['score'])}")
+    lines.append(f"frames: {dist(columns['frames'])}")
+
+    triggered = columns['boss_trigger_frame'] >= 0
+    lines.append(f"boss trigger (score 100000): {triggered.sum()} ({triggered.mean():.1%})  frames: {dist(columns['boss_trigger_frame'][triggered])}")
+    killed = columns['boss_kill_frame'] >= 0
+    kill_time = columns['boss_kill_frame'][killed] - columns['boss_spawn_frame'][killed]
+    lines.append(f"boss kill: {killed.sum()}  frames after spawn: {dist(kill_time)}")
+    return '\n'.join(lines)
+
+
+def run(path, games, policy, seed, max_frames, workers):
+    writer = ColumnWriter(path)
+    jobs = [(seed + i, policy, max_frames) for i in range(games)]
+    start = time.perf_counter()
+    frames = 0
+    # ゲームごとに独立しているので、終わった順に受け取って書き出す
+    with Pool(workers) as pool:
+        for row in pool.imap_unordered(play_game, jobs, chunksize=max(1, games // (workers * 16))):
+            writer.append(row)
+            frames += row[4]
+    writer.close()
+    elapsed = time.perf_counter() - start
+    print(f"{games} games, {frames} frames in {elapsed:.2f}s with {workers} workers ({frames / elapsed:.0f} frames/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    r = sub.add_parser('run')
+    r.add_argument('path', help='結果を書き出すディレクトリ')
+    r.add_argument('--games', type=int, default=1000)
+    r.add_argument('--policy', choices=POLICIES, default='random')
+    r.add_argument('--seed', type=int, default=0, help='最初のゲームのシード (以降 1 ずつ増やす)')
+    r.add_argument('--frames', type=int, default=60 * 60 * 10, help='1ゲームのフレーム上限')
+    r.add_argument('--workers', type=int, default=os.cpu_count())
+    sub.add_parser('summary').add_argument('path')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args.path, args.games, args.policy, args.seed, args.frames, args.workers)
+    print(summarize(*load_columns(args.path)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# エンティティのメモリ使用量と属性アクセスのマイクロベンチマーク
+# __slots__ とテーブル化の前 (dict ベース、文字列比較) と後を比べる
+#
+#   python benchmarks/bench_entities.py [--count 10000]
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+# 変更前のクラス (インスタンスごとの __dict__ と item_types リスト)
+class LegacyEnemy:
+    def __init__(self, type, x, y, w, h, speed, color, health):
+        self.type = type
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        self.speed = speed
+        self.color = color
+        self.health = health
+        self.dx = 0.5
+
+
+class LegacyItem:
+    def __init__(self, x, y, w, h, speed, type_index):
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        self.speed = speed
+        self.type_index = type_index
+        self.item_types = [
+            {'name': 'score', 'color': 10},
+            {'name': 'speed', 'color': 12},
+            {'name': 'power', 'color': 13},
+            {'name': '3way', 'color': 14},
+            {'name': 'barrier', 'color': 6},
+            {'name': 'bomb', 'color': 7}
+        ]
+        self.is_bouncing = False
+        self.bounce_speed = 1
+        self.initial_bounce_y = 0
+        self.bounce_height = 10
+
+    @property
+    def type(self):
+        return self.item_types[self.type_index]
+
+
+class EffectTarget:
+    # apply_item_effect の分岐だけを測るための最小限の受け手
+    def __init__(self):
+        self.hits = [0] * len(main.ITEM_TYPES)
+
+    def legacy_apply(self, item_type):
+        if item_type['name'] == 'score':
+            self.hits[0] += 1
+        elif item_type['name'] == 'speed':
+            self.hits[1] += 1
+        elif item_type['name'] == 'power':
+            self.hits[2] += 1
+        elif item_type['name'] == '3way':
+            self.hits[3] += 1
+        elif item_type['name'] == 'barrier':
+            self.hits[4] += 1
+        elif item_type['name'] == 'bomb':
+            self.hits[5] += 1
+
+    def effect_0(self): self.hits[0] += 1
+    def effect_1(self): self.hits[1] += 1
+    def effect_2(self): self.hits[2] += 1
+    def effect_3(self): self.hits[3] += 1
+    def effect_4(self): self.hits[4] += 1
+    def effect_5(self): self.hits[5] += 1
+
+    EFFECTS = (effect_0, effect_1, effect_2, effect_3, effect_4, effect_5)
+
+    def table_apply(self, type_index):
+        self.EFFECTS[type_index](self)
+
+
+def measure_memory(factory, count):
+    tracemalloc.start()
+    objs = [factory(i) for i in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objs
+    return size / count
+
+
+def measure_update(entities, repeat):
+    # Enemy.update と同じ属性の読み書き
+    def step():
+        for e in entities:
+            e.y += e.speed
+            e.x += e.dx
+            if e.x < 0 or e.x + e.w > main.SCREEN_WIDTH:
+                e.dx *= -1
+    return min(timeit.repeat(step, number=repeat, repeat=5)) / (repeat * len(entities)) * 1e9
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=10000)
+    args = parser.parse_args()
+    n = args.count
+
+    rows = []
+    rows.append(('Enemy bytes/instance',
+                 measure_memory(lambda i: LegacyEnemy('shooter', i % 200, 0, 14, 14, 0, 8, 2), n),
+                 measure_memory(lambda i: main.Enemy(main.ENEMY_SHOOTER, i % 200, 0, 14, 14, 0, 8, 2, 0.5), n)))
+    rows.append(('Item bytes/instance',
+                 measure_memory(lambda i: LegacyItem(i % 200, 0, 7, 7, 1, i % 6), n),
+                 measure_memory(lambda i: main.Item(i % 200, 0, 7, 7, 1, i % 6), n)))
+
+    legacy = [LegacyEnemy('shooter', i % 200, 0, 14, 14, 0, 8, 2) for i in range(1000)]
+    slotted = [main.Enemy(main.ENEMY_SHOOTER, i % 200, 0, 14, 14, 0, 8, 2, 0.5) for i in range(1000)]
+    rows.append(('Enemy update ns/entity', measure_update(legacy, 200), measure_update(slotted, 200)))
+
+    target = EffectTarget()
+    legacy_items = [LegacyItem(0, 0, 7, 7, 1, i % 6) for i in range(600)]
+    items = [main.Item(0, 0, 7, 7, 1, i % 6) for i in range(600)]
+    t_legacy = min(timeit.repeat(lambda: [target.legacy_apply(i.type) for i in legacy_items], number=200, repeat=5))
+    t_table = min(timeit.repeat(lambda: [target.table_apply(i.type_index) for i in items], number=200, repeat=5))
+    rows.append(('Item effect dispatch ns/call', t_legacy / (200 * 600) * 1e9, t_table / (200 * 600) * 1e9))
+
+    print(f"{'':32}{'before':>10}{'after':>10}{'ratio':>8}")
+    for name, before, after in rows:
+        print(f"{name:32}{before:10.1f}{after:10.1f}{after / before:8.2f}")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,199 @@
+# シナリオ別のフレームコスト計測 (update と draw を別々に測る)
+# 結果は JSON で保存し、2回分を比べて遅くなったところを探す
+#
+#   python benchmarks/bench_frames.py -o before.json
+#   python benchmarks/bench_frames.py -o after.json
+#   python benchmarks/bench_frames.py --compare before.json after.json
+#
+# draw の計測には pyxel.init が必要。ディスプレイがない環境では SDL の offscreen ドライバを使う
+# (--no-draw なら update だけを測る)
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyxel
+
+import main
+from main import App, ScriptedInput, INPUT_BITS, ITEM_3WAY, scale_val
+
+SHOT = INPUT_BITS[pyxel.KEY_SPACE]
+
+
+def strafe(frame):
+    # 左右に往復しながら撃ち続ける
+    side = INPUT_BITS[pyxel.KEY_LEFT] if frame // 60 % 2 else INPUT_BITS[pyxel.KEY_RIGHT]
+    return side | SHOT
+
+
+def keep_alive(app):
+    app.player.life = app.player.max_life
+    app.player.invincible_timer = 2
+
+
+def start_boss(app):
+    app.game_phase = 'boss'
+    app.world.clear('enemies') # プールに戻す (start_boss_intro と同じ)
+    app.boss = main.Boss()
+    app.boss.y = scale_val(50)
+    app.boss.attack_pattern = 'barrage'
+    app.boss.health = 10 ** 9
+
+
+def start_dense_boss(app):
+    start_boss(app)
+    app.boss.program = main.BOSS_PROGRAM_DENSE
+
+
+def cycle_boss_phases(app):
+    # BOSS_PROGRAM_DENSE の3つのフェーズを200フレームずつ回す
+    keep_alive(app)
+    app.boss.health = (400, 200, 50)[app.frame_count // 200 % 3]
+
+
+# シナリオ: (入力, 開始時の準備, 毎フレームの調整)
+SCENARIOS = {
+    # ボスの弾幕が画面を埋め尽くした状態
+    'boss_barrage': (strafe, start_boss, keep_alive),
+    # BOSS_PROGRAM_DENSE の全フェーズ (渦巻き・多重リング・自機狙い)
+    'dense_pattern': (strafe, start_dense_boss, cycle_boss_phases),
+    # 3way アイテム取得後の5方向ショットを撃ち続ける
+    'five_way_fire': (strafe, lambda app: app.apply_item_effect(ITEM_3WAY), keep_alive),
+    # 3フレームごとの出現で敵が最大密度になる状態 (撃たない)
+    'max_enemies': (lambda frame: 0, None, keep_alive),
+    # 海の背景 (スコア 1000 未満)
+    'sea_background': (strafe, None, lambda app: (keep_alive(app), setattr(app, 'score', 0))),
+    # 宇宙の背景と100個の星 (スコア 2000 以上)
+    'space_background': (strafe, lambda app: setattr(app, 'score', 5000), keep_alive),
+}
+
+
+def percentiles(samples_ns):
+    s = sorted(samples_ns)
+    def pick(q):
+        return s[min(len(s) - 1, int(q * len(s)))] / 1e6
+    return {
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'mean': sum(s) / len(s) / 1e6,
+        'max': s[-1] / 1e6,
+    }
+
+
+def run_scenario(name, frames, warmup, draw, seed):
+    policy, setup, tick = SCENARIOS[name]
+    app = App(headless=True, seed=seed, input_source=ScriptedInput(policy))
+    if setup:
+        setup(app)
+    update_ns = []
+    draw_ns = []
+    clock = time.perf_counter_ns
+    for frame in range(warmup + frames):
+        if tick:
+            tick(app)
+        t0 = clock()
+        app.update()
+        t1 = clock()
+        if draw:
+            app.draw()
+        t2 = clock()
+        if frame >= warmup:
+            update_ns.append(t1 - t0)
+            draw_ns.append(t2 - t1)
+
+    result = {
+        'update': percentiles(update_ns),
+        'entities': {
+            'bullets': len(app.bullets),
+            'enemies': len(app.enemies),
+            'enemy_bullets': len(app.enemy_bullets),
+            'clouds': len(app.clouds),
+            'items': len(app.items),
+        },
+    }
+    if draw:
+        result['draw'] = percentiles(draw_ns)
+    return result
+
+
+def compare(base_path, new_path, threshold):
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    regressions = 0
+    print(f"{'scenario':18}{'phase':8}{'stat':6}{'base ms':>10}{'new ms':>10}{'change':>9}")
+    for name, result in new['scenarios'].items():
+        if name not in base['scenarios']:
+            continue
+        for phase in ('update', 'draw'):
+            if phase not in result or phase not in base['scenarios'][name]:
+                continue
+            for stat in ('p50', 'p95', 'p99'):
+                b = base['scenarios'][name][phase][stat]
+                n = result[phase][stat]
+                change = (n - b) / b if b else 0.0
+                flag = ''
+                if change > threshold:
+                    flag = '  <-- slower'
+                    regressions += 1
+                print(f"{name:18}{phase:8}{stat:6}{b:10.3f}{n:10.3f}{change:+9.1%}{flag}")
+    return regressions
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', help='結果の JSON を書き出すパス')
+    parser.add_argument('--frames', type=int, default=600)
+    parser.add_argument('--warmup', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='省略時はすべて')
+    parser.add_argument('--no-draw', action='store_true')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'))
+    parser.add_argument('--threshold', type=float, default=0.10, help='これ以上遅くなったら失敗にする割合')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+
+    if args.output:
+        args.output = os.path.abspath(args.output) # pyxel.init で作業ディレクトリが変わる前に
+    draw = not args.no_draw
+    if draw:
+        os.environ.setdefault('SDL_VIDEODRIVER', 'offscreen')
+        os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+        pyxel.init(main.SCREEN_WIDTH, main.SCREEN_HEIGHT)
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'frames': args.frames,
+            'warmup': args.warmup,
+            'seed': args.seed,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'scenarios': {},
+    }
+    for name in args.scenario or SCENARIOS:
+        result = run_scenario(name, args.frames, args.warmup, draw, args.seed)
+        results['scenarios'][name] = result
+        line = f"{name:18}"
+        for phase in ('update', 'draw'):
+            if phase in result:
+                r = result[phase]
+                line += f"  {phase} p50 {r['p50']:.3f} p95 {r['p95']:.3f} p99 {r['p99']:.3f} ms"
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    run()
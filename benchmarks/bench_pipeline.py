@@ -0,0 +1,74 @@
+# 1つのプロセスで update と draw を順に呼ぶときと、pipeline.py で別のプロセスに分けたときの1フレームの時間を比べる
+# どちらもランダムな入力で同じゲームを進める。パイプラインでは入力を送ってから1つ前のフレームが届くのを待って描く
+#
+#   python benchmarks/bench_pipeline.py --frames 3000
+#
+# コアが1つしかない環境では2つのプロセスが同じコアを取り合うので速くならない
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyxel
+
+import main
+from main import App, NullAudio, ScriptedInput
+from headless import RandomPolicy
+from pipeline import Pipeline
+
+
+def summarize(samples):
+    samples.sort()
+    return {'mean': sum(samples) / len(samples) * 1000,
+            'p50': samples[len(samples) // 2] * 1000,
+            'p95': samples[int(len(samples) * 0.95)] * 1000}
+
+
+def run_serial(frames, seed):
+    app = App(headless=True, seed=seed, input_source=ScriptedInput(RandomPolicy(seed)))
+    samples = []
+    for _ in range(frames):
+        t0 = time.perf_counter()
+        app.update()
+        app.draw()
+        samples.append(time.perf_counter() - t0)
+    return summarize(samples)
+
+
+def run_pipelined(frames, seed):
+    pipeline = Pipeline(seed, input_source=ScriptedInput(RandomPolicy(seed)), audio=NullAudio())
+    pipeline.wait(0, timeout=30) # 子プロセスの起動を待つ
+    samples = []
+    try:
+        for k in range(1, frames + 1):
+            t0 = time.perf_counter()
+            pipeline.update()
+            pipeline.wait(k - 1)
+            pipeline.view.draw()
+            samples.append(time.perf_counter() - t0)
+    finally:
+        pipeline.close()
+    return summarize(samples)
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=3000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.environ.setdefault('SDL_VIDEODRIVER', 'offscreen')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    pyxel.init(main.SCREEN_WIDTH, main.SCREEN_HEIGHT)
+
+    print(f"cpus: {os.cpu_count()}")
+    print(f"{'mode':12}{'mean':>9}{'p50':>9}{'p95':>9}   (ms/frame)")
+    for name, measure in (('serial', run_serial), ('pipelined', run_pipelined)):
+        r = measure(args.frames, args.seed)
+        print(f"{name:12}{r['mean']:9.3f}{r['p50']:9.3f}{r['p95']:9.3f}")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,66 @@
+# ネット対戦のロールバック (状態を戻して N フレーム進め直す) にかかる時間を測る
+# 2人プレイの App を bench_frames.py のシナリオで進め、N フレームごとに N フレーム前から進め直す
+#
+#   python benchmarks/bench_rollback.py --rollback 8
+#   python benchmarks/bench_rollback.py --gc-policy      # gcpolicy.py で GC を制御したとき (GC の停止時間も表示)
+#
+# 60fps で遅れないためには 1フレーム (16.7ms) の中に収まる必要がある
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import App
+from bench_frames import SCENARIOS
+from netplay import LoopbackTransport, RollbackSession
+
+
+def measure(name, rollback, frames, warmup, gc_policy=False):
+    policy, setup, adjust = SCENARIOS[name]
+    app = App(headless=True, seed=0, players=2, gc_policy=gc_policy)
+    if setup:
+        setup(app)
+    session = RollbackSession(app, 0, LoopbackTransport.pair()[0], policy, max_rollback=rollback)
+    samples = []
+    for i in range(warmup + frames):
+        if adjust:
+            adjust(app)
+        session.advance()
+        if i >= warmup and i % rollback == 0:
+            session.rollback_from = session.frame - rollback
+            t0 = time.perf_counter()
+            session.rollback()
+            samples.append(time.perf_counter() - t0)
+    samples.sort()
+    result = {'bullets': len(app.enemy_bullets),
+              'p50': samples[len(samples) // 2] * 1000,
+              'p95': samples[int(len(samples) * 0.95)] * 1000,
+              'max': samples[-1] * 1000}
+    if app.gc_policy:
+        result['gc'] = app.gc_policy.stats()
+        app.gc_policy.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rollback', type=int, default=8, help="進め直すフレーム数")
+    parser.add_argument('--frames', type=int, default=600)
+    parser.add_argument('--warmup', type=int, default=300)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS))
+    parser.add_argument('--gc-policy', action='store_true', help="プレイ中の GC を止める (gcpolicy.py)")
+    args = parser.parse_args()
+
+    print(f"{'scenario':18}{'bullets':>9}{'p50':>9}{'p95':>9}{'max':>9}   (ms, {args.rollback} frames)")
+    for name in args.scenario or SCENARIOS:
+        r = measure(name, args.rollback, args.frames, args.warmup, args.gc_policy)
+        line = f"{name:18}{r['bullets']:9}{r['p50']:9.2f}{r['p95']:9.2f}{r['max']:9.2f}"
+        if 'gc' in r:
+            line += f"   gc auto {r['gc']['auto']} forced {r['gc']['forced']}"
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# 起動から最初のフレームまでの時間と、R でのリスタート (reset_game) の時間を測る
+#
+#   python benchmarks/bench_startup.py --runs 5
+#
+# pyxel.init は1プロセスで1回しか呼べないので、起動は毎回新しいプロセスで測る
+# ディスプレイのない環境では SDL の offscreen ドライバを使う
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+START = time.perf_counter()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def child(restarts):
+    # 1回分の起動を測って JSON で返す (ms)
+    marks = {}
+    import pyxel
+    from main import App, PyxelAudio, ScriptedInput, SCREEN_WIDTH, SCREEN_HEIGHT, SIM_FPS
+    marks['import'] = time.perf_counter()
+    pyxel.init(SCREEN_WIDTH, SCREEN_HEIGHT, fps=SIM_FPS)
+    marks['init'] = time.perf_counter()
+    # ウィンドウ実行と同じ準備をする (pyxel.run には入らない)
+    app = App(headless=True, input_source=ScriptedInput(), audio=PyxelAudio())
+    app.build_assets()
+    marks['app'] = time.perf_counter()
+    app.update()
+    app.draw()
+    pyxel.flip()
+    marks['first_frame'] = time.perf_counter()
+
+    samples = []
+    for _ in range(restarts):
+        t0 = time.perf_counter()
+        app.reset_game()
+        samples.append(time.perf_counter() - t0)
+    samples.sort()
+
+    result = {}
+    last = START
+    for name, t in marks.items():
+        result[name] = (t - last) * 1000
+        last = t
+    result['total'] = (last - START) * 1000
+    result['restart_p50'] = samples[len(samples) // 2] * 1000
+    result['restart_max'] = samples[-1] * 1000
+    print(json.dumps(result))
+
+
+def measure(restarts):
+    env = dict(os.environ)
+    if not env.get('DISPLAY') and not env.get('WAYLAND_DISPLAY'):
+        env.setdefault('SDL_VIDEODRIVER', 'offscreen')
+        env.setdefault('SDL_AUDIODRIVER', 'dummy')
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', '--restarts', str(restarts)],
+                         env=env, check=True, capture_output=True, text=True, timeout=60).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--restarts', type=int, default=50)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.restarts)
+        return
+
+    columns = ('import', 'init', 'app', 'first_frame', 'total', 'restart_p50', 'restart_max')
+    results = [measure(args.restarts) for _ in range(args.runs)]
+    print(f"{'run':6}" + ''.join(f"{c:>13}" for c in columns) + '   (ms)')
+    for i, r in enumerate(results):
+        print(f"{i:<6}" + ''.join(f"{r[c]:13.2f}" for c in columns))
+    print(f"{'p50':6}" + ''.join(f"{sorted(r[c] for r in results)[len(results) // 2]:13.2f}" for c in columns))
+
+
+if __name__ == '__main__':
+    main()
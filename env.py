@@ -0,0 +1,322 @@
+# 自動プレイヤーの学習・評価用の環境 (Gym と同じ reset / step の形)
+# 描画はせず、App.update でゲームを進めて状態を numpy 配列の観測にする
+#
+#   env = ShmupEnv(obs='grid')
+#   obs, info = env.reset(seed=0)
+#   obs, reward, terminated, truncated, info = env.step(action)
+#
+# action は入力のマスク (INPUT_KEYS のビット、0 〜 N_ACTIONS - 1)。R (リスタート) のビットは使わない
+# reward はその step で増えたスコア。ゲームオーバーかクリアで terminated、max_steps で truncated になる
+#
+# 観測:
+#   'grid'     (4, grid, grid) の uint8。画面を grid x grid のマスに分け、自機・敵 (ボスは体の範囲)・敵の弾・アイテムの
+#              中心がそのマスにいくつあるか (255 まで)
+#   'features' (max_rows, 7) の float32。1行に1つ (種類, x, y, w, h, vx, vy)、座標と速さは画面の幅・高さで割った値
+#              自機・ボス・敵・アイテム・回復アイテム・雲・敵の弾の順に並べ、入りきらない分は捨てる (空き行の種類は 0)
+#
+# VectorEnv はたくさんの環境をまとめて進める。workers > 0 ならプロセスに分け、観測は共有メモリに書く
+#
+#   python env.py --envs 16 --workers 4 --steps 2000 --obs grid
+import argparse
+import os
+import time
+from multiprocessing import Pipe, Process
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pyxel
+
+from main import App, ScriptedInput, INPUT_BITS, SCREEN_WIDTH, SCREEN_HEIGHT
+
+N_ACTIONS = INPUT_BITS[pyxel.KEY_R] # R より下のビットの組み合わせ
+GRID_CHANNELS = ('player', 'enemies', 'enemy_bullets', 'items')
+# features の種類 (0 は空き行)
+KIND_PLAYER, KIND_BOSS, KIND_ENEMY, KIND_ITEM, KIND_HEAL_ITEM, KIND_CLOUD, KIND_ENEMY_BULLET = range(1, 8)
+FEATURES = 7
+
+
+class ShmupEnv:
+    def __init__(self, obs='grid', grid=32, max_rows=128, frame_skip=1, max_steps=None):
+        if obs not in ('grid', 'features'):
+            raise ValueError(f"unknown observation: {obs}")
+        self.obs_type = obs
+        self.grid = grid
+        self.max_rows = max_rows
+        self.frame_skip = frame_skip # 1回の step で同じ入力のまま進めるフレーム数
+        self.max_steps = max_steps
+        if obs == 'grid':
+            self.observation_shape = (len(GRID_CHANNELS), grid, grid)
+            self.observation_dtype = np.uint8
+        else:
+            self.observation_shape = (max_rows, FEATURES)
+            self.observation_dtype = np.float32
+        self.action = 0
+        self.steps = 0
+        # App は1回だけ作り、reset では reset_game で使い回す (プールや背景のキャッシュも残る)
+        self.input = ScriptedInput(lambda frame: self.action)
+        self.app = App(headless=True, input_source=self.input, seed=0)
+
+    def reset(self, seed=None, out=None):
+        # App(seed=seed) を作り直したのと同じ状態にする。out を渡すとそこに観測を書く
+        app = self.app
+        app.seed = seed if seed is not None else int.from_bytes(os.urandom(4), 'little')
+        app.rng.seed(app.seed)
+        app.frame_count = 0
+        self.input.frame = -1
+        self.input.mask = self.input.prev_mask = 0
+        app.reset_game()
+        self.action = 0
+        self.steps = 0
+        return self.observe(out), self.info()
+
+    def step(self, action, out=None):
+        app = self.app
+        self.action = int(action) % N_ACTIONS
+        score = app.score
+        for _ in range(self.frame_skip):
+            app.update()
+            if app.game_phase == 'gameover' or app.game_phase == 'clear':
+                break
+        self.steps += 1
+        terminated = app.game_phase == 'gameover' or app.game_phase == 'clear'
+        truncated = not terminated and self.max_steps is not None and self.steps >= self.max_steps
+        return self.observe(out), app.score - score, terminated, truncated, self.info()
+
+    def info(self):
+        app = self.app
+        return {'score': app.score, 'life': app.player.life, 'phase': app.game_phase, 'frame': app.frame_count}
+
+    def observe(self, out=None):
+        if out is None:
+            out = np.zeros(self.observation_shape, self.observation_dtype)
+        else:
+            out[...] = 0
+        if self.obs_type == 'grid':
+            self.observe_grid(out)
+        else:
+            self.observe_features(out)
+        return out
+
+    def observe_grid(self, out):
+        # 全チャンネルの中心座標を1つの配列にまとめ、1回の bincount で数える (画面外は端のマスに寄せる)
+        app = self.app
+        g = self.grid
+        xs = []
+        ys = []
+        channels = []
+        for channel, entities in ((0, app.players), (1, app.enemies), (3, app.items), (3, app.heal_items)):
+            for e in entities:
+                xs.append(e.x + e.w / 2)
+                ys.append(e.y + e.h / 2)
+            channels += [channel] * len(entities)
+        store = app.enemy_bullets
+        n = store.count
+        if n:
+            xs = np.concatenate((xs, store.x[:n] + store.w[:n] / 2))
+            ys = np.concatenate((ys, store.y[:n] + store.h[:n] / 2))
+            channels = np.concatenate((channels, np.full(n, 2)))
+        ix = np.clip((np.asarray(xs) * (g / SCREEN_WIDTH)).astype(np.intp), 0, g - 1)
+        iy = np.clip((np.asarray(ys) * (g / SCREEN_HEIGHT)).astype(np.intp), 0, g - 1)
+        counts = np.bincount((np.asarray(channels, np.intp) * g + iy) * g + ix, minlength=out.size)
+        np.minimum(counts, 255, out=counts)
+        out.reshape(-1)[:] = counts
+        boss = app.boss
+        if boss:
+            # ボスは大きいので体の範囲のマスすべてに置く
+            sx = g / SCREEN_WIDTH
+            sy = g / SCREEN_HEIGHT
+            x0, x1 = int(max(boss.x * sx, 0)), int(min((boss.x + boss.w) * sx, g - 1))
+            y0, y1 = int(max(boss.y * sy, 0)), int(min((boss.y + boss.h) * sy, g - 1))
+            if x0 <= x1 and y0 <= y1:
+                out[1, y0:y1 + 1, x0:x1 + 1] += out[1, y0:y1 + 1, x0:x1 + 1] < 255
+
+    def observe_features(self, out):
+        app = self.app
+        rows = []
+        for kind, entities in ((KIND_PLAYER, app.players), (KIND_BOSS, (app.boss,) if app.boss else ()),
+                               (KIND_ENEMY, app.enemies), (KIND_ITEM, app.items),
+                               (KIND_HEAL_ITEM, app.heal_items), (KIND_CLOUD, app.clouds)):
+            for e in entities:
+                vx, vy = e.motion() if kind != KIND_PLAYER else (0, 0)
+                rows.append((kind, e.x, e.y, e.w, e.h, vx, vy))
+        n = min(len(rows), self.max_rows)
+        if n:
+            out[:n] = rows[:n]
+        store = app.enemy_bullets
+        m = min(store.count, self.max_rows - n)
+        if m > 0:
+            block = out[n:n + m]
+            block[:, 0] = KIND_ENEMY_BULLET
+            for column, a in enumerate((store.x, store.y, store.w, store.h, store.dx, store.dy), 1):
+                block[:, column] = a[:m]
+        # 座標と速さを画面の大きさで割る
+        n += max(m, 0)
+        out[:n, 1::2] /= SCREEN_WIDTH
+        out[:n, 2::2] /= SCREEN_HEIGHT
+
+
+def run_worker(conn, shm_name, shape, dtype, start, count, kwargs):
+    # envs[start:start + count] を受け持つ。観測は共有メモリの自分の範囲に直接書く
+    shm = SharedMemory(name=shm_name)
+    try:
+        obs = np.ndarray(shape, dtype, buffer=shm.buf)[start:start + count]
+        envs = VectorEnv.make_envs(count, kwargs)
+        while True:
+            command, arg = conn.recv()
+            if command == 'reset':
+                conn.send(VectorEnv.reset_envs(envs, arg, obs))
+            elif command == 'step':
+                conn.send(VectorEnv.step_envs(envs, arg, obs))
+            else:
+                break
+        obs = None
+    finally:
+        shm.close()
+        conn.close()
+
+
+class VectorEnv:
+    # num_envs 個の ShmupEnv をまとめて進める (Gym の vector env と同じく、終わった環境は自動で reset する)
+    # step の戻り値は (観測, 報酬, terminated, truncated, info) で、それぞれ先頭の次元が環境
+    # info は 'score' / 'life' / 'frame' の配列と、このステップで終わった環境の 'final_score' (終わっていなければ -1)
+    # 自動 reset のシードは、環境 i の k 回目のゲームが seed + i + k * num_envs
+    def __init__(self, num_envs, workers=0, **kwargs):
+        self.num_envs = num_envs
+        self.workers = min(workers, num_envs)
+        self.kwargs = kwargs
+        probe = ShmupEnv(**kwargs) if self.workers else None
+        self.envs = None
+        self.processes = []
+        self.conns = []
+        self.shm = None
+        if not self.workers:
+            self.envs = self.make_envs(num_envs, kwargs)
+            probe = self.envs[0]
+        self.observation_shape = (num_envs,) + probe.observation_shape
+        self.observation_dtype = probe.observation_dtype
+        if self.workers:
+            size = int(np.prod(self.observation_shape)) * np.dtype(self.observation_dtype).itemsize
+            self.shm = SharedMemory(create=True, size=size)
+            self.obs = np.ndarray(self.observation_shape, self.observation_dtype, buffer=self.shm.buf)
+            self.slices = []
+            start = 0
+            for i in range(self.workers):
+                count = num_envs // self.workers + (i < num_envs % self.workers)
+                parent, child = Pipe()
+                p = Process(target=run_worker, daemon=True,
+                            args=(child, self.shm.name, self.observation_shape, self.observation_dtype, start, count, kwargs))
+                p.start()
+                child.close()
+                self.processes.append(p)
+                self.conns.append(parent)
+                self.slices.append(slice(start, start + count))
+                start += count
+        else:
+            self.obs = np.zeros(self.observation_shape, self.observation_dtype)
+
+    @staticmethod
+    def make_envs(count, kwargs):
+        return [ShmupEnv(**kwargs) for _ in range(count)]
+
+    @staticmethod
+    def reset_envs(envs, seeds, obs):
+        # seeds[i] で reset し、次の自動 reset からは stride ずつ進める
+        seeds, stride = seeds
+        for i, env in enumerate(envs):
+            env.next_seed = seeds[i]
+            env.seed_stride = stride
+            env.reset(env.next_seed, obs[i])
+        return None
+
+    @staticmethod
+    def step_envs(envs, actions, obs):
+        n = len(envs)
+        rewards = np.zeros(n, np.int64)
+        terminated = np.zeros(n, bool)
+        truncated = np.zeros(n, bool)
+        stats = np.zeros((4, n), np.int64) # score, life, frame, final_score
+        for i, env in enumerate(envs):
+            _, rewards[i], terminated[i], truncated[i], _ = env.step(actions[i], obs[i])
+            app = env.app
+            stats[3, i] = -1
+            if terminated[i] or truncated[i]:
+                stats[3, i] = app.score
+                env.next_seed += env.seed_stride
+                env.reset(env.next_seed, obs[i])
+            stats[0, i] = app.score
+            stats[1, i] = app.player.life
+            stats[2, i] = app.frame_count
+        return rewards, terminated, truncated, stats
+
+    def reset(self, seed=0):
+        seeds = [seed + i for i in range(self.num_envs)]
+        if self.workers:
+            for conn, s in zip(self.conns, self.slices):
+                conn.send(('reset', (seeds[s], self.num_envs)))
+            for conn in self.conns:
+                conn.recv()
+        else:
+            self.reset_envs(self.envs, (seeds, self.num_envs), self.obs)
+        return self.obs, {}
+
+    def step(self, actions):
+        # 返す観測の配列は次の step で上書きされる (残すときはコピーする)
+        actions = np.asarray(actions)
+        if self.workers:
+            for conn, s in zip(self.conns, self.slices):
+                conn.send(('step', actions[s]))
+            results = [conn.recv() for conn in self.conns]
+            rewards, terminated, truncated, stats = (np.concatenate(r, axis=-1) for r in zip(*results))
+        else:
+            rewards, terminated, truncated, stats = self.step_envs(self.envs, actions, self.obs)
+        info = {'score': stats[0], 'life': stats[1], 'frame': stats[2], 'final_score': stats[3]}
+        return self.obs, rewards, terminated, truncated, info
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(('close', None))
+            except OSError:
+                pass
+        for p in self.processes:
+            p.join(timeout=5)
+        self.processes = []
+        self.conns = []
+        if self.shm:
+            self.obs = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--envs', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=0, help="0 なら同じプロセスで進める")
+    parser.add_argument('--steps', type=int, default=2000)
+    parser.add_argument('--obs', choices=('grid', 'features'), default='grid')
+    parser.add_argument('--frame-skip', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    with VectorEnv(args.envs, args.workers, obs=args.obs, frame_skip=args.frame_skip) as env:
+        env.reset(args.seed)
+        games = 0
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            _, _, terminated, truncated, _ = env.step(rng.integers(0, N_ACTIONS, args.envs))
+            games += int(np.count_nonzero(terminated | truncated))
+        elapsed = time.perf_counter() - start
+    total = args.steps * args.envs
+    print(f"{total} steps in {elapsed:.3f}s  ({total / elapsed:.0f} steps/s, {games} games finished)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+# ウィンドウを開かずにゲームやリプレイを動画 (GIF・PNG 連番・生の RGB) に書き出す
+# App.draw で描いた画面を1枚ずつ取り出してそのままエンコーダに渡すので、全フレームをメモリに持たない
+#
+#   python export.py out.gif --replay out.trp                    # リプレイを GIF に
+#   python export.py frames/%05d.png --seed 1 --frames 600       # ランダムな入力で PNG 連番に
+#   python export.py - --replay out.trp | ffplay -f rawvideo -pixel_format rgb24 -video_size 256x256 -framerate 60 -
+#   python export.py out.mp4 --replay out.trp --pipe "ffmpeg -y -f rawvideo -pix_fmt rgb24 -s {w}x{h} -r {fps} -i - {out}"
+#
+# --stride N で N フレームに1枚だけ描いて書き出し (ゲームは全フレーム進める)、--region x,y,w,h で画面の一部だけを切り出す
+# --start F なら F フレーム目まで描かずに進めてから書き出す
+import argparse
+import os
+import shlex
+import struct
+import subprocess
+import sys
+import time
+import zlib
+
+import numpy as np
+import pyxel
+
+from main import App, ScriptedInput, SCREEN_WIDTH, SCREEN_HEIGHT, SIM_FPS
+import headless
+import replay
+
+
+def palette():
+    # pyxel のパレット (0xRRGGBB) を (色数, 3) の uint8 に
+    colors = np.array(list(pyxel.colors), np.uint32)
+    return np.stack(((colors >> 16) & 0xff, (colors >> 8) & 0xff, colors & 0xff), axis=1).astype(np.uint8)
+
+
+def lzw_encode(pixels, min_size):
+    # GIF の LZW 圧縮 (pixels は 1 バイト 1 画素)。表が 4096 個で埋まったらクリアコードを出して作り直す
+    clear = 1 << min_size
+    end = clear + 1
+    out = bytearray()
+    size = min_size + 1
+    bits = clear
+    nbits = size
+    table = {}
+    get = table.get
+    next_code = end + 1
+    prefix = pixels[0]
+    for i in range(1, len(pixels)):
+        p = pixels[i]
+        key = prefix << 8 | p
+        code = get(key)
+        if code is not None:
+            prefix = code
+            continue
+        bits |= prefix << nbits
+        nbits += size
+        while nbits >= 8:
+            out.append(bits & 0xff)
+            bits >>= 8
+            nbits -= 8
+        if next_code < 4096:
+            table[key] = next_code
+            if next_code == 1 << size:
+                size += 1
+            next_code += 1
+        else:
+            bits |= clear << nbits
+            nbits += size
+            table.clear()
+            size = min_size + 1
+            next_code = end + 1
+        prefix = p
+    bits |= prefix << nbits
+    nbits += size
+    bits |= end << nbits
+    nbits += size
+    while nbits > 0:
+        out.append(bits & 0xff)
+        bits >>= 8
+        nbits -= 8
+    return out
+
+
+class GifWriter:
+    # 1フレームずつファイルに追記する GIF (色はパレットのインデックスのまま)
+    def __init__(self, path, width, height, colors, fps, loop=True):
+        self.file = open(path, 'wb')
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.time = 0 # 書いたフレームの合計の表示時間 (1/100 秒)
+        self.frames = 0
+        depth = max((len(colors) - 1).bit_length(), 2) # 色テーブルは 2 のべき乗 (最低 4 色)
+        self.min_size = depth
+        table = np.zeros((1 << depth, 3), np.uint8)
+        table[:len(colors)] = colors
+        self.file.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0x80 | (depth - 1) << 4 | (depth - 1), 0, 0))
+        self.file.write(table.tobytes())
+        if loop:
+            self.file.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+
+    def write(self, frame):
+        # 表示時間は 1/100 秒単位なので、合計がずれないように端数を次のフレームに回す
+        self.frames += 1
+        end = round(self.frames * 100 / self.fps)
+        delay = end - self.time
+        self.time = end
+        data = lzw_encode(frame.tobytes(), self.min_size)
+        out = bytearray(b'\x21\xf9\x04\x00' + struct.pack('<H', delay) + b'\x00\x00')
+        out += b'\x2c' + struct.pack('<HHHHB', 0, 0, self.width, self.height, 0) + bytes((self.min_size,))
+        for i in range(0, len(data), 255):
+            block = data[i:i + 255]
+            out.append(len(block))
+            out += block
+        out.append(0)
+        self.file.write(out)
+
+    def close(self):
+        self.file.write(b'\x3b')
+        self.file.close()
+
+
+class PngWriter:
+    # 1フレーム1ファイルのパレット PNG。pattern は '%05d' などでフレーム番号を入れる (なければディレクトリとみなす)
+    def __init__(self, pattern, width, height, colors, level=6):
+        if '%' not in pattern:
+            os.makedirs(pattern, exist_ok=True)
+            pattern = os.path.join(pattern, '%05d.png')
+        elif os.path.dirname(pattern):
+            os.makedirs(os.path.dirname(pattern), exist_ok=True)
+        self.pattern = pattern
+        self.level = level
+        self.frames = 0
+        self.head = b'\x89PNG\r\n\x1a\n' + self.chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0))
+        self.head += self.chunk(b'PLTE', colors.tobytes())
+        self.tail = self.chunk(b'IEND', b'')
+
+    @staticmethod
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    def write(self, frame):
+        # 各行の先頭にフィルタの種類 (0 = なし) を付けて圧縮する
+        rows = np.zeros((frame.shape[0], frame.shape[1] + 1), np.uint8)
+        rows[:, 1:] = frame
+        with open(self.pattern % self.frames, 'wb') as f:
+            f.write(self.head + self.chunk(b'IDAT', zlib.compress(rows.tobytes(), self.level)) + self.tail)
+        self.frames += 1
+
+    def close(self):
+        pass
+
+
+class RawWriter:
+    # RGB 24bit の画素をそのまま流す (標準出力・ファイル・別のプロセスの標準入力)
+    def __init__(self, stream, colors, process=None):
+        self.stream = stream
+        self.colors = colors
+        self.process = process
+
+    def write(self, frame):
+        self.stream.write(self.colors[frame].tobytes())
+
+    def close(self):
+        if self.process:
+            self.stream.close()
+            if self.process.wait():
+                raise RuntimeError(f"encoder exited with status {self.process.returncode}")
+        elif self.stream is not sys.stdout.buffer:
+            self.stream.close()
+        else:
+            self.stream.flush()
+
+
+def open_writer(target, width, height, fps, pipe=None):
+    colors = palette()
+    if pipe:
+        command = shlex.split(pipe.format(w=width, h=height, fps=fps, out=target))
+        process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        return RawWriter(process.stdin, colors, process)
+    if target == '-':
+        return RawWriter(sys.stdout.buffer, colors)
+    ext = os.path.splitext(target)[1].lower()
+    if ext == '.gif':
+        return GifWriter(target, width, height, colors, fps)
+    if ext == '.png' or '%' in target or not ext or os.path.isdir(target):
+        return PngWriter(target, width, height, colors)
+    if ext in ('.rgb', '.raw'):
+        return RawWriter(open(target, 'wb'), colors)
+    raise ValueError(f"unknown output format: {target} (.gif / .png / .rgb / - / --pipe)")
+
+
+def export(app, writer, frames, start=0, stride=1, region=None):
+    # app を start フレーム目まで描かずに進め、そこから frames フレームを stride ごとに描いて writer に渡す
+    # 書き出した枚数を返す
+    x, y, w, h = region or (0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
+    screen = np.frombuffer(pyxel.screen.data_ptr(), np.uint8).reshape(pyxel.height, pyxel.width)
+    while app.frame_count < start:
+        app.update()
+    count = 0
+    for i in range(frames):
+        app.update()
+        if i % stride:
+            continue
+        app.draw()
+        writer.write(screen[y:y + h, x:x + w])
+        count += 1
+    return count
+
+
+def parse_region(text):
+    x, y, w, h = (int(v) for v in text.split(','))
+    if w <= 0 or h <= 0 or x < 0 or y < 0 or x + w > SCREEN_WIDTH or y + h > SCREEN_HEIGHT:
+        raise argparse.ArgumentTypeError(f"region must be inside the {SCREEN_WIDTH}x{SCREEN_HEIGHT} screen")
+    return x, y, w, h
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output', help=".gif / .png (%%05d で連番) / ディレクトリ / .rgb / - (標準出力に RGB)")
+    parser.add_argument('--replay', help="リプレイファイル (なければ --policy の入力で進める)")
+    parser.add_argument('--policy', choices=sorted(headless.POLICIES), default='random')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stage', help="--replay がないときのステージ (既定は endless)")
+    parser.add_argument('--frames', type=int, help="書き出すフレーム数 (既定はリプレイの最後まで、なければ 600)")
+    parser.add_argument('--start', type=int, default=0)
+    parser.add_argument('--stride', type=int, default=1)
+    parser.add_argument('--region', type=parse_region, help="x,y,w,h")
+    parser.add_argument('--pipe', help="生の RGB を標準入力に渡すコマンド ({w} {h} {fps} {out} を置き換える)")
+    args = parser.parse_args()
+    if args.stride < 1:
+        parser.error("--stride must be at least 1")
+    # pyxel.init で作業ディレクトリがこのファイルの場所に変わるので、相対パスは先に絶対パスにしておく
+    if args.output != '-':
+        args.output = os.path.abspath(args.output)
+    if args.replay:
+        args.replay = os.path.abspath(args.replay)
+
+    if not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY'):
+        os.environ.setdefault('SDL_VIDEODRIVER', 'offscreen')
+        os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    pyxel.init(SCREEN_WIDTH, SCREEN_HEIGHT, fps=SIM_FPS)
+
+    if args.replay:
+        rec = replay.Replay.load(args.replay)
+        app = App(headless=True, seed=rec.seed, input_source=ScriptedInput(rec.masks), stage=rec.stage)
+        frames = args.frames if args.frames is not None else len(rec) - args.start
+    else:
+        app = headless.create_app(headless.POLICIES[args.policy](args.seed), seed=args.seed, stage=args.stage)
+        frames = args.frames if args.frames is not None else 600
+
+    _, _, w, h = args.region or (0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
+    fps = SIM_FPS / args.stride
+    writer = open_writer(args.output, w, h, fps if fps != int(fps) else int(fps), args.pipe)
+    start = time.perf_counter()
+    try:
+        count = export(app, writer, max(frames, 0), args.start, args.stride, args.region)
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+    print(f"{count} frames ({w}x{h}, {fps:g} fps) in {elapsed:.2f}s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
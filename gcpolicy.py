@@ -0,0 +1,150 @@
+# ゲームの場面に合わせて GC (循環参照の回収) を動かす
+# エンティティはプールで使い回しているので普段の GC は少ないが、ネット対戦の状態保存のように
+# 毎フレーム tuple を大量に作る場面では世代1以上の回収 (1ms 以上) がプレイ中に入ることがある
+#
+#   リセット直後      全世代を回収してから gc.freeze() で残ったもの (アセット・キャッシュ・プール) を対象外にする
+#   playing / boss    自動の GC を止める (play_threshold > 0 ならしきい値を上げるだけ)
+#   boss_intro / gameover / clear   入った時点で全世代を回収し、しきい値を元に戻す
+#   見張り            止めている間も、世代0の数が young_limit を超えたら世代0だけ、
+#                     RSS が rss_limit_mb 以上増えたら全世代をその場で回収する
+#
+# gc の設定はプロセス全体で共有なので、ヘッドレスでは gc_policy=True を渡したときだけ使う
+#
+#   TOUHOU_GC=0 / 1                  無効・有効 (省略時はウィンドウ実行だけ有効)
+#   TOUHOU_GC_STATS=1                終了時に回収の回数と停止時間を表示する
+import atexit
+import gc
+import os
+import time
+
+PLAY_PHASES = ('playing', 'boss') # GC を止める場面
+RSS_CHECK_INTERVAL = 60 # RSS を読む間隔 (フレーム)
+STATM_PATH = '/proc/self/statm'
+
+
+def read_rss():
+    # 常駐メモリ (バイト)。/proc がない環境では None
+    try:
+        with open(STATM_PATH) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class GcPolicy:
+    def __init__(self, app, play_threshold=0, young_limit=20000, rss_limit_mb=64, report=None):
+        self.app = app
+        self.play_threshold = play_threshold
+        self.young_limit = young_limit
+        self.rss_limit = rss_limit_mb * 1024 * 1024
+        self.default_threshold = gc.get_threshold()
+        self.was_enabled = gc.isenabled()
+        self.phase = None
+        self.explicit = False # 自分で呼んだ gc.collect の間だけ True
+        self.started = 0
+        self.collected_at = -1 # 最後に場面の切り替わりで回収したフレーム
+
+        self.auto_counts = [0, 0, 0] # 世代ごとの自動の回収回数
+        self.explicit_count = 0
+        self.forced_count = 0 # 見張りが回収した回数
+        self.pause_total = 0 # ns
+        self.pause_max = 0
+        self.phase_pause = {} # 場面ごとの停止時間の合計 (ns)
+        self.rss_base = read_rss()
+
+        gc.callbacks.append(self.on_gc)
+        if report if report is not None else os.environ.get('TOUHOU_GC_STATS'):
+            atexit.register(self.report)
+
+    def on_gc(self, phase, info):
+        if phase == 'start':
+            self.started = time.perf_counter_ns()
+            return
+        pause = time.perf_counter_ns() - self.started
+        self.pause_total += pause
+        self.pause_max = max(self.pause_max, pause)
+        self.phase_pause[self.phase] = self.phase_pause.get(self.phase, 0) + pause
+        if self.explicit:
+            self.explicit_count += 1
+        else:
+            self.auto_counts[info['generation']] += 1
+
+    def collect(self, generation=2):
+        self.explicit = True
+        try:
+            gc.collect(generation)
+        finally:
+            self.explicit = False
+
+    def on_reset(self):
+        # 前のゲームのごみを回収し、生き残ったものは以降の GC で辿らない
+        gc.unfreeze()
+        self.collect()
+        gc.freeze()
+        self.rss_base = read_rss()
+        self.phase = None # 次の update で場面の設定をやり直す
+
+    def update(self):
+        # App.update の最初に毎フレーム呼ぶ (場面の変化は次のフレームで拾う)
+        phase = self.app.game_phase
+        if phase != self.phase:
+            self.enter(phase)
+        if self.phase not in PLAY_PHASES:
+            return
+        if gc.get_count()[0] > self.young_limit:
+            self.forced_count += 1
+            self.collect(0)
+        if self.rss_base is not None and self.app.frame_count % RSS_CHECK_INTERVAL == 0:
+            rss = read_rss()
+            if rss is not None and rss - self.rss_base > self.rss_limit:
+                self.forced_count += 1
+                self.collect()
+                self.rss_base = read_rss()
+
+    def enter(self, phase):
+        playing = phase in PLAY_PHASES
+        if self.phase is not None and playing == (self.phase in PLAY_PHASES):
+            self.phase = phase
+            return
+        self.phase = phase
+        if playing:
+            if self.play_threshold:
+                gc.set_threshold(self.play_threshold, *self.default_threshold[1:])
+                gc.enable()
+            else:
+                gc.disable()
+        else:
+            # 止まっている場面なので、ここでまとめて回収する
+            # (ロールバックで同じフレームをやり直したときは回収済みなので飛ばす)
+            gc.set_threshold(*self.default_threshold)
+            gc.enable()
+            if self.app.frame_count > self.collected_at:
+                self.collected_at = self.app.frame_count
+                self.collect()
+
+    def stats(self):
+        return {
+            'auto': list(self.auto_counts),
+            'explicit': self.explicit_count,
+            'forced': self.forced_count,
+            'pause_total_ms': self.pause_total / 1e6,
+            'pause_max_ms': self.pause_max / 1e6,
+            'phase_pause_ms': {str(k): v / 1e6 for k, v in self.phase_pause.items()},
+            'frozen': gc.get_freeze_count(),
+        }
+
+    def report(self):
+        s = self.stats()
+        print(f"gc: auto {s['auto']}  explicit {s['explicit']}  forced {s['forced']}  "
+              f"pause total {s['pause_total_ms']:.2f}ms max {s['pause_max_ms']:.2f}ms  frozen {s['frozen']}")
+
+    def close(self):
+        # gc の設定を元に戻す
+        if self.on_gc in gc.callbacks:
+            gc.callbacks.remove(self.on_gc)
+        gc.unfreeze()
+        gc.set_threshold(*self.default_threshold)
+        if self.was_enabled:
+            gc.enable()
+        else:
+            gc.disable()
@@ -0,0 +1,73 @@
+# ウィンドウを開かずにゲームを進める (CI・性能測定・バランス調整用)
+#
+#   python headless.py --frames 10000 --policy random --seed 0
+import argparse
+import random
+import time
+
+import pyxel
+
+from main import App, ScriptedInput, RecordingAudio, INPUT_BITS
+
+SHOT = INPUT_BITS[pyxel.KEY_SPACE]
+RESTART = INPUT_BITS[pyxel.KEY_R]
+
+
+def idle_policy(frame):
+    return 0
+
+
+class RandomPolicy:
+    # ときどきランダムなキーの組み合わせに切り替える (ショットは押しっぱなし)
+    # restart=True ならゲームオーバー後にすぐ R でやり直す
+    def __init__(self, seed=0, change_rate=0.1, restart=True):
+        self.rng = random.Random(seed)
+        self.change_rate = change_rate
+        self.restart = restart
+        self.mask = SHOT
+
+    def __call__(self, frame):
+        if self.rng.random() < self.change_rate:
+            self.mask = (self.rng.getrandbits(8) & ~RESTART) | SHOT
+        if self.restart and frame % 2:
+            return self.mask | RESTART # btnp で拾えるように1フレームおきに押す
+        return self.mask
+
+
+POLICIES = {
+    'idle': lambda seed: idle_policy,
+    'random': lambda seed: RandomPolicy(seed),
+}
+
+
+def create_app(policy=None, record_audio=False, save_dir=None, seed=None, stage=None):
+    # policy はフレーム番号を受け取って入力マスクを返す関数 (ScriptedInput を参照)
+    audio = RecordingAudio() if record_audio else None
+    app = App(headless=True, input_source=ScriptedInput(policy), audio=audio, save_dir=save_dir, seed=seed, stage=stage)
+    if audio:
+        audio.app = app
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=10000)
+    parser.add_argument('--policy', choices=sorted(POLICIES), default='random')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--record-audio', action='store_true')
+    parser.add_argument('--stage', help="ステージの名前 (stages/<名前>.json、既定は endless)")
+    args = parser.parse_args()
+
+    app = create_app(POLICIES[args.policy](args.seed), args.record_audio, seed=args.seed, stage=args.stage)
+    start = time.perf_counter()
+    app.step(args.frames)
+    elapsed = time.perf_counter() - start
+
+    print(f"frames: {args.frames}  time: {elapsed:.3f}s  ({args.frames / elapsed:.0f} frames/s)")
+    print(f"phase: {app.game_phase}  score: {app.score}  life: {app.player.life}")
+    if args.record_audio:
+        print(f"audio events: {len(app.audio.events)}")
+
+
+if __name__ == '__main__':
+    main()
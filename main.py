@@ -1,9 +1,17 @@
 import pyxel
+import numpy as np
 import math
 import random
 import os
+import json
+import time
+from bisect import bisect_right
+from collections import namedtuple
+from operator import attrgetter
 from pathlib import Path
 
+from scores import ScoreStore
+
 # Pyxelの画面サイズ
 SCREEN_WIDTH = 256
 SCREEN_HEIGHT = 256
@@ -27,12 +35,165 @@ def scale_y(val):
 def scale_val(val):
     return int(val * SCALE_FACTOR)
 
-class Player:
+# 敵の種類 (Enemy.type はこのテーブルのインデックス)
+EnemyType = namedtuple('EnemyType', ['name', 'size', 'color', 'health', 'speed', 'bullet_proof', 'fire_chance'])
+ENEMY_SHOOTER, ENEMY_SWARMER, ENEMY_ARMORED = range(3)
+ENEMY_TYPES = (
+    EnemyType('shooter', scale_val(40), 8, 2, scale_val(2), False, 0.01), # Red, 弾を撃つ
+    EnemyType('swarmer', scale_val(20), 9, 1, scale_val(4), False, 0),    # Orange, 小さくて速い
+    EnemyType('armored', scale_val(50), 13, 5, scale_val(2), True, 0),    # Grey, 弾が効かない
+)
+ENEMY_SPAWN_ROLLS = (0.6, 0.85) # 出現率の累積しきい値 (shooter, swarmer, 残りが armored)
+
+# アイテムの種類 (全アイテムで共有する変更不可のテーブル、Item.type_index はこのインデックス)
+ItemType = namedtuple('ItemType', ['name', 'color'])
+ITEM_SCORE, ITEM_SPEED, ITEM_POWER, ITEM_3WAY, ITEM_BARRIER, ITEM_BOMB = range(6)
+ITEM_TYPES = (
+    ItemType('score', 10),  # yellow
+    ItemType('speed', 12),  # blue
+    ItemType('power', 13),  # grey
+    ItemType('3way', 14),   # purple
+    ItemType('barrier', 6), # pink
+    ItemType('bomb', 7),    # white (for flashing)
+)
+
+# 1フレーム分のキー入力はこの順番のビットマスクで表す (ヘッドレス実行・リプレイ用)
+INPUT_KEYS = (pyxel.KEY_UP, pyxel.KEY_DOWN, pyxel.KEY_LEFT, pyxel.KEY_RIGHT, pyxel.KEY_SPACE, pyxel.KEY_Z, pyxel.KEY_X, pyxel.KEY_R)
+INPUT_BITS = {key: 1 << i for i, key in enumerate(INPUT_KEYS)}
+
+
+def keys_to_mask(keys):
+    mask = 0
+    for key in keys:
+        mask |= INPUT_BITS[key]
+    return mask
+
+
+class ScriptedInput:
+    # ヘッドレス実行時の入力
+    # source はフレーム番号を受け取ってマスクを返す関数か、マスクを順に返すイテラブル (尽きたら入力なし)
+    # bytes やリストなどのシーケンスはフレーム番号で引くので、frame を書き換えればそこから続けられる (snapshot.restore)
+    def __init__(self, source=None):
+        self.frame = -1
+        self.mask = 0
+        self.prev_mask = 0
+        self.func = None
+        self.masks = None
+        self.iterator = None
+        if source is None or callable(source):
+            self.func = source
+        elif hasattr(source, '__getitem__') and hasattr(source, '__len__'):
+            self.masks = source
+        else:
+            self.iterator = iter(source)
+
+    def begin_frame(self):
+        self.frame += 1
+        self.prev_mask = self.mask
+        if self.func:
+            self.mask = self.func(self.frame)
+        elif self.masks is not None:
+            self.mask = self.masks[self.frame] if self.frame < len(self.masks) else 0
+        elif self.iterator:
+            self.mask = next(self.iterator, 0)
+        else:
+            self.mask = 0
+
+    def btn(self, key):
+        return bool(self.mask & INPUT_BITS[key])
+
+    def btnp(self, key):
+        # 押された瞬間のフレームだけ True (pyxel.btnp と同じ)
+        bit = INPUT_BITS[key]
+        return bool(self.mask & bit) and not self.prev_mask & bit
+
+
+class PyxelInput(ScriptedInput):
+    # ウィンドウ実行時の入力
+    # 1回の pyxel のフレームでシミュレーションを0回や2回進めることがあるので (FrameGovernor)、
+    # pyxel.btnp は使わずにステップごとにキーの状態を読んで ScriptedInput と同じように押した瞬間を判定する
     def __init__(self):
+        super().__init__(self.poll)
+
+    def poll(self, frame):
+        mask = 0
+        for i, key in enumerate(INPUT_KEYS):
+            if pyxel.btn(key):
+                mask |= 1 << i
+        return mask
+
+
+class PyxelAudio:
+    def define_sounds(self):
+        # サウンド定義
+        pyxel.sound(0).set(notes="c1", tones="n", volumes="2", effects="q", speed=5) # Shot
+        pyxel.sound(1).set(notes="c1", tones="n", volumes="7", effects="f", speed=15) # Hit/Explosion
+        pyxel.sound(2).set(notes="c1", tones="n", volumes="7", effects="f", speed=30) # Player Hit
+
+        # BGMの定義
+        # メロディ (ch0)
+        pyxel.sound(10).set("c3e3g3c4 g3e3c3r", "t", "7", "n", 10)
+        # ベース (ch1)
+        pyxel.sound(11).set("c2g1c2g1 c2g1c2g1", "s", "5", "n", 10)
+        # アルペジオ (ch2)
+        pyxel.sound(12).set("c2e2g2c3e3g3c4e4", "t", "3", "f", 15)
+        pyxel.music(0).set([10], [11], [12], [])
+
+        # BGMの定義 (ボスステージ - 派手なBGM)
+        # メロディ (ch0)
+        pyxel.sound(13).set("c3g3e3c4g3e3c3r", "t", "7", "n", 8) # Faster, higher pitch
+        # ベース (ch1)
+        pyxel.sound(14).set("c3g2c3g2 c3g2c3g2", "s", "5", "n", 8) # Faster, higher pitch
+        # ドラム (ch2)
+        pyxel.sound(15).set("rrrrrrc1rrrrrr", "n", "5", "f", 4) # Percussive
+        pyxel.music(1).set([13], [14], [15], [])
+
+    def play(self, ch, snd):
+        pyxel.play(ch, snd)
+
+    def playm(self, msc, loop=False):
+        pyxel.playm(msc, loop=loop)
+
+
+class NullAudio:
+    # ヘッドレス実行時は音を鳴らさない
+    def define_sounds(self):
+        pass
+
+    def play(self, ch, snd):
+        pass
+
+    def playm(self, msc, loop=False):
+        pass
+
+
+class RecordingAudio(NullAudio):
+    # 鳴らす代わりに (フレーム, 種類, 引数) を記録する
+    def __init__(self, app=None):
+        self.app = app
+        self.events = []
+
+    def play(self, ch, snd):
+        self.events.append((self.app.frame_count if self.app else None, 'play', (ch, snd)))
+
+    def playm(self, msc, loop=False):
+        self.events.append((self.app.frame_count if self.app else None, 'playm', (msc, loop)))
+
+PLAYER_COLORS = (6, 9) # 1P はピンク、2P はオレンジ
+
+
+class Player:
+    __slots__ = ('x', 'y', 'w', 'h', 'speed', 'life', 'max_life', 'shot_type', 'bullet_power', 'bullet_size',
+                 'has_barrier', 'special_attack_stock', 'is_hammering', 'hammer_cooldown', 'hammer_timer',
+                 'invincible_timer', 'shot_cooldown', 'shot_timer', 'color')
+
+    def __init__(self, index=0, count=1):
+        # count 人で遊ぶときの index 番目 (0 が 1P)。横に等間隔で並べる
         self.w = scale_val(50)
         self.h = scale_val(50)
-        self.x = SCREEN_WIDTH / 2 - self.w / 2
+        self.x = SCREEN_WIDTH * (index + 1) / (count + 1) - self.w / 2
         self.y = SCREEN_HEIGHT - self.h - scale_val(10) # 画面下部に配置
+        self.color = PLAYER_COLORS[index]
         self.speed = scale_val(10)
         self.life = 3
         self.max_life = 5
@@ -51,14 +212,14 @@ class Player:
         self.shot_cooldown = 5 # ショットのクールダウン (フレーム数)
         self.shot_timer = 0 # ショットタイマー
 
-    def update(self):
-        if pyxel.btn(pyxel.KEY_UP):
+    def update(self, input):
+        if input.btn(pyxel.KEY_UP):
             self.y -= self.speed
-        if pyxel.btn(pyxel.KEY_DOWN):
+        if input.btn(pyxel.KEY_DOWN):
             self.y += self.speed
-        if pyxel.btn(pyxel.KEY_LEFT):
+        if input.btn(pyxel.KEY_LEFT):
             self.x -= self.speed
-        if pyxel.btn(pyxel.KEY_RIGHT):
+        if input.btn(pyxel.KEY_RIGHT):
             self.x += self.speed
 
         # 画面端での制限
@@ -75,38 +236,54 @@ class Player:
         if self.invincible_timer > 0:
             self.invincible_timer -= 1
 
-    def draw(self):
+    def draw(self, sprites=None):
         # 無敵時間中は点滅
         if self.invincible_timer > 0 and pyxel.frame_count % 4 < 2:
             return
 
+        style = (self.has_barrier, self.is_hammering, self.color)
+        if sprites:
+            sprites.draw(Player.shape, self.x, self.y, self.w, self.h, style)
+        else:
+            Player.shape(pyxel, self.x, self.y, self.w, self.h, style)
+
+    @staticmethod
+    def shape(g, x, y, w, h, style):
+        # g は pyxel か SpriteCache の Rasterizer
+        has_barrier, is_hammering, color = style
+
         # バリアの描画
-        if self.has_barrier:
-            pyxel.circ(self.x + self.w / 2, self.y + self.h / 2, self.w / 2, 8) # Pyxel color 8 (light blue)
+        if has_barrier:
+            g.circ(x + w / 2, y + h / 2, w / 2, 8) # Pyxel color 8 (light blue)
 
-        # プレイヤー本体 (シンプルな人型)
+        # プレイヤー本体 (シンプルな人型、色は PLAYER_COLORS)
         # 頭
-        pyxel.circ(self.x + self.w / 2, self.y + self.h / 4, self.w / 4, 6) # Pink
+        g.circ(x + w / 2, y + h / 4, w / 4, color)
         # 体
-        pyxel.rect(self.x + self.w / 4, self.y + self.h / 2, self.w / 2, self.h / 2, 6) # Pink
+        g.rect(x + w / 4, y + h / 2, w / 2, h / 2, color)
         # 腕
-        pyxel.rect(self.x, self.y + self.h / 2, self.w / 4, self.h / 4, 6) # Pink
-        pyxel.rect(self.x + self.w * 3 / 4, self.y + self.h / 2, self.w / 4, self.h / 4, 6) # Pink
+        g.rect(x, y + h / 2, w / 4, h / 4, color)
+        g.rect(x + w * 3 / 4, y + h / 2, w / 4, h / 4, color)
 
         # ハンマーの描画
-        if self.is_hammering:
+        if is_hammering:
             hammer_w = scale_val(70)
             hammer_h = scale_val(70)
-            pyxel.rect(
-                self.x + self.w / 2 - hammer_w / 2,
-                self.y - hammer_h / 2,
+            g.rect(
+                x + w / 2 - hammer_w / 2,
+                y - hammer_h / 2,
                 hammer_w,
                 hammer_h,
                 10 # Pyxel color 10 (light yellow)
             )
 
 class Bullet:
+    __slots__ = ('x', 'y', 'w', 'h', 'speed', 'power', 'color', 'dx')
+
     def __init__(self, x, y, dx, power, size, color):
+        self.reset(x, y, dx, power, size, color)
+
+    def reset(self, x, y, dx, power, size, color):
         self.x = x
         self.y = y
         self.w = size
@@ -120,11 +297,20 @@ class Bullet:
         self.y -= self.speed
         self.x += self.dx * (self.speed / 2)
 
+    def motion(self):
+        # 1フレームで動く量 (連続的な当たり判定 time_of_impact 用)
+        return self.dx * (self.speed / 2), -self.speed
+
     def draw(self):
         pyxel.rect(self.x, self.y, self.w, self.h, self.color)
 
 class Enemy:
-    def __init__(self, type, x, y, w, h, speed, color, health):
+    __slots__ = ('type', 'x', 'y', 'w', 'h', 'speed', 'color', 'health', 'dx', 'vx', 'vy')
+
+    def __init__(self, type, x, y, w, h, speed, color, health, dx):
+        self.reset(type, x, y, w, h, speed, color, health, dx)
+
+    def reset(self, type, x, y, w, h, speed, color, health, dx):
         self.type = type
         self.x = x
         self.y = y
@@ -133,72 +319,173 @@ class Enemy:
         self.speed = speed
         self.color = color
         self.health = health
-        self.dx = (random.random() - 0.5) * scale_val(5) # 横方向の速度を上げる
+        self.dx = dx
+        self.vx = self.vy = 0 # 直前の update() で実際に動いた量
 
     def update(self):
-        self.y += self.speed
-        self.x += self.dx
+        self.vx = self.dx
+        self.vy = self.speed
+        self.y += self.vy
+        self.x += self.vx
 
-        # 画面端で跳ね返る
+        # 画面端で跳ね返る (motion() は跳ね返る前に動いた量を返す)
         if self.x < 0 or self.x + self.w > SCREEN_WIDTH:
             self.dx *= -1
 
-    def draw(self):
+    def motion(self):
+        return self.vx, self.vy
+
+    def draw(self, sprites=None):
+        if sprites:
+            sprites.draw(Enemy.shape, self.x, self.y, self.w, self.h, self.color)
+        else:
+            Enemy.shape(pyxel, self.x, self.y, self.w, self.h, self.color)
+
+    @staticmethod
+    def shape(g, x, y, w, h, color):
         # 胴体
-        pyxel.rect(self.x, self.y + self.h / 4, self.w, self.h / 2, self.color)
+        g.rect(x, y + h / 4, w, h / 2, color)
         # 頭
-        pyxel.tri(self.x + self.w / 4, self.y, self.x + self.w * 3 / 4, self.y, self.x + self.w / 2, self.y + self.h / 4, self.color)
+        g.tri(x + w / 4, y, x + w * 3 / 4, y, x + w / 2, y + h / 4, color)
         # 左翼
-        pyxel.tri(self.x - self.w / 4, self.y + self.h / 4, self.x, self.y + self.h / 2, self.x, self.y + self.h / 4, 10)
+        g.tri(x - w / 4, y + h / 4, x, y + h / 2, x, y + h / 4, 10)
         # 右翼
-        pyxel.tri(self.x + self.w, self.y + self.h / 4, self.x + self.w * 5 / 4, self.y + self.h / 2, self.x + self.w, self.y + self.h / 4, 10)
+        g.tri(x + w, y + h / 4, x + w * 5 / 4, y + h / 2, x + w, y + h / 4, 10)
         # 尻尾
-        pyxel.tri(self.x + self.w / 2, self.y + self.h / 2, self.x + self.w * 3 / 4, self.y + self.h, self.x + self.w / 4, self.y + self.h, self.color)
-
-class EnemyBullet:
-    def __init__(self, x, y, dx, dy, w, h, speed, color):
-        self.x = x
-        self.y = y
-        self.w = w
-        self.h = h
-        self.speed = speed
-        self.color = color
-        self.dx = dx
-        self.dy = dy
+        g.tri(x + w / 2, y + h / 2, x + w * 3 / 4, y + h, x + w / 4, y + h, color)
+
+class EnemyBulletStore:
+    # 敵の弾は数が多いので、1発ずつのオブジェクトではなく配列 (SoA) でまとめて持つ
+    # 移動・画面外の削除・プレイヤーとの当たり判定はそれぞれ1回の配列演算で行う
+    def __init__(self, capacity=256):
+        self.count = 0
+        self.high_water = 0 # 同時に存在した最大数
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        self.capacity = capacity
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.dx = np.zeros(capacity)
+        self.dy = np.zeros(capacity)
+        self.w = np.zeros(capacity)
+        self.h = np.zeros(capacity)
+        self.color = np.zeros(capacity, dtype=np.int32)
+
+    def arrays(self):
+        return (self.x, self.y, self.dx, self.dy, self.w, self.h, self.color)
+
+    def grow(self, needed):
+        # 容量が足りなくなったら倍々で確保し直す
+        old = self.arrays()
+        self.allocate(max(needed, self.capacity * 2))
+        n = self.count
+        for dst, src in zip(self.arrays(), old):
+            dst[:n] = src[:n]
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.count = 0
+
+    def spawn(self, x, y, dx, dy, w, h, color):
+        if self.count >= self.capacity:
+            self.grow(self.count + 1)
+        i = self.count
+        self.x[i] = x
+        self.y[i] = y
+        self.dx[i] = dx
+        self.dy[i] = dy
+        self.w[i] = w
+        self.h[i] = h
+        self.color[i] = color
+        self.count += 1
+        if self.count > self.high_water:
+            self.high_water = self.count
+
+    def spawn_many(self, x, y, dx, dy, w, h, color):
+        # dx, dy は配列、x, y, w, h, color は配列でもスカラーでもよい
+        k = len(dx)
+        if self.count + k > self.capacity:
+            self.grow(self.count + k)
+        i, j = self.count, self.count + k
+        self.x[i:j] = x
+        self.y[i:j] = y
+        self.dx[i:j] = dx
+        self.dy[i:j] = dy
+        self.w[i:j] = w
+        self.h[i:j] = h
+        self.color[i:j] = color
+        self.count = j
+        if j > self.high_water:
+            self.high_water = j
 
     def update(self):
-        self.x += self.dx
-        self.y += self.dy
+        n = self.count
+        if n == 0:
+            return
+        self.x[:n] += self.dx[:n]
+        self.y[:n] += self.dy[:n]
+
+        # 画面外の弾を削除 (順番は保つ)
+        x, y, w, h = self.x[:n], self.y[:n], self.w[:n], self.h[:n]
+        keep = (y > -h) & (y < SCREEN_HEIGHT + h) & (x > -w) & (x < SCREEN_WIDTH + w)
+        m = int(np.count_nonzero(keep))
+        if m < n:
+            for a in self.arrays():
+                a[:m] = a[:n][keep]
+            self.count = m
+
+    def hit_index(self, target):
+        # target に当たっている弾のうちインデックスが最大のもの (なければ -1)
+        n = self.count
+        if n == 0:
+            return -1
+        x, y = self.x[:n], self.y[:n]
+        hit = (x < target.x + target.w) & (x + self.w[:n] > target.x) & (y < target.y + target.h) & (y + self.h[:n] > target.y)
+        indices = np.flatnonzero(hit)
+        return int(indices[-1]) if len(indices) else -1
+
+    def remove(self, i):
+        n = self.count
+        for a in self.arrays():
+            a[i:n - 1] = a[i + 1:n]
+        self.count = n - 1
+
+    def stats(self):
+        return {'in_use': self.count, 'capacity': self.capacity, 'high_water': self.high_water}
 
     def draw(self):
-        pyxel.rect(self.x, self.y, self.w, self.h, self.color)
+        n = self.count
+        for x, y, w, h, color in zip(self.x[:n].tolist(), self.y[:n].tolist(), self.w[:n].tolist(), self.h[:n].tolist(), self.color[:n].tolist()):
+            pyxel.rect(x, y, w, h, color)
 
 class Item:
+    __slots__ = ('x', 'y', 'w', 'h', 'speed', 'type_index', 'is_bouncing', 'bounce_speed', 'initial_bounce_y', 'bounce_height', 'vy')
+
     def __init__(self, x, y, w, h, speed, type_index):
+        self.reset(x, y, w, h, speed, type_index)
+
+    def reset(self, x, y, w, h, speed, type_index):
         self.x = x
         self.y = y
         self.w = w
         self.h = h
         self.speed = speed
         self.type_index = type_index
-        self.item_types = [
-            {'name': 'score', 'color': 10}, # yellow
-            {'name': 'speed', 'color': 12}, # blue
-            {'name': 'power', 'color': 13}, # grey
-            {'name': '3way', 'color': 14},  # purple
-            {'name': 'barrier', 'color': 6},# pink
-            {'name': 'bomb', 'color': 7}    # white (for flashing)
-        ]
         self.is_bouncing = False
         self.bounce_speed = scale_val(5)
         self.initial_bounce_y = 0
         self.bounce_height = scale_val(30)
+        self.vy = 0 # 直前の update() で実際に動いた量 (頂点で止めた分も含む)
 
     @property
     def type(self):
-        return self.item_types[self.type_index]
+        return ITEM_TYPES[self.type_index]
 
     def update(self):
+        y = self.y
         if self.is_bouncing:
             self.y -= self.bounce_speed
             if self.y <= self.initial_bounce_y - self.bounce_height:
@@ -206,17 +493,26 @@ class Item:
                 self.y = self.initial_bounce_y - self.bounce_height # Ensure it stops at the peak
         else:
             self.y += self.speed
+        self.vy = self.y - y
+
+    def motion(self):
+        return 0, self.vy
 
     def draw(self):
-        if self.type['name'] == 'bomb':
+        if self.type_index == ITEM_BOMB:
             # 点滅表現
             if pyxel.frame_count % 10 < 5:
-                pyxel.rect(self.x, self.y, self.w, self.h, self.type['color'])
+                pyxel.rect(self.x, self.y, self.w, self.h, ITEM_TYPES[ITEM_BOMB].color)
         else:
-            pyxel.rect(self.x, self.y, self.w, self.h, self.type['color'])
+            pyxel.rect(self.x, self.y, self.w, self.h, ITEM_TYPES[self.type_index].color)
 
 class Explosion:
+    __slots__ = ('x', 'y', 'size', 'color', 'duration', 'timer')
+
     def __init__(self, x, y, size, color, duration):
+        self.reset(x, y, size, color, duration)
+
+    def reset(self, x, y, size, color, duration):
         self.x = x
         self.y = y
         self.size = size
@@ -232,7 +528,12 @@ class Explosion:
             pyxel.rect(self.x - self.size / 2, self.y - self.size / 2, self.size, self.size, self.color)
 
 class BombEffect:
+    __slots__ = ('x', 'y', 'radius', 'max_radius', 'speed', 'is_alive', 'color')
+
     def __init__(self, x, y):
+        self.reset(x, y)
+
+    def reset(self, x, y):
         self.x = x
         self.y = y
         self.radius = 0
@@ -246,16 +547,21 @@ class BombEffect:
         if self.radius > self.max_radius:
             self.is_alive = False
 
-    def draw(self):
+    def draw(self, rings=3):
         # 複数の円を時間差で描画して波紋のようなエフェクトにする
-        for i in range(3):
+        for i in range(rings):
             r = self.radius - i * 20
             if r > 0:
                 # 中空の円を描画
                 pyxel.circb(self.x, self.y, r, self.color)
 
 class HealItem:
+    __slots__ = ('x', 'y', 'w', 'h', 'speed', 'color')
+
     def __init__(self, x, y, w, h, speed, color):
+        self.reset(x, y, w, h, speed, color)
+
+    def reset(self, x, y, w, h, speed, color):
         self.x = x
         self.y = y
         self.w = w
@@ -266,11 +572,19 @@ class HealItem:
     def update(self):
         self.y += self.speed
 
+    def motion(self):
+        return 0, self.speed
+
     def draw(self):
         pyxel.rect(self.x, self.y, self.w, self.h, self.color)
 
 class Cloud:
+    __slots__ = ('x', 'y', 'w', 'h', 'speed', 'dropped_item')
+
     def __init__(self, x, y, w, h, speed, is_background_cloud=False):
+        self.reset(x, y, w, h, speed)
+
+    def reset(self, x, y, w, h, speed, is_background_cloud=False):
         self.x = x
         self.y = y
         self.w = w
@@ -281,12 +595,85 @@ class Cloud:
     def update(self):
         self.y += self.speed # Move downwards
 
+    def motion(self):
+        return 0, self.speed
+
     def draw(self):
         # Pyxelには楕円描画がないので、rectで代用するか、後で画像を使う
         pyxel.rect(self.x, self.y, self.w, self.h, 7) # White for cloud
 
+# 弾幕パターン
+# 1回の発射で撃つ弾の向きと速さ (速度ベクトル) は作るときに計算しておき、
+# 発射のたびに全体を回転 (cos/sin 1組) させて spawn_many でまとめて追加する
+class BulletPattern:
+    __slots__ = ('vx', 'vy', 'interval', 'spin', 'aim', 'window', 'w', 'h', 'color')
+
+    def __init__(self, angles, speeds, interval, spin=0.0, aim=False, window=None, w=scale_val(10), h=scale_val(20), color=6):
+        # angles と speeds の組み合わせ全部を1回で撃つ (speeds を複数にすると同じ向きに速さ違いの弾が並ぶ)
+        angles, speeds = np.meshgrid(np.asarray(angles, dtype=float), np.atleast_1d(np.asarray(speeds, dtype=float)))
+        self.vx = (np.cos(angles) * speeds).ravel()
+        self.vy = (np.sin(angles) * speeds).ravel()
+        self.interval = interval # 何フレームごとに撃つか
+        self.spin = spin # 1フレームあたりの回転 (ラジアン)
+        self.aim = aim # True ならプレイヤーの方向を 0 度にする
+        self.window = window # (開始, 終了): フェーズの cycle の中でこの間だけ撃つ
+        self.w = w
+        self.h = h
+        self.color = color
+
+    def emit(self, store, x, y, t, target=None):
+        # (x, y) から撃つ。t はボスの attack_timer
+        if t % self.interval:
+            return
+        vx, vy = self.vx, self.vy
+        if self.spin:
+            angle = t * self.spin
+            c, s = math.cos(angle), math.sin(angle)
+            vx, vy = vx * c - vy * s, vx * s + vy * c
+        if self.aim and target:
+            # 向きベクトルを正規化して回転に使う (三角関数はいらない)
+            ax = target.x + target.w / 2 - x
+            ay = target.y + target.h / 2 - y
+            d = math.hypot(ax, ay)
+            if d:
+                c, s = ax / d, ay / d
+                vx, vy = vx * c - vy * s, vx * s + vy * c
+        store.spawn_many(x - self.w / 2, y, vx, vy, self.w, self.h, self.color)
+
+
+def ring(count, speed, interval, spin=0.0, **kwargs):
+    # 全方向に等間隔 (spin を付けると発射ごとに回る)
+    return BulletPattern(np.arange(count) * (math.pi * 2 / count), speed, interval, spin, **kwargs)
+
+
+def spiral(arms, speed, interval, spin, **kwargs):
+    # 少ない本数を細かい間隔で撃ちながら回す
+    return ring(arms, speed, interval, spin, **kwargs)
+
+
+def fan(count, spread, speed, interval, aim=True, **kwargs):
+    # spread (ラジアン) の範囲に count 発。aim=True ならプレイヤー狙い
+    return BulletPattern(np.linspace(-spread / 2, spread / 2, count), speed, interval, aim=aim, **kwargs)
+
+
+# ボスの攻撃プログラム: フェーズは上から順に見て、体力が min_health より多い最初のものを使う
+# cycle を指定すると attack_timer % cycle が各パターンの window に入っているときだけ撃つ
+BossPhase = namedtuple('BossPhase', ['min_health', 'patterns', 'cycle'], defaults=(None,))
+
+BOSS_PROGRAM = (
+    BossPhase(-math.inf, (ring(16, scale_val(4), 5, spin=1 / 20),)), # 16方向、5フレームごと、少しずつ回転
+)
+BOSS_PROGRAM_DENSE = (
+    BossPhase(300, (ring(16, scale_val(4), 5, spin=1 / 20), fan(5, 0.8, 1.5, 30))),
+    BossPhase(100, (spiral(4, 1.2, 2, spin=0.13), ring(24, (1.0, 1.6), 40, window=(20, 100))), cycle=120),
+    BossPhase(-math.inf, (spiral(6, 1.4, 2, spin=-0.11), ring(32, (1.0, 1.5), 20), fan(7, 1.2, 2.0, 15))),
+)
+
+
 class Boss:
-    def __init__(self):
+    __slots__ = ('w', 'h', 'x', 'y', 'speed', 'dx', 'health', 'max_health', 'color', 'attack_pattern', 'attack_timer', 'program', 'vx', 'vy')
+
+    def __init__(self, program=BOSS_PROGRAM):
         self.w = scale_val(200)
         self.h = scale_val(200)
         self.x = SCREEN_WIDTH / 2 - self.w / 2
@@ -296,10 +683,13 @@ class Boss:
         self.health = 500
         self.max_health = 500
         self.color = 14 # Purple
-        self.attack_pattern = 'descend'
+        self.attack_pattern = 'descend' # descend: 降りてくる, barrage: 左右に動きながら弾幕
         self.attack_timer = 0
+        self.program = program
+        self.vx = self.vy = 0 # 直前の update() で実際に動いた量
 
     def update(self):
+        x, y = self.x, self.y
         if self.attack_pattern == 'descend':
             self.y += self.speed
             if self.y >= scale_val(50):
@@ -309,6 +699,24 @@ class Boss:
             if self.x <= 0 or self.x + self.w >= SCREEN_WIDTH:
                 self.dx *= -1
             self.attack_timer += 1
+        self.vx = self.x - x
+        self.vy = self.y - y
+
+    def motion(self):
+        return self.vx, self.vy
+
+    def fire(self, store, target):
+        # 体力で今のフェーズを選び、そのパターンを撃つ
+        for phase in self.program:
+            if self.health > phase.min_health:
+                break
+        t = self.attack_timer
+        x = self.x + self.w / 2
+        y = self.y + self.h / 2
+        for pattern in phase.patterns:
+            if pattern.window and not pattern.window[0] <= t % phase.cycle < pattern.window[1]:
+                continue
+            pattern.emit(store, x, y, t, target)
 
     def draw(self):
         pyxel.rect(self.x, self.y, self.w, self.h, self.color)
@@ -317,341 +725,1065 @@ class Boss:
         pyxel.rect(self.x, self.y - scale_val(10), self.w * (self.health / self.max_health), scale_val(5), 11) # Health (green)
 
 
+# ステージ
+# 'endless' は今までどおりのランダムな出現 (3フレームごとに敵、240フレームごとに雲、スコア 100000 でボス)
+# それ以外は stages/<名前>.json のタイムラインで、選ばれたときに初めて読み込んでフレーム順のイベントの配列にする
+#
+# stages/<名前>.json (座標・大きさ・速さは Pyxel の画面のピクセル、frame はステージが始まってからのフレーム数):
+#   {
+#     "boss": {"program": "dense", "score": null},               ボスの攻撃 (normal / dense) と出現するスコア (null ならイベントのみ)
+#     "enemies": {"heavy": {"base": "shooter", "health": 6}},      ENEMY_TYPES の値を変えた敵の種類
+#     "formations": {"v3": [[0, 0], [-20, -15], [20, -15]]},       編隊 (先頭の敵からのずれ)
+#     "events": [
+#       {"frame": 60, "wave": {"enemy": "swarmer", "formation": "v3", "x": 118, "dx": 0}},
+#       {"frame": 120, "every": 30, "count": 4, "shift": [40, 0], "wave": {...}},   30フレームごとに4回、毎回 shift だけずらす
+#       {"frame": 300, "cloud": {"x": 80, "w": 100, "h": 40}},
+#       {"frame": 1800, "boss": true}
+#     ]
+#   }
+STAGE_DIR = Path(__file__).resolve().parent / 'stages'
+BOSS_PROGRAMS = {'normal': BOSS_PROGRAM, 'dense': BOSS_PROGRAM_DENSE}
+FORMATIONS = {'single': ((0, 0),)}
+STAGE_WAVE, STAGE_CLOUD, STAGE_BOSS = range(3) # イベントの種類
+
+
+class EndlessStage:
+    name = 'endless'
+    enemy_types = ENEMY_TYPES
+    boss_program = BOSS_PROGRAM
+    boss_score = 100000 # スコア閾値を100000に調整
+
+    def update(self, app):
+        app.enemy_spawn_timer += 1
+        if app.enemy_spawn_timer >= 3: # 0.05秒に1回敵を出現させる (10倍)
+            app.spawn_enemy()
+            app.enemy_spawn_timer = 0
+
+        # 雲の出現
+        app.cloud_spawn_timer += 1
+        if app.cloud_spawn_timer >= 240: # 4秒に1回 (240フレーム)
+            app.spawn_cloud() # アイテムドロップ用の雲
+            app.cloud_spawn_timer = 0
+
+
+class TimelineStage:
+    # events は (フレーム, 種類, 引数) をフレーム順に並べたもの (繰り返しも読み込み時に展開しておく)
+    # app.stage_cursor が次のイベントを指すので、1フレームの処理はステージの長さによらずそのフレームのイベントの数だけ
+    def __init__(self, name, events, enemy_types, boss_program=BOSS_PROGRAM, boss_score=None):
+        self.name = name
+        self.events = events
+        self.enemy_types = enemy_types
+        self.boss_program = boss_program
+        self.boss_score = boss_score
+
+    def update(self, app):
+        frame = app.stage_frame
+        app.stage_frame += 1
+        events = self.events
+        i = app.stage_cursor
+        while i < len(events) and events[i][0] <= frame:
+            _, kind, args = events[i]
+            i += 1
+            if kind == STAGE_WAVE:
+                for spawn in args:
+                    app.world.spawn('enemies', *spawn)
+            elif kind == STAGE_CLOUD:
+                app.world.spawn('clouds', *args)
+            else:
+                app.start_boss_intro()
+        app.stage_cursor = i
+
+    @classmethod
+    def compile(cls, name, data):
+        types = list(ENEMY_TYPES)
+        type_index = {t.name: i for i, t in enumerate(types)}
+        for type_name, spec in data.get('enemies', {}).items():
+            spec = dict(spec)
+            base = spec.pop('base', 'shooter')
+            if base not in type_index:
+                raise ValueError(f"{name}: unknown enemy type {base!r}")
+            type_index[type_name] = len(types)
+            types.append(types[type_index[base]]._replace(name=type_name, **spec))
+        formations = dict(FORMATIONS)
+        formations.update((key, tuple(map(tuple, offsets))) for key, offsets in data.get('formations', {}).items())
+
+        events = []
+        for event in data.get('events', ()):
+            shift_x, shift_y = event.get('shift', (0, 0))
+            for n in range(event.get('count', 1)):
+                frame = event['frame'] + n * event.get('every', 0)
+                if 'wave' in event:
+                    wave = event['wave']
+                    enemy = wave.get('enemy', 'shooter')
+                    if enemy not in type_index or wave.get('formation', 'single') not in formations:
+                        raise ValueError(f"{name}: unknown enemy or formation in {wave}")
+                    t = type_index[enemy]
+                    spec = types[t]
+                    x = wave.get('x', (SCREEN_WIDTH - spec.size) / 2) + n * shift_x
+                    y = wave.get('y', -spec.size) + n * shift_y
+                    dx = wave.get('dx', 0)
+                    spawns = tuple((t, x + ox, y + oy, spec.size, spec.size, spec.speed, spec.color, spec.health, dx)
+                                   for ox, oy in formations[wave.get('formation', 'single')])
+                    events.append((frame, STAGE_WAVE, spawns))
+                elif 'cloud' in event:
+                    cloud = event['cloud']
+                    w = cloud.get('w', scale_val(100))
+                    h = cloud.get('h', scale_val(45))
+                    x = cloud.get('x', (SCREEN_WIDTH - w) / 2) + n * shift_x
+                    y = cloud.get('y', -h * 2) + n * shift_y
+                    events.append((frame, STAGE_CLOUD, (x, y, w, h, cloud.get('speed', scale_val(7)))))
+                elif event.get('boss'):
+                    events.append((frame, STAGE_BOSS, None))
+                else:
+                    raise ValueError(f"{name}: unknown event {event}")
+        events.sort(key=lambda e: e[0]) # 同じフレームのイベントはファイルの順
+
+        boss = data.get('boss', {})
+        program = boss.get('program', 'normal')
+        if program not in BOSS_PROGRAMS:
+            raise ValueError(f"{name}: unknown boss program {program!r}")
+        return cls(name, events, tuple(types), BOSS_PROGRAMS[program], boss.get('score'))
+
+
+STAGES = {'endless': EndlessStage()} # 読み込んだステージ (名前ごとに1回だけ読む)
+
+
+def load_stage(name):
+    # name はステージの名前 (stages/<name>.json) か .json ファイルのパス
+    stage = STAGES.get(name)
+    if stage is None:
+        path = Path(name) if name.endswith('.json') else STAGE_DIR / f'{name}.json'
+        with open(path, encoding='utf-8') as f:
+            stage = STAGES[name] = TimelineStage.compile(path.stem, json.load(f))
+    return stage
+
+
+BACKGROUND_BANKS = {'sea': 0, 'space': 2} # 背景ごとの描画済み画像を置くイメージバンク
+STAR_COUNT = 100
+STAR_SEED = 20240501 # 星の配置 (毎フレーム変わらないように固定)
+
+
+class BackgroundCache:
+    # 背景 (海・宇宙) は種類ごとのイメージバンクに一度だけ描いておき (ウィンドウ実行では起動時の build_assets で)、
+    # 毎フレームは blt で貼るだけにする
+    def __init__(self, banks=BACKGROUND_BANKS):
+        self.banks = banks
+        self.rendered = set() # イメージバンクに描いてある背景
+        rng = random.Random(STAR_SEED)
+        self.stars = [(rng.randint(0, SCREEN_WIDTH - 1), rng.randint(0, SCREEN_HEIGHT - 1)) for _ in range(STAR_COUNT)]
+
+    def invalidate(self):
+        # イメージバンクが書き換えられたときに呼ぶ (次の描画で作り直す)
+        self.rendered.clear()
+
+    def render(self, kind):
+        image = pyxel.images[self.banks[kind]]
+        if kind == 'sea':
+            for y in range(SCREEN_HEIGHT):
+                if y < SCREEN_HEIGHT * 0.2: # Top 20% (lighter blue)
+                    image.rect(0, y, SCREEN_WIDTH, 1, 12) # Light blue
+                elif y < SCREEN_HEIGHT * 0.5: # Middle 30% (medium blue)
+                    image.rect(0, y, SCREEN_WIDTH, 1, 1) # Dark blue
+                else: # Bottom 50% (darker blue)
+                    image.rect(0, y, SCREEN_WIDTH, 1, 1) # Dark blue
+        elif kind == 'space':
+            # 星だけを描いておき、地球は手前に重ねる (星はスクロールさせる)
+            image.cls(0) # Black for space
+            for star_x, star_y in self.stars:
+                image.pset(star_x, star_y, 7) # White stars
+        self.rendered.add(kind)
+
+    def draw(self, kind, frame, scroll=True, stars=True):
+        if kind == 'sky':
+            pyxel.cls(12) # Light blue for sky (雲は draw_entities で描く)
+            return
+        if kind == 'space' and not stars:
+            pyxel.cls(0) # 星なし (描画の品質を下げたとき)
+            self.draw_earth()
+            return
+        if kind not in self.rendered:
+            self.render(kind)
+        bank = self.banks[kind]
+
+        if kind == 'sea':
+            pyxel.blt(0, 0, bank, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
+            return
+
+        # 星は2フレームに1ドットずつ下へ流す (画面の下端から上端へ回り込む)
+        offset = frame // 2 % SCREEN_HEIGHT if scroll else 0
+        pyxel.blt(0, offset, bank, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT - offset)
+        if offset:
+            pyxel.blt(0, 0, bank, 0, SCREEN_HEIGHT - offset, SCREEN_WIDTH, offset)
+        self.draw_earth()
+
+    def draw_earth(self):
+        # Draw Earth (simple circle with blue and green)
+        earth_radius = scale_val(50)
+        earth_x = SCREEN_WIDTH / 2
+        earth_y = SCREEN_HEIGHT / 4 * 3 # Near bottom
+        pyxel.circ(earth_x, earth_y, earth_radius, 1) # Blue ocean
+        pyxel.circ(earth_x + earth_radius / 3, earth_y - earth_radius / 3, earth_radius / 2, 3) # Green land
+        pyxel.circ(earth_x - earth_radius / 2, earth_y + earth_radius / 4, earth_radius / 4, 3) # Green land
+
+
+SPRITE_BANK = 1 # 敵・プレイヤーの描画済み図形を置くイメージバンク
+SPRITE_COLKEY = 0 # 図形には使わない色 (blt で透明にする)
+SPRITE_MARGIN = 2 # 画面の端からこれ以上離れている図形だけをキャッシュから描く
+SUB_PIXEL_EPS = 1e-3 # 1/4 ピクセルの区切りからこれより近い座標はキャッシュを使わない (1/4 ピクセル単位)
+
+
+def pyxel_round(v):
+    # pyxel は座標と大きさを整数に丸めてから描く (0.5 は 0 から遠い方へ)
+    return int(math.copysign(math.floor(abs(v) + 0.5), v))
+
+
+class Rasterizer:
+    # pyxel と同じ rect/tri/circ を受け取り、整数に丸めてからイメージバンクに描く
+    # image が None なら描かずに範囲だけを調べる
+    def __init__(self, image=None, dx=0, dy=0):
+        self.image = image
+        self.dx = dx
+        self.dy = dy
+        self.left = self.top = math.inf
+        self.right = self.bottom = -math.inf
+
+    def include(self, x0, y0, x1, y1):
+        self.left = min(self.left, x0)
+        self.top = min(self.top, y0)
+        self.right = max(self.right, x1)
+        self.bottom = max(self.bottom, y1)
+
+    def rect(self, x, y, w, h, col):
+        x, y, w, h = pyxel_round(x), pyxel_round(y), pyxel_round(w), pyxel_round(h)
+        if w <= 0 or h <= 0:
+            return
+        self.include(x, y, x + w - 1, y + h - 1)
+        if self.image:
+            self.image.rect(x + self.dx, y + self.dy, w, h, col)
+
+    def tri(self, x1, y1, x2, y2, x3, y3, col):
+        xs = (pyxel_round(x1), pyxel_round(x2), pyxel_round(x3))
+        ys = (pyxel_round(y1), pyxel_round(y2), pyxel_round(y3))
+        self.include(min(xs), min(ys), max(xs), max(ys))
+        if self.image:
+            self.image.tri(xs[0] + self.dx, ys[0] + self.dy, xs[1] + self.dx, ys[1] + self.dy, xs[2] + self.dx, ys[2] + self.dy, col)
+
+    def circ(self, x, y, r, col):
+        x, y, r = pyxel_round(x), pyxel_round(y), pyxel_round(r)
+        self.include(x - r, y - r, x + r, y + r)
+        if self.image:
+            self.image.circ(x + self.dx, y + self.dy, r, col)
+
+
+class SpriteCache:
+    # 敵・プレイヤーの図形 (rect・tri・circ の組み合わせ) を一度だけイメージバンクに描いておき、
+    # 毎フレームは blt 1回で貼る
+    # pyxel は座標を整数に丸めてから描くので、同じ図形でも座標の小数部で形が1ドットずれることがある
+    # 幅と高さが整数なら頂点は x, y から 1/4 の倍数だけずれた位置にあるので、小数部を 1/4 ずつの区分に分けて区分ごとに別の画像にする
+    # イメージバンクがいっぱいになったら全部捨てて描き直す
+    def __init__(self, bank=SPRITE_BANK):
+        self.bank = bank
+        self.entries = {} # (図形, 幅, 高さ, 色) -> [キャッシュから描ける x, y の範囲, 区分ごとの画像]
+        self.misses = 0
+        self.evictions = 0
+        self.invalidate()
+
+    def invalidate(self):
+        # イメージバンクが書き換えられたときにも呼ぶ
+        for entry in self.entries.values():
+            entry[4] = [None] * 16
+        self.count = 0
+        self.shelf_x = 0
+        self.shelf_y = 0
+        self.shelf_h = 0
+
+    def measure(self, shape, w, h, style):
+        # 画面の端にかかる図形はそのまま描く (クリップされると tri の塗り方が変わる)
+        bounds = Rasterizer()
+        shape(bounds, 0, 0, w, h, style)
+        return [max(SPRITE_MARGIN - bounds.left, 0), max(SPRITE_MARGIN - bounds.top, 0),
+                SCREEN_WIDTH - SPRITE_MARGIN - bounds.right, SCREEN_HEIGHT - SPRITE_MARGIN - bounds.bottom,
+                [None] * 16]
+
+    def draw(self, shape, x, y, w, h, style):
+        # shape(g, x, y, w, h, style) は g (pyxel か Rasterizer) に図形を描く関数 (色 0 は使わない)
+        entry = self.entries.get((shape, w, h, style))
+        if entry is None:
+            entry = self.entries[(shape, w, h, style)] = self.measure(shape, w, h, style)
+        x0, y0, x1, y1, sprites = entry
+        if x0 <= x <= x1 and y0 <= y <= y1:
+            qx = x * 4
+            qy = y * 4
+            ix = int(qx)
+            iy = int(qy)
+            fx = qx - ix
+            fy = qy - iy
+            # 区切りのすぐそばは pyxel の中で float32 にしたときに丸めがずれることがあるので除く
+            if ((fx == 0 or SUB_PIXEL_EPS < fx < 1 - SUB_PIXEL_EPS) and
+                    (fy == 0 or SUB_PIXEL_EPS < fy < 1 - SUB_PIXEL_EPS)):
+                index = (ix & 3) << 2 | iy & 3
+                sprite = sprites[index] or self.render(entry, index, shape, x, y, w, h, style)
+                if sprite:
+                    u, v, sw, sh, ox, oy = sprite
+                    pyxel.blt((ix >> 2) + ox, (iy >> 2) + oy, self.bank, u, v, sw, sh, SPRITE_COLKEY)
+                    return
+        shape(pyxel, x, y, w, h, style)
+
+    def render(self, entry, index, shape, x, y, w, h, style):
+        self.misses += 1
+        bounds = Rasterizer()
+        shape(bounds, x, y, w, h, style)
+        sw = bounds.right - bounds.left + 1
+        sh = bounds.bottom - bounds.top + 1
+        image = pyxel.images[self.bank]
+        if sw > image.width or sh > image.height:
+            return None
+
+        # 棚詰め: 左から並べ、右端に着いたら次の段へ
+        if self.shelf_x + sw > image.width:
+            self.shelf_x = 0
+            self.shelf_y += self.shelf_h
+            self.shelf_h = 0
+        if self.shelf_y + sh > image.height:
+            self.invalidate()
+            self.evictions += 1
+        u, v = self.shelf_x, self.shelf_y
+        self.shelf_x += sw
+        self.shelf_h = max(self.shelf_h, sh)
+
+        image.rect(u, v, sw, sh, SPRITE_COLKEY)
+        shape(Rasterizer(image, u - bounds.left, v - bounds.top), x, y, w, h, style)
+        sprite = entry[4][index] = (u, v, sw, sh, bounds.left - math.floor(x), bounds.top - math.floor(y))
+        self.count += 1
+        return sprite
+
+    def stats(self):
+        return {'sprites': self.count, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class Pool:
+    # エンティティのオブジェクトプール
+    # 使い終わったオブジェクトをフリーリストに戻し、reset() で初期化し直して使い回す
+    def __init__(self, cls):
+        self.cls = cls
+        self.free = []
+        self.in_use = 0
+        self.created = 0 # 実際に生成したオブジェクトの数
+        self.high_water = 0 # 同時に使われた最大数
+
+    def acquire(self, *args):
+        if self.free:
+            obj = self.free.pop()
+            obj.reset(*args)
+        else:
+            obj = self.cls(*args)
+            self.created += 1
+        self.in_use += 1
+        if self.in_use > self.high_water:
+            self.high_water = self.in_use
+        return obj
+
+    def take(self):
+        # reset() を呼ばずに取り出す (中身は呼んだ側で書き込む)
+        if self.free:
+            obj = self.free.pop()
+        else:
+            obj = self.cls.__new__(self.cls)
+            self.created += 1
+        self.in_use += 1
+        if self.in_use > self.high_water:
+            self.high_water = self.in_use
+        return obj
+
+    def release(self, obj):
+        self.in_use -= 1
+        self.free.append(obj)
+
+    def release_all(self, entities):
+        self.in_use -= len(entities)
+        self.free.extend(entities)
+        entities.clear()
+
+    def stats(self):
+        return {'in_use': self.in_use, 'free': len(self.free), 'created': self.created, 'high_water': self.high_water}
+
+
+def compact(entities, alive, pool=None):
+    # 生きているものを前に詰めて (順番は保つ)、リストをその場で切り詰める
+    j = 0
+    for e in entities:
+        if alive(e):
+            entities[j] = e
+            j += 1
+        elif pool:
+            pool.release(e)
+    del entities[j:]
+
+
+def in_screen(e):
+    return e.y > -e.h and e.y < SCREEN_HEIGHT + e.h and e.x > -e.w and e.x < SCREEN_WIDTH + e.w
+
+
+def above_bottom(e):
+    return e.y < SCREEN_HEIGHT
+
+
+class Kind:
+    # World に登録したエンティティの種類ひとつ分
+    __slots__ = ('name', 'cls', 'entities', 'pool', 'alive', 'on_update', 'dead')
+
+    def __init__(self, name, cls, pool, alive, on_update):
+        self.name = name
+        self.cls = cls
+        self.entities = []
+        self.pool = pool
+        self.alive = alive # 残す条件 (寿命・画面外の判定)。None なら update では消さない
+        self.on_update = on_update # 各エンティティの update() の後に呼ぶ関数
+        self.dead = set() # destroy() されたインデックス (flush() で消す)
+
+
+class World:
+    # エンティティの種類 (kind) ごとにリストとプールを持ち、
+    # 移動と寿命・画面外の削除 (update)、描画 (draw)、削除 (destroy/flush) を共通の処理で行う
+    # 新しい種類は register() するだけで、ループを書き足さなくてよい
+    def __init__(self):
+        self.kinds = {}
+
+    def register(self, name, cls=None, alive=None, on_update=None):
+        # cls を渡すとプールから取り出して使い回す (cls は reset() を持つこと)
+        # 返すリストはそのまま App の属性 (self.bullets など) として使う
+        kind = Kind(name, cls, Pool(cls) if cls else None, alive, on_update)
+        self.kinds[name] = kind
+        return kind.entities
+
+    def spawn(self, name, *args):
+        kind = self.kinds[name]
+        entity = kind.pool.acquire(*args)
+        kind.entities.append(entity)
+        return entity
+
+    def update(self, name):
+        kind = self.kinds[name]
+        on_update = kind.on_update
+        for e in kind.entities:
+            e.update()
+            if on_update:
+                on_update(e)
+        if kind.alive:
+            compact(kind.entities, kind.alive, kind.pool)
+
+    def draw(self, name, *args):
+        for e in self.kinds[name].entities:
+            e.draw(*args)
+
+    def destroy(self, name, index):
+        # 消す印を付けるだけ (実際に消すのは flush()、それまではインデックスは変わらない)
+        self.kinds[name].dead.add(index)
+
+    def is_destroyed(self, name, index):
+        return index in self.kinds[name].dead
+
+    def flush(self):
+        # destroy() したものをまとめて消してプールに戻す (残りの順番は保つ)
+        for kind in self.kinds.values():
+            dead = kind.dead
+            if dead:
+                entities = kind.entities
+                j = 0
+                for k, e in enumerate(entities):
+                    if k in dead:
+                        if kind.pool:
+                            kind.pool.release(e)
+                    else:
+                        entities[j] = e
+                        j += 1
+                del entities[j:]
+                dead.clear()
+
+    def clear(self, name=None):
+        # name を省略するとすべての種類を空にする
+        for kind in (self.kinds[name],) if name else self.kinds.values():
+            if kind.pool:
+                kind.pool.release_all(kind.entities)
+            else:
+                kind.entities.clear()
+            kind.dead.clear()
+
+    def stats(self):
+        # プールごとの使用数・最大数 (容量の調整用)
+        return {name: kind.pool.stats() for name, kind in self.kinds.items() if kind.pool}
+
+    def get_state(self):
+        # 種類ごとに、各エンティティの __slots__ の値のタプルのリスト (snapshot 用)
+        # attrgetter は複数の名前を渡すと値のタプルを返す
+        return {name: list(map(attrgetter(*kind.cls.__slots__), kind.entities)) for name, kind in self.kinds.items()}
+
+    def set_state(self, state):
+        # get_state() の結果に戻す (オブジェクトはプールから取り出して値を書き込む)
+        self.clear()
+        for name, rows in state.items():
+            kind = self.kinds[name]
+            slots = kind.cls.__slots__
+            for row in rows:
+                e = kind.pool.take() if kind.pool else kind.cls.__new__(kind.cls)
+                for s, v in zip(slots, row):
+                    setattr(e, s, v)
+                kind.entities.append(e)
+
+
+def time_of_impact(a, avx, avy, b, bvx, bvy):
+    # a と b がこのフレームにそれぞれ (avx, avy)、(bvx, bvy) だけまっすぐ動いたとして、
+    # 移動の途中で最初に重なる時刻 t を返す (0 = 動く前、1 = 今の位置)。重ならなければ -1
+    # t = 1 での判定は is_colliding と同じなので、速い弾が小さい敵をすり抜けなくなる
+    # b を今の位置に止めて、a を相対速度で動かす (スラブ法)
+    rvx = avx - bvx
+    rvy = avy - bvy
+    x0 = a.x - rvx
+    y0 = a.y - rvy
+    if rvx:
+        t0 = (b.x - a.w - x0) / rvx
+        t1 = (b.x + b.w - x0) / rvx
+        if t0 > t1:
+            t0, t1 = t1, t0
+    elif x0 < b.x + b.w and x0 + a.w > b.x:
+        t0, t1 = -1.0, 2.0
+    else:
+        return -1
+    if rvy:
+        s0 = (b.y - a.h - y0) / rvy
+        s1 = (b.y + b.h - y0) / rvy
+        if s0 > s1:
+            s0, s1 = s1, s0
+        if s0 > t0:
+            t0 = s0
+        if s1 < t1:
+            t1 = s1
+    elif not (y0 < b.y + b.h and y0 + a.h > b.y):
+        return -1
+    if t0 < t1 and t0 < 1 and t1 > 0:
+        return t0 if t0 > 0 else 0.0
+    return -1
+
+
+class SpatialGrid:
+    # 256x256のプレイフィールドを一様グリッドに分割するブロードフェーズ
+    # 毎フレーム build() で作り直し、query() で同じセルにいる候補だけを返す
+    # 弾の連続的な当たり判定に使うので、どちらもこのフレームに動いた範囲 (動く前と今の矩形を両方含む矩形) で登録・検索する
+    def __init__(self, cell_size=32):
+        self.cell_size = cell_size
+        self.cols = (SCREEN_WIDTH + cell_size - 1) // cell_size
+        self.rows = (SCREEN_HEIGHT + cell_size - 1) // cell_size
+        self.cells = [[] for _ in range(self.cols * self.rows)]
+        self.used_cells = [] # 前回使ったセル (クリア用)
+
+    def cell_range(self, entity):
+        # entity がこのフレームに動いた範囲が掛かるセル。画面外にはみ出した分は端のセルに寄せる
+        # (毎フレーム敵の数だけ呼ぶので min/max を使わずに書く)
+        vx, vy = entity.motion()
+        x0 = x1 = entity.x
+        y0 = y1 = entity.y
+        if vx > 0:
+            x0 -= vx
+        else:
+            x1 -= vx
+        if vy > 0:
+            y0 -= vy
+        else:
+            y1 -= vy
+        cs = self.cell_size
+        last_col = self.cols - 1
+        last_row = self.rows - 1
+        c0 = int(x0 // cs)
+        c1 = int((x1 + entity.w) // cs)
+        r0 = int(y0 // cs)
+        r1 = int((y1 + entity.h) // cs)
+        c0 = 0 if c0 < 0 else last_col if c0 > last_col else c0
+        c1 = 0 if c1 < 0 else last_col if c1 > last_col else c1
+        r0 = 0 if r0 < 0 else last_row if r0 > last_row else r0
+        r1 = 0 if r1 < 0 else last_row if r1 > last_row else r1
+        return c0, c1, r0, r1
+
+    def build(self, entities):
+        cells = self.cells
+        for k in self.used_cells:
+            cells[k].clear()
+        self.used_cells.clear()
+
+        cols = self.cols
+        for index, entity in enumerate(entities):
+            c0, c1, r0, r1 = self.cell_range(entity)
+            for r in range(r0, r1 + 1):
+                for c in range(c0, c1 + 1):
+                    cell = cells[r * cols + c]
+                    if not cell:
+                        self.used_cells.append(r * cols + c)
+                    cell.append(index)
+
+    def query(self, entity):
+        # 候補のインデックスを降順で返す (元の逆順ループと同じ順番で判定するため)
+        c0, c1, r0, r1 = self.cell_range(entity)
+        cells = self.cells
+        if c0 == c1 and r0 == r1:
+            return cells[r0 * self.cols + c0][::-1]
+        found = set()
+        for r in range(r0, r1 + 1):
+            for c in range(c0, c1 + 1):
+                found.update(cells[r * self.cols + c])
+        return sorted(found, reverse=True)
+
+
+# 固定ステップのループ
+SIM_FPS = 60 # シミュレーションは常にこの間隔で進める
+MAX_CATCHUP_STEPS = 4 # 1回の pyxel のフレームで進めるステップ数の上限 (これ以上遅れた分は捨てる)
+MAX_SKIPPED_DRAWS = 2 # 続けて描画を飛ばすフレーム数の上限
+
+# 描画の品質 (負荷が高いときに段階的に下げる)
+QualityLevel = namedtuple('QualityLevel', ['bomb_rings', 'explosion_scale', 'stars'])
+QUALITY_LEVELS = (
+    QualityLevel(3, 1.0, True),  # 0: 通常
+    QualityLevel(2, 1.0, True),  # 1: ボムの波紋を減らす
+    QualityLevel(2, 0.5, True),  # 2: 爆発を短くする
+    QualityLevel(1, 0.5, False), # 3: 星を消す
+)
+DEGRADE_LOAD = 0.9 # 負荷 (1フレームの予算に対する処理時間の平均) がこれを超え続けたら品質を下げる
+RECOVER_LOAD = 0.6 # これを下回り続けたら品質を戻す
+DEGRADE_FRAMES = 30
+RECOVER_FRAMES = 120
+
+
+class FrameGovernor:
+    # pyxel.run の update/draw の代わりに呼ばれ、経過時間に合わせて App.update を 1/SIM_FPS 秒ずつ進める
+    # 遅れているときは描画を飛ばし (MAX_SKIPPED_DRAWS まで)、負荷に応じて app の描画品質を上げ下げする
+    def __init__(self, app, fps=SIM_FPS, clock=time.perf_counter):
+        self.app = app
+        self.step = 1 / fps
+        self.clock = clock
+        self.last = None
+        self.accumulator = 0.0
+        self.steps = 0 # 直前の update で進めたステップ数
+        self.work = 0.0 # 直前の update にかかった時間
+        self.skipped = 0 # 続けて飛ばした描画の数
+        self.load = 0.0
+        self.over = 0
+        self.under = 0
+        self.skipped_draws = 0
+        self.dropped_steps = 0
+
+    def update(self):
+        now = self.clock()
+        elapsed = now - self.last if self.last is not None else self.step
+        self.last = now
+        if abs(elapsed - self.step) < 0.002:
+            elapsed = self.step # 表示のタイミングの揺れでステップ数がばらつかないようにそろえる
+        self.accumulator += elapsed
+
+        self.steps = 0
+        while self.accumulator >= self.step and self.steps < MAX_CATCHUP_STEPS:
+            self.app.update()
+            self.accumulator -= self.step
+            self.steps += 1
+        if self.accumulator >= self.step:
+            # 追いつけない分は捨てる (ゲームが遅くなる方を選ぶ)
+            self.dropped_steps += int(self.accumulator / self.step)
+            self.accumulator %= self.step
+        self.work = self.clock() - now
+
+    def draw(self):
+        if self.steps > 1 and self.skipped < MAX_SKIPPED_DRAWS:
+            # 追いつくために複数ステップ進めたフレームは描かない (画面には前のフレームが残る)
+            self.skipped += 1
+            self.skipped_draws += 1
+            self.adjust(self.work)
+            return
+        self.skipped = 0
+        start = self.clock()
+        self.app.draw()
+        self.adjust(self.work + self.clock() - start)
+
+    def adjust(self, work):
+        self.load += (work / self.step - self.load) * 0.1
+        level = self.app.quality_level
+        if self.load > DEGRADE_LOAD:
+            self.over += 1
+            self.under = 0
+            if self.over >= DEGRADE_FRAMES and level < len(QUALITY_LEVELS) - 1:
+                self.app.set_quality(level + 1)
+                self.over = 0
+        elif self.load < RECOVER_LOAD:
+            self.under += 1
+            self.over = 0
+            if self.under >= RECOVER_FRAMES and level > 0:
+                self.app.set_quality(level - 1)
+                self.under = 0
+        else:
+            self.over = self.under = 0
+
+    def stats(self):
+        return {'quality': self.app.quality_level, 'load': self.load,
+                'skipped_draws': self.skipped_draws, 'dropped_steps': self.dropped_steps}
+
+
 class App:
     # Inner class for the hammer hitbox to fix the scope issue
     class HammerHitbox:
+        __slots__ = ('x', 'y', 'w', 'h')
+
         def __init__(self, x, y, w, h):
             self.x = x
             self.y = y
             self.w = w
             self.h = h
             
-    def __init__(self):
-        pyxel.init(SCREEN_WIDTH, SCREEN_HEIGHT)
-        pyxel.title("Pyxel Danmaku Game")
-
-        # ハイスコアファイルのパス
-        self.SAVE_DIR = Path(pyxel.user_data_dir("PyxelDanmakuGame", "HighScores"))
-        self.HIGH_SCORE_FILE = self.SAVE_DIR / "highscore.txt"
+    # update() と draw() の中身はこの順番で呼ぶ (名前は App のメソッド名から update_/draw_ を除いたもの)
+    UPDATE_PHASES = ('player', 'clouds', 'input', 'game_phase', 'bullets', 'items', 'heal_items',
+                     'enemies', 'boss', 'enemy_bullets', 'effects', 'collisions')
+    DRAW_PHASES = ('background', 'entities', 'effects', 'ui')
+
+    def __init__(self, headless=False, input_source=None, audio=None, save_dir=None, seed=None, profile=None, players=1, stage=None, gc_policy=None):
+        # headless=True ならウィンドウを開かずにゲームの状態だけを作る (step() で進める)
+        # 入力は input_source (ScriptedInput など)、音は audio (NullAudio など) を使う
+        # players=2 なら2人協力プレイ。input_source にはプレイヤーごとの入力のリストを渡す
+        # stage はステージの名前 (省略すると環境変数 TOUHOU_STAGE、それもなければ 'endless')
+        # gc_policy は場面に合わせた GC の制御 (gcpolicy.py、省略するとウィンドウ実行だけ有効)
+        # ゲーム中の乱数はすべて self.rng から取るので、seed と入力が同じなら同じ展開になる
+        self.headless = headless
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.rng = random.Random(self.seed)
+        if not headless:
+            pyxel.init(SCREEN_WIDTH, SCREEN_HEIGHT, fps=SIM_FPS)
+            pyxel.title("Pyxel Danmaku Game")
+        if isinstance(input_source, (list, tuple)):
+            self.inputs = list(input_source)
+        else:
+            self.inputs = [input_source or (ScriptedInput() if headless else PyxelInput())]
+        self.inputs += [ScriptedInput() for _ in range(players - len(self.inputs))]
+        self.input = self.inputs[0] # 1P の入力
+        self.player_count = players
+        self.stage = load_stage(stage or os.environ.get('TOUHOU_STAGE') or 'endless')
+        self.enemy_types = self.stage.enemy_types # Enemy.type はこのテーブルのインデックス
+        self.audio = audio or (NullAudio() if headless else PyxelAudio())
+        self.frame_count = 0 # update() を呼んだ回数
+        self.set_quality(0)
+
+        self.update_phases = [self.check_collisions if name == 'collisions' else getattr(self, 'update_' + name) for name in self.UPDATE_PHASES]
+        self.draw_phases = [getattr(self, 'draw_' + name) for name in self.DRAW_PHASES]
+        # フェーズごとの計測 (profile=True か環境変数 TOUHOU_PROFILE=1 で有効)
+        self.profiler = None
+        if profile or (profile is None and os.environ.get('TOUHOU_PROFILE')):
+            from profiler import FrameProfiler
+            self.profiler = FrameProfiler(self)
+
+        # ハイスコアの保存先 (ヘッドレスでは save_dir を渡したときだけ保存する)
+        # 起動時に1回だけ読み込み、書き込みは ScoreStore のスレッドが行う
+        if save_dir is None and not headless:
+            save_dir = pyxel.user_data_dir("PyxelDanmakuGame", "HighScores")
+        self.SAVE_DIR = Path(save_dir) if save_dir is not None else None
+        self.scores = ScoreStore(self.SAVE_DIR)
+
+        self.grid = SpatialGrid() # 当たり判定のブロードフェーズ
+        self.background = BackgroundCache()
+        self.sprites = SpriteCache()
+        self.create_world()
+        # 効果音・BGM・背景は起動時に1回だけ用意する (リスタートではゲームの状態だけを戻す)
+        if not headless:
+            self.build_assets()
+
+        # GC の制御は gc の設定がプロセス全体で共有なので、ヘッドレスでは明示したときだけ使う
+        self.gc_policy = None
+        if gc_policy is None:
+            gc_policy = os.environ.get('TOUHOU_GC', '0' if headless else '1') != '0'
+        if gc_policy:
+            from gcpolicy import GcPolicy
+            self.gc_policy = GcPolicy(self)
 
         self.reset_game()
-        pyxel.run(self.update, self.draw)
-
-    def load_high_score(self):
-        if not self.HIGH_SCORE_FILE.exists():
-            return 0
-        try:
-            with open(self.HIGH_SCORE_FILE, "r") as f:
-                return int(f.read())
-        except (ValueError, IOError):
-            return 0
-
-    def save_high_score(self, score):
-        self.SAVE_DIR.mkdir(parents=True, exist_ok=True)
-        with open(self.HIGH_SCORE_FILE, "w") as f:
-            f.write(str(score))
+        # ウィンドウ実行では FrameGovernor が固定ステップで update を呼ぶ (ヘッドレスでは step() で進めるので使わない)
+        self.governor = None
+        if not headless:
+            self.governor = FrameGovernor(self)
+            pyxel.run(self.governor.update, self.governor.draw)
+
+    def build_assets(self):
+        # ヘッドレスでは呼ばない (背景は描画するときに必要な分だけ作る)
+        self.audio.define_sounds()
+        for kind in BACKGROUND_BANKS:
+            self.background.render(kind)
+
+    def set_quality(self, level):
+        # 描画の品質 (QUALITY_LEVELS のインデックス、0 が最高)
+        self.quality_level = level
+        self.quality = QUALITY_LEVELS[level]
+
+    def step(self, n=1):
+        # ヘッドレスで n フレーム進める
+        for _ in range(n):
+            self.update()
+
+    def create_world(self):
+        # エンティティのリストとプールはゲームをまたいで使い回す
+        # 種類ごとに (クラス, 残す条件, update() の後に呼ぶ関数) を登録し、リストは App の属性としても持つ
+        world = self.world = World()
+        self.bullets = world.register('bullets', Bullet, in_screen)
+        self.enemies = world.register('enemies', Enemy, above_bottom, self.fire_enemy_bullet)
+        self.clouds = world.register('clouds', Cloud, above_bottom, self.drop_item)
+        self.items = world.register('items', Item, above_bottom)
+        self.heal_items = world.register('heal_items', HealItem, above_bottom)
+        self.explosions = world.register('explosions', Explosion, lambda e: e.timer > 0)
+        self.bomb_effects = world.register('bomb_effects', BombEffect, lambda e: e.is_alive) # ボムエフェクトのリスト
+        self.enemy_bullets = EnemyBulletStore() # 敵の弾は数が多いので配列でまとめて持つ
+        self.hammer_hitboxes = [self.HammerHitbox(0, 0, 0, 0) for _ in range(self.player_count)]
+
+    def pool_stats(self):
+        # プールごとの使用数・最大数 (容量の調整用)
+        stats = self.world.stats()
+        stats['enemy_bullets'] = self.enemy_bullets.stats()
+        return stats
+
+    def record_score(self):
+        # 上位 TOP_N に入るスコアなら表に入れる (ファイルへの書き込みはバックグラウンド)
+        self.scores.submit(self.score, self.seed, self.game_phase)
+        self.high_score = self.scores.best()
 
     def reset_game(self):
-        self.player = Player()
-        self.bullets = []
-        self.enemies = []
-        self.enemy_bullets = []
-        self.clouds = []
-        self.items = []
-        self.heal_items = []
+        self.players = [Player(i, self.player_count) for i in range(self.player_count)]
+        self.player = self.players[0] # 1P
+        # 前のゲームのエンティティはプールに戻す
+        self.world.clear()
+        self.enemy_bullets.clear()
         self.boss = None
-        self.explosions = [] # 爆発エフェクトのリスト
-        self.bomb_effects = [] # ボムエフェクトのリスト
-
-        # サウンド定義
-        pyxel.sound(0).set(notes="c1", tones="n", volumes="2", effects="q", speed=5) # Shot
-        pyxel.sound(1).set(notes="c1", tones="n", volumes="7", effects="f", speed=15) # Hit/Explosion
-        pyxel.sound(2).set(notes="c1", tones="n", volumes="7", effects="f", speed=30) # Player Hit
-
-        # BGMの定義
-        # メロディ (ch0)
-        pyxel.sound(10).set("c3e3g3c4 g3e3c3r", "t", "7", "n", 10)
-        # ベース (ch1)
-        pyxel.sound(11).set("c2g1c2g1 c2g1c2g1", "s", "5", "n", 10)
-        # アルペジオ (ch2)
-        pyxel.sound(12).set("c2e2g2c3e3g3c4e4", "t", "3", "f", 15)
-        pyxel.music(0).set([10], [11], [12], [])
-
-        # BGMの定義 (ボスステージ - 派手なBGM)
-        # メロディ (ch0)
-        pyxel.sound(13).set("c3g3e3c4g3e3c3r", "t", "7", "n", 8) # Faster, higher pitch
-        # ベース (ch1)
-        pyxel.sound(14).set("c3g2c3g2 c3g2c3g2", "s", "5", "n", 8) # Faster, higher pitch
-        # ドラム (ch2)
-        pyxel.sound(15).set("rrrrrrc1rrrrrr", "n", "5", "f", 4) # Percussive
-        pyxel.music(1).set([13], [14], [15], [])
 
         # BGMの再生
-        pyxel.playm(0, loop=True)
+        self.audio.playm(0, loop=True)
 
         self.score = 0
-        self.high_score = self.load_high_score() # ハイスコアを読み込む
+        self.high_score = self.scores.best() # ハイスコア (メモリ上の表から)
         self.game_phase = 'playing' # playing, gameover, clear
         self.boss_intro_timer = 0 # ボス導入タイマーを初期化
+        self.death_cause = None # ゲームオーバーの原因 ('enemy', 'bullet', 'boss_bullet')
 
         self.enemy_spawn_timer = 0
         self.cloud_spawn_timer = 0
+        self.stage_frame = 0 # ステージが始まってからのフレーム数 (ボスの間は進まない)
+        self.stage_cursor = 0 # 次に起きるステージのイベント
 
         # 初期雲を10個生成
         for _ in range(10):
             w = scale_val(120)
             h = scale_val(60)
-            x = random.random() * (SCREEN_WIDTH - w)
-            y = random.uniform(-h * 2, -h) # 画面上部の異なる高さから出現
+            x = self.rng.random() * (SCREEN_WIDTH - w)
+            y = self.rng.uniform(-h * 2, -h) # 画面上部の異なる高さから出現
             speed = scale_val(7) # 落下速度を速くする
-            self.clouds.append(Cloud(x, y, w, h, speed))
+            self.world.spawn('clouds', x, y, w, h, speed)
+
+        if self.gc_policy:
+            self.gc_policy.on_reset()
 
     def update(self):
+        self.frame_count += 1
+        for input in self.inputs:
+            input.begin_frame()
+        if self.profiler:
+            self.profiler.begin_frame(self)
+        if self.gc_policy:
+            self.gc_policy.update()
+
         if self.game_phase == 'gameover' or self.game_phase == 'clear':
-            if pyxel.btnp(pyxel.KEY_R): # Rキーでリスタート
+            if any(input.btnp(pyxel.KEY_R) for input in self.inputs): # Rキーでリスタート (誰が押してもよい)
                 self.reset_game() # ゲームをリセット
             return
 
-        self.player.update() # Player update always runs
+        for phase in self.update_phases:
+            phase()
 
+    def update_player(self):
+        for player, input in zip(self.players, self.inputs):
+            if player.life > 0: # 2人プレイでやられたプレイヤーは動かない
+                player.update(input)
+
+    def target_player(self):
+        # 敵が狙うプレイヤー (生きている中で番号の小さい方)
+        for player in self.players:
+            if player.life > 0:
+                return player
+        return self.player
+
+    def update_clouds(self):
         # 雲の更新 (常に実行)
-        for cloud in self.clouds:
-            cloud.update()
-            if not cloud.dropped_item and abs(cloud.x + cloud.w / 2 - SCREEN_WIDTH / 2) < scale_val(20):
-                cloud.dropped_item = True
-                self.create_item(cloud)
-        self.clouds = [c for c in self.clouds if c.y < SCREEN_HEIGHT]
+        self.world.update('clouds')
 
+    def drop_item(self, cloud):
+        # 雲が画面の中央を通ったらアイテムを落とす
+        if not cloud.dropped_item and abs(cloud.x + cloud.w / 2 - SCREEN_WIDTH / 2) < scale_val(20):
+            cloud.dropped_item = True
+            self.create_item(cloud)
+
+    def update_input(self):
+        for player, input in zip(self.players, self.inputs):
+            if player.life > 0:
+                self.update_player_input(player, input)
+
+    def update_player_input(self, player, input):
         # Player input handling (shooting, hammer, special attack)
-        if self.player.shot_timer > 0:
-            self.player.shot_timer -= 1
+        if player.shot_timer > 0:
+            player.shot_timer -= 1
 
-        if pyxel.btn(pyxel.KEY_SPACE) and self.player.shot_timer <= 0:
-            self.create_bullet()
-            pyxel.play(0, 0) # ショット音
-            self.player.shot_timer = self.player.shot_cooldown
+        if input.btn(pyxel.KEY_SPACE) and player.shot_timer <= 0:
+            self.create_bullet(player)
+            self.audio.play(0, 0) # ショット音
+            player.shot_timer = player.shot_cooldown
 
         # ハンマー攻撃 (Zキー)
-        if pyxel.btnp(pyxel.KEY_Z):
-            if self.player.hammer_timer <= 0:
-                self.player.is_hammering = True
-                self.player.hammer_timer = self.player.hammer_cooldown
+        if input.btnp(pyxel.KEY_Z):
+            if player.hammer_timer <= 0:
+                player.is_hammering = True
+                player.hammer_timer = player.hammer_cooldown
 
         # 特殊攻撃
-        if pyxel.btnp(pyxel.KEY_X) and self.player.special_attack_stock > 0:
-            self.player.special_attack_stock -= 1
+        if input.btnp(pyxel.KEY_X) and player.special_attack_stock > 0:
+            player.special_attack_stock -= 1
             self.enemy_bullets.clear() # 敵の弾を消去
             for enemy in self.enemies:
                 enemy.health -= 10 # 敵にダメージ
             if self.boss:
                 self.boss.health -= 50 # ボスにダメージ
             # ボムエフェクトを生成
-            self.bomb_effects.append(BombEffect(self.player.x + self.player.w / 2, self.player.y + self.player.h / 2))
+            self.world.spawn('bomb_effects', player.x + player.w / 2, player.y + player.h / 2)
 
+    def update_game_phase(self):
         # ゲームフェーズの移行
-        if self.score >= 100000 and self.boss is None: # スコア閾値を100000に調整し、ボスがまだ出現していない場合
-            self.game_phase = 'boss_intro' # ボス導入フェーズに移行
-            self.enemies.clear() # 残っている敵をクリア
-            self.boss_intro_timer = 0
-            # ボス登場前の雲を10個生成
-            for _ in range(10):
-                w = scale_val(120)
-                h = scale_val(60)
-                x = random.random() * (SCREEN_WIDTH - w)
-                y = random.uniform(-h * 2, -h) # 画面上部の異なる高さから出現
-                speed = random.uniform(scale_val(2), scale_val(5))
-                self.clouds.append(Cloud(x, y, w, h, speed))
-            pyxel.playm(-1) # 現在のBGMを停止
+        boss_score = self.stage.boss_score
+        if boss_score is not None and self.score >= boss_score and self.boss is None and self.game_phase == 'playing': # ボスがまだ出現していない場合
+            self.start_boss_intro()
 
         if self.game_phase == 'boss_intro': # ボス導入フェーズ中
             self.boss_intro_timer += 1
             if self.boss_intro_timer >= 420: # 7秒経過 (60フレーム/秒 * 7秒)
                 self.game_phase = 'boss'
-                self.boss = Boss()
-                pyxel.playm(1, loop=True) # ボスBGMを再生
+                self.boss = Boss(self.stage.boss_program)
+                self.audio.playm(1, loop=True) # ボスBGMを再生
+
+    def start_boss_intro(self):
+        # スコアかステージのイベントでボス導入フェーズに移行
+        self.game_phase = 'boss_intro'
+        self.world.clear('enemies') # 残っている敵をクリア
+        self.boss_intro_timer = 0
+        # ボス登場前の雲を10個生成
+        for _ in range(10):
+            w = scale_val(120)
+            h = scale_val(60)
+            x = self.rng.random() * (SCREEN_WIDTH - w)
+            y = self.rng.uniform(-h * 2, -h) # 画面上部の異なる高さから出現
+            speed = self.rng.uniform(scale_val(2), scale_val(5))
+            self.world.spawn('clouds', x, y, w, h, speed)
+        self.audio.playm(-1) # 現在のBGMを停止
 
+    def update_bullets(self):
         # 弾の更新
-        for bullet in self.bullets:
-            bullet.update()
-        self.bullets = [b for b in self.bullets if b.y > -b.h and b.y < SCREEN_HEIGHT + b.h and b.x > -b.w and b.x < SCREEN_WIDTH + b.w]
+        self.world.update('bullets')
 
+    def update_items(self):
         # アイテムの更新
-        for item in self.items:
-            item.update()
-        self.items = [i for i in self.items if i.y < SCREEN_HEIGHT]
+        self.world.update('items')
 
+    def update_heal_items(self):
         # 回復アイテムの更新
-        for item in self.heal_items:
-            item.update()
-        self.heal_items = [i for i in self.heal_items if i.y < SCREEN_HEIGHT]
+        self.world.update('heal_items')
 
-        # 敵の出現 (ランダム)
+    def update_enemies(self):
+        # 敵・雲の出現 (ステージ)
         if self.boss is None and self.game_phase != 'boss_intro': # ボスが出現していない、かつボス導入フェーズ中でない場合のみ敵を出現させる
-            self.enemy_spawn_timer += 1
-            if self.enemy_spawn_timer >= 3: # 0.05秒に1回敵を出現させる (10倍)
-                self.spawn_enemy()
-                self.enemy_spawn_timer = 0
-
-            # 雲の出現
-            self.cloud_spawn_timer += 1
-            if self.cloud_spawn_timer >= 240: # 4秒に1回 (240フレーム)
-                self.spawn_cloud() # アイテムドロップ用の雲
-                self.cloud_spawn_timer = 0
-
-            # 敵の更新
-            for enemy in self.enemies:
-                enemy.update()
-                # シューター敵の弾発射
-                if enemy.type == 'shooter' and random.random() < 0.01: # 確率を調整
-                    self.create_enemy_bullet(enemy, math.pi / 2) # 真下
-            self.enemies = [e for e in self.enemies if e.y < SCREEN_HEIGHT]
-
-        elif self.game_phase == 'boss':
-            if self.boss:
-                self.boss.update()
-                # ボスの弾幕パターン
-                if self.boss.attack_pattern == 'barrage' and self.boss.attack_timer % 5 == 0: # 頻度をさらに上げる
-                    for i in range(16): # 弾の数を増やす
-                        angle = (math.pi * 2 / 16) * i + (self.boss.attack_timer / 20) # 弾の角度を調整
-                        self.create_enemy_bullet(self.boss, angle)
-                if self.boss.health <= 0:
-                    self.game_clear()
-
-        # 敵の弾の更新
-        for bullet in self.enemy_bullets:
-            bullet.update()
-        self.enemy_bullets = [b for b in self.enemy_bullets if b.y > -b.h and b.y < SCREEN_HEIGHT + b.h and b.x > -b.w and b.x < SCREEN_WIDTH + b.w]
-
-        # 爆発エフェクトの更新
-        for explosion in self.explosions:
-            explosion.update()
-        self.explosions = [e for e in self.explosions if e.timer > 0]
-
-        # ボムエフェクトの更新
-        for effect in self.bomb_effects:
-            effect.update()
-        self.bomb_effects = [e for e in self.bomb_effects if e.is_alive]
-
-        self.check_collisions()
+            self.stage.update(self)
+
+            # 敵の更新 (弾の発射は fire_enemy_bullet)
+            self.world.update('enemies')
+
+    def fire_enemy_bullet(self, enemy):
+        # シューター敵の弾発射
+        fire_chance = self.enemy_types[enemy.type].fire_chance
+        if fire_chance and self.rng.random() < fire_chance: # シューターのみ
+            self.create_enemy_bullet(enemy, math.pi / 2) # 真下
+
+    def update_boss(self):
+        # ボスがいるときは update_enemies の代わりにこちらが動く
+        if self.game_phase == 'boss' and self.boss:
+            self.boss.update()
+            # ボスの弾幕パターン (BOSS_PROGRAM)
+            if self.boss.attack_pattern == 'barrage':
+                self.boss.fire(self.enemy_bullets, self.target_player())
+            if self.boss.health <= 0:
+                self.game_clear()
+
+    def update_enemy_bullets(self):
+        # 敵の弾の更新 (移動と画面外の削除)
+        self.enemy_bullets.update()
+
+    def update_effects(self):
+        # 爆発エフェクトとボムエフェクトの更新
+        self.world.update('explosions')
+        self.world.update('bomb_effects')
 
     def draw(self):
+        for phase in self.draw_phases:
+            phase()
+        if self.profiler and self.profiler.overlay:
+            self.profiler.draw_overlay()
+
+    def draw_background(self):
         # Background drawing based on score
         if self.score < 1000:
-            # Sea background
-            for y in range(SCREEN_HEIGHT):
-                if y < SCREEN_HEIGHT * 0.2: # Top 20% (lighter blue)
-                    pyxel.rect(0, y, SCREEN_WIDTH, 1, 12) # Light blue
-                elif y < SCREEN_HEIGHT * 0.5: # Middle 30% (medium blue)
-                    pyxel.rect(0, y, SCREEN_WIDTH, 1, 1) # Dark blue
-                else: # Bottom 50% (darker blue) 
-                    pyxel.rect(0, y, SCREEN_WIDTH, 1, 1) # Dark blue
+            kind = 'sea'
         elif self.score < 2000:
-            # Sky background with clouds
-            pyxel.cls(12) # Light blue for sky
-            for cloud in self.clouds:
-                cloud.draw()
+            kind = 'sky'
         else:
-            # Space background with Earth
-            pyxel.cls(0) # Black for space
-            # Draw stars (simple random pixels)
-            for _ in range(100):
-                star_x = random.randint(0, SCREEN_WIDTH - 1)
-                star_y = random.randint(0, SCREEN_HEIGHT - 1)
-                pyxel.pset(star_x, star_y, 7) # White stars
-            
-            # Draw Earth (simple circle with blue and green)
-            earth_radius = scale_val(50)
-            earth_x = SCREEN_WIDTH / 2
-            earth_y = SCREEN_HEIGHT / 4 * 3 # Near bottom
-            pyxel.circ(earth_x, earth_y, earth_radius, 1) # Blue ocean
-            pyxel.circ(earth_x + earth_radius / 3, earth_y - earth_radius / 3, earth_radius / 2, 3) # Green land
-            pyxel.circ(earth_x - earth_radius / 2, earth_y + earth_radius / 4, earth_radius / 4, 3) # Green land
-
-        self.player.draw()
-
-        for bullet in self.bullets:
-            bullet.draw()
-
-        for enemy in self.enemies:
-            enemy.draw()
+            kind = 'space'
+        self.background.draw(kind, self.frame_count, stars=self.quality.stars)
 
-        for bullet in self.enemy_bullets:
-            bullet.draw()
+    def draw_entities(self):
+        for player in self.players:
+            if player.life > 0:
+                player.draw(self.sprites)
 
-        for cloud in self.clouds:
-            cloud.draw()
-
-        for item in self.items:
-            item.draw()
-
-        for item in self.heal_items:
-            item.draw()
+        self.world.draw('bullets')
+        self.world.draw('enemies', self.sprites)
+        self.enemy_bullets.draw()
+        self.world.draw('clouds')
+        self.world.draw('items')
+        self.world.draw('heal_items')
 
         if self.boss:
             self.boss.draw()
 
-        # 爆発エフェクトの描画
-        for explosion in self.explosions:
-            explosion.draw()
-
-        # ボムエフェクトの描画
-        for effect in self.bomb_effects:
-            effect.draw()
-
-        self.draw_ui()
+    def draw_effects(self):
+        # 爆発エフェクトとボムエフェクトの描画
+        self.world.draw('explosions')
+        self.world.draw('bomb_effects', self.quality.bomb_rings)
 
-        if self.game_phase == 'gameover':
-            pyxel.rect(0, SCREEN_HEIGHT / 2 - 20, SCREEN_WIDTH, 40, 0) # 黒い帯
-            pyxel.text(SCREEN_WIDTH / 2 - len("GAME OVER") * 4 / 2, SCREEN_HEIGHT / 2 - 10, "GAME OVER", 7)
-            pyxel.text(SCREEN_WIDTH / 2 - len("PRESS R TO RESTART") * 4 / 2, SCREEN_HEIGHT / 2 + 5, "PRESS R TO RESTART", 7)
-        elif self.game_phase == 'clear':
-            pyxel.rect(0, SCREEN_HEIGHT / 2 - 20, SCREEN_WIDTH, 40, 0) # 黒い帯
-            pyxel.text(SCREEN_WIDTH / 2 - pyxel.width("GAME CLEAR") / 2, SCREEN_HEIGHT / 2 - 10, "GAME CLEAR", 10)
-            pyxel.text(SCREEN_WIDTH / 2 - pyxel.width("PRESS R TO RESTART") / 2, SCREEN_HEIGHT / 2 + 5, "PRESS R TO RESTART", 7)
-
-    def create_bullet(self):
+    def create_bullet(self, player):
         bullet_props = {
-            'y': self.player.y,
-            'w': self.player.bullet_size,
-            'h': self.player.bullet_size * 2,
-            'power': self.player.bullet_power,
+            'y': player.y,
+            'w': player.bullet_size,
+            'h': player.bullet_size * 2,
+            'power': player.bullet_power,
             'color': 10 # Yellow
         }
 
-        if self.player.shot_type == '3way':
+        if player.shot_type == '3way':
             # 5-way shot
             for i in range(-2, 3):
                 angle_offset = i * (math.pi / 12) # 角度を調整
-                self.bullets.append(Bullet(self.player.x + self.player.w / 2 - bullet_props['w'] / 2, bullet_props['y'], math.tan(angle_offset), bullet_props['power'], bullet_props['w'], bullet_props['color']))
+                self.world.spawn('bullets', player.x + player.w / 2 - bullet_props['w'] / 2, bullet_props['y'], math.tan(angle_offset), bullet_props['power'], bullet_props['w'], bullet_props['color'])
         else:
-            self.bullets.append(Bullet(self.player.x + self.player.w / 2 - bullet_props['w'] / 2, bullet_props['y'], 0, bullet_props['power'], bullet_props['w'], bullet_props['color']))
+            self.world.spawn('bullets', player.x + player.w / 2 - bullet_props['w'] / 2, bullet_props['y'], 0, bullet_props['power'], bullet_props['w'], bullet_props['color'])
 
     def spawn_enemy(self):
-        type_roll = random.random()
-        if type_roll < 0.6:
-            enemy_type = 'shooter'
-        elif type_roll < 0.85:
-            enemy_type = 'swarmer'
-        else:
-            enemy_type = 'armored'
-        
-        size = scale_val(40)
-        if enemy_type == 'shooter':
-            color = 8 # Red
-            health = 2
-        elif enemy_type == 'swarmer':
-            size = scale_val(20)
-            color = 9 # Orange
-            health = 1
-        else: # armored
-            size = scale_val(50)
-            color = 13 # Grey
-            health = 5
-        
-        x = random.random() * (SCREEN_WIDTH - size)
+        # endless ステージのランダムな出現
+        enemy_type = bisect_right(ENEMY_SPAWN_ROLLS, self.rng.random())
+        spec = ENEMY_TYPES[enemy_type]
+        size = spec.size
+        x = self.rng.random() * (SCREEN_WIDTH - size)
         y = -size
-        speed = scale_val(2) if enemy_type != 'swarmer' else scale_val(4)
-        self.enemies.append(Enemy(enemy_type, x, y, size, size, speed, color, health))
+        dx = (self.rng.random() - 0.5) * scale_val(5) # 横方向の速度を上げる
+        self.world.spawn('enemies', enemy_type, x, y, size, size, spec.speed, spec.color, spec.health, dx)
 
     def create_enemy_bullet(self, source, angle):
         bullet_w = scale_val(10)
@@ -659,184 +1791,241 @@ class App:
         bullet_speed = scale_val(4)
         dx = math.cos(angle) * bullet_speed
         dy = math.sin(angle) * bullet_speed
-        self.enemy_bullets.append(EnemyBullet(source.x + source.w / 2 - bullet_w / 2, source.y + source.h / 2, dx, dy, bullet_w, bullet_h, bullet_speed, 6)) # Pink
+        self.enemy_bullets.spawn(source.x + source.w / 2 - bullet_w / 2, source.y + source.h / 2, dx, dy, bullet_w, bullet_h, 6) # Pink
 
     def spawn_cloud(self):
-        w = random.randint(scale_val(50), scale_val(150))
-        h = random.randint(scale_val(20), scale_val(70))
-        x = random.random() * (SCREEN_WIDTH - w)
-        y = random.uniform(-h * 2, -h) # 画面上部の異なる高さから出現
+        w = self.rng.randint(scale_val(50), scale_val(150))
+        h = self.rng.randint(scale_val(20), scale_val(70))
+        x = self.rng.random() * (SCREEN_WIDTH - w)
+        y = self.rng.uniform(-h * 2, -h) # 画面上部の異なる高さから出現
         speed = scale_val(7) # 落下速度を速くする
-        self.clouds.append(Cloud(x, y, w, h, speed))
+        self.world.spawn('clouds', x, y, w, h, speed)
+
+    def spawn_explosion(self, x, y, size, color, duration):
+        # 描画の品質を下げているときは爆発を短くする
+        duration = max(1, int(duration * self.quality.explosion_scale))
+        self.world.spawn('explosions', x, y, size, color, duration)
 
     def create_item(self, cloud):
         item_w = scale_val(20)
         item_h = scale_val(20)
         item_speed = scale_val(5) # アイテムの落下速度を速くする
-        self.items.append(Item(cloud.x + cloud.w / 2 - item_w / 2, cloud.y + cloud.h, item_w, item_h, item_speed, 0)) # Start with score item
+        self.world.spawn('items', cloud.x + cloud.w / 2 - item_w / 2, cloud.y + cloud.h, item_w, item_h, item_speed, 0) # Start with score item
 
     def create_heal_item(self, enemy):
         item_w = scale_val(20)
         item_h = scale_val(20)
         item_speed = scale_val(2)
-        self.heal_items.append(HealItem(enemy.x + enemy.w / 2 - item_w / 2, enemy.y + enemy.h / 2 - item_h / 2, item_w, item_h, item_speed, 3)) # Lime green
+        self.world.spawn('heal_items', enemy.x + enemy.w / 2 - item_w / 2, enemy.y + enemy.h / 2 - item_h / 2, item_w, item_h, item_speed, 3) # Lime green
 
     def check_collisions(self):
-        # Define hammer hitbox once if active, to be used for enemies and boss
-        hammer_hitbox = None
-        if self.player.is_hammering:
-            hammer_w = scale_val(70)
-            hammer_h = scale_val(70)
-            hammer_hitbox = self.HammerHitbox(
-                self.player.x + self.player.w / 2 - hammer_w / 2,
-                self.player.y - hammer_h / 2,
-                hammer_w,
-                hammer_h
-            )
+        # Define hammer hitboxes once if active, to be used for enemies and boss
+        hammers = []
+        for player, hammer_hitbox in zip(self.players, self.hammer_hitboxes): # 毎フレーム作らずに使い回す
+            if player.is_hammering and player.life > 0:
+                hammer_w = scale_val(70)
+                hammer_h = scale_val(70)
+                hammer_hitbox.x = player.x + player.w / 2 - hammer_w / 2
+                hammer_hitbox.y = player.y - hammer_h / 2
+                hammer_hitbox.w = hammer_w
+                hammer_hitbox.h = hammer_h
+                hammers.append(hammer_hitbox)
 
         # プレイヤーの弾 vs 敵
+        # 弾は速いので、このフレームの移動の途中で当たるものも含めて (time_of_impact) 一番先に当たる相手を選ぶ
+        # 弾ごとに同じセルの敵だけを調べる。各パスで消すものは world.destroy で印を付けてパスの最後に flush する
+        world = self.world
+        grid = self.grid
+        grid.build(self.enemies)
         for i in range(len(self.bullets) - 1, -1, -1):
-            for j in range(len(self.enemies) - 1, -1, -1):
-                bullet = self.bullets[i]
-                enemy = self.enemies[j]
-                if self.is_colliding(bullet, enemy):
-                    if enemy.type == 'armored':
-                        self.bullets.pop(i)
-                        break # 次の弾へ
-                    enemy.health -= bullet.power
-                    self.bullets.pop(i)
-                    if enemy.health <= 0:
-                        self.enemies.pop(j)
-                        self.score += 100
-                        self.explosions.append(Explosion(enemy.x + enemy.w / 2, enemy.y + enemy.h / 2, scale_val(30), 7, 10)) # 白い爆発
-                        pyxel.play(1, 1) # 爆発音
-                        if random.random() < 0.1:
-                            self.create_heal_item(enemy)
-                    break # 弾が当たったら次の弾へ
+            j = self.first_hit(self.bullets[i], self.enemies, 'enemies')
+            if j < 0:
+                continue
+            bullet = self.bullets[i]
+            enemy = self.enemies[j]
+            world.destroy('bullets', i)
+            if self.enemy_types[enemy.type].bullet_proof: # armored
+                continue # 次の弾へ
+            enemy.health -= bullet.power
+            if enemy.health <= 0:
+                world.destroy('enemies', j)
+                self.score += 100
+                self.spawn_explosion(enemy.x + enemy.w / 2, enemy.y + enemy.h / 2, scale_val(30), 7, 10) # 白い爆発
+                self.audio.play(1, 1) # 爆発音
+                if self.rng.random() < 0.1:
+                    self.create_heal_item(enemy)
+        world.flush()
 
         # プレイヤーの弾 vs 雲
+        grid.build(self.clouds)
         for i in range(len(self.bullets) - 1, -1, -1):
-            for j in range(len(self.clouds) - 1, -1, -1):
-                bullet = self.bullets[i]
-                cloud = self.clouds[j]
-                if self.is_colliding(bullet, cloud):
-                    self.bullets.pop(i)
-                    if not cloud.dropped_item: # 既にドロップ済みでなければ
-                        cloud.dropped_item = True
-                        self.create_item(cloud)
-                    break # 弾が当たったら次の弾へ
+            j = self.first_hit(self.bullets[i], self.clouds, 'clouds')
+            if j < 0:
+                continue
+            cloud = self.clouds[j]
+            world.destroy('bullets', i)
+            if not cloud.dropped_item: # 既にドロップ済みでなければ
+                cloud.dropped_item = True
+                self.create_item(cloud)
+        world.flush()
 
         # ハンマー vs 敵
-        if hammer_hitbox:
+        for hammer_hitbox in hammers:
             for j in range(len(self.enemies) - 1, -1, -1):
                 enemy = self.enemies[j]
                 if self.is_colliding(hammer_hitbox, enemy):
                     enemy.health -= scale_val(5) # ハンマーダメージ
                     if enemy.health <= 0:
-                        self.enemies.pop(j)
+                        world.destroy('enemies', j)
                         self.score += 150
-                        self.explosions.append(Explosion(enemy.x + enemy.w / 2, enemy.y + enemy.h / 2, scale_val(40), 7, 15)) # 白い爆発
-                        pyxel.play(1, 1) # 爆発音
-                        if random.random() < 0.1:
+                        self.spawn_explosion(enemy.x + enemy.w / 2, enemy.y + enemy.h / 2, scale_val(40), 7, 15) # 白い爆発
+                        self.audio.play(1, 1) # 爆発音
+                        if self.rng.random() < 0.1:
                             self.create_heal_item(enemy)
+            world.flush()
 
         # プレイヤーの弾 vs アイテム (アイテムの種類変更)
+        # create_item で増えたアイテムも対象にするため、雲のパスの後で作る
+        grid.build(self.items)
         for i in range(len(self.bullets) - 1, -1, -1):
-            for j in range(len(self.items) - 1, -1, -1):
-                bullet = self.bullets[i]
-                item = self.items[j]
-                if self.is_colliding(bullet, item):
-                    self.bullets.pop(i)
-                    item.type_index = (item.type_index + 1) % len(item.item_types)
-                    item.is_bouncing = True
-                    item.initial_bounce_y = item.y
-                    break
-
-        # プレイヤー vs アイテム (アイテム取得)
+            j = self.first_hit(self.bullets[i], self.items, 'items')
+            if j < 0:
+                continue
+            item = self.items[j]
+            world.destroy('bullets', i)
+            item.type_index = (item.type_index + 1) % len(ITEM_TYPES)
+            item.is_bouncing = True
+            item.initial_bounce_y = item.y
+        world.flush()
+
+        players = [player for player in self.players if player.life > 0]
+
+        # プレイヤー vs アイテム (アイテム取得、2人が同時に触れたら番号の小さい方)
         for i in range(len(self.items) - 1, -1, -1):
             item = self.items[i]
-            if self.is_colliding(self.player, item):
-                self.apply_item_effect(item.type)
-                self.items.pop(i)
+            for player in players:
+                if self.is_colliding(player, item):
+                    self.apply_item_effect(item.type_index, player)
+                    world.destroy('items', i)
+                    break
 
         # プレイヤー vs 回復アイテム
         for i in range(len(self.heal_items) - 1, -1, -1):
             item = self.heal_items[i]
-            if self.is_colliding(self.player, item):
-                self.player.life = min(self.player.life + 1, self.player.max_life)
-                self.heal_items.pop(i)
-
-        # プレイヤー vs 敵
-        for i in range(len(self.enemies) - 1, -1, -1):
-            enemy = self.enemies[i]
-            if self.is_colliding(self.player, enemy):
-                if self.player.invincible_timer == 0: # 無敵時間中でない場合のみダメージ
-                    self.enemies.pop(i)
-                    if self.player.has_barrier:
-                        self.player.has_barrier = False
-                    else:
-                        self.player.life -= 1
-                        pyxel.play(0, 2) # プレイヤー被弾音
-                        self.player.invincible_timer = 60 # 1秒間の無敵時間 (60フレーム)
-                        if self.player.life <= 0:
-                            self.game_over()
-                    return # プレイヤーがダメージを受けたら、他の敵との衝突はチェックしない
-
-        # 敵の弾 vs プレイヤー
-        for i in range(len(self.enemy_bullets) - 1, -1, -1):
-            bullet = self.enemy_bullets[i]
-            if self.is_colliding(bullet, self.player):
-                if self.player.invincible_timer == 0: # 無敵時間中でない場合のみダメージ
-                    self.enemy_bullets.pop(i)
-                    if self.player.has_barrier:
-                        self.player.has_barrier = False
-                    else:
-                        self.player.life -= 1
-                        pyxel.play(0, 2) # プレイヤー被弾音
-                        self.player.invincible_timer = 60 # 1秒間の無敵時間 (60フレーム)
-                        if self.player.life <= 0:
-                            self.game_over()
-                    return # プレイヤーがダメージを受けたら、他の弾との衝突はチェックしない
+            for player in players:
+                if self.is_colliding(player, item):
+                    player.life = min(player.life + 1, player.max_life)
+                    world.destroy('heal_items', i)
+                    break
+        world.flush()
+
+        # プレイヤー vs 敵・敵の弾
+        # 誰かがダメージを受けたフレームは、ボスとの衝突はチェックしない
+        damaged = False
+        for player in players:
+            if self.check_player_hit(player):
+                damaged = True
+        if damaged:
+            return
 
         # ボスとの衝突
         if self.boss:
             # プレイヤーの弾 vs ボス
+            boss_vx, boss_vy = self.boss.motion()
             for i in range(len(self.bullets) - 1, -1, -1):
                 bullet = self.bullets[i]
-                if self.is_colliding(bullet, self.boss):
+                if time_of_impact(bullet, *bullet.motion(), self.boss, boss_vx, boss_vy) >= 0:
                     self.boss.health -= bullet.power
-                    self.bullets.pop(i)
+                    world.destroy('bullets', i)
+                    world.flush()
                     if self.boss.health <= 0:
-                        self.explosions.append(Explosion(self.boss.x + self.boss.w / 2, self.boss.y + self.boss.h / 2, scale_val(100), 7, 30)) # ボス破壊時の大きな爆発
-                        pyxel.play(1, 1) # 爆発音
+                        self.spawn_explosion(self.boss.x + self.boss.w / 2, self.boss.y + self.boss.h / 2, scale_val(100), 7, 30) # ボス破壊時の大きな爆発
+                        self.audio.play(1, 1) # 爆発音
                         self.game_clear()
                     break
 
             # ハンマー vs ボス
-            if hammer_hitbox and self.is_colliding(hammer_hitbox, self.boss):
-                self.boss.health -= scale_val(5) # ハンマーダメージ
-                if self.boss.health <= 0:
-                    self.explosions.append(Explosion(self.boss.x + self.boss.w / 2, self.boss.y + self.boss.h / 2, scale_val(100), 7, 30)) # ボス破壊時の大きな爆発
-                    pyxel.play(1, 1) # 爆発音
-                    self.game_clear()
-
-    def apply_item_effect(self, item_type):
-        if item_type['name'] == 'score':
-            self.score += 1000
-        elif item_type['name'] == 'speed':
-            self.player.speed = min(self.player.speed + scale_val(1), scale_val(10))
-        elif item_type['name'] == 'power':
-            self.player.shot_type = 'normal'
-            self.player.bullet_power = min(self.player.bullet_power + 1, 5)
-            self.player.bullet_size = min(self.player.bullet_size + scale_val(5), scale_val(25)) # 弾のサイズをより大きくする
-        elif item_type['name'] == '3way':
-            self.player.shot_type = '3way'
-            self.player.bullet_power = 1
-            self.player.bullet_size = scale_val(5)
-        elif item_type['name'] == 'barrier':
-            self.player.has_barrier = True
-        elif item_type['name'] == 'bomb':
-            self.player.special_attack_stock = min(self.player.special_attack_stock + 1, 5)
+            for hammer_hitbox in hammers:
+                if self.is_colliding(hammer_hitbox, self.boss):
+                    self.boss.health -= scale_val(5) # ハンマーダメージ
+                    if self.boss.health <= 0:
+                        self.spawn_explosion(self.boss.x + self.boss.w / 2, self.boss.y + self.boss.h / 2, scale_val(100), 7, 30) # ボス破壊時の大きな爆発
+                        self.audio.play(1, 1) # 爆発音
+                        self.game_clear()
+
+    def check_player_hit(self, player):
+        # 敵・敵の弾との衝突。ダメージを受けたら True
+        for i in range(len(self.enemies) - 1, -1, -1):
+            enemy = self.enemies[i]
+            if self.is_colliding(player, enemy):
+                if player.invincible_timer == 0: # 無敵時間中でない場合のみダメージ
+                    self.world.destroy('enemies', i)
+                    self.world.flush()
+                    self.damage_player(player, 'enemy')
+                    return True # プレイヤーがダメージを受けたら、他の敵との衝突はチェックしない
+
+        i = self.enemy_bullets.hit_index(player)
+        if i >= 0 and player.invincible_timer == 0: # 無敵時間中でない場合のみダメージ
+            self.enemy_bullets.remove(i)
+            self.damage_player(player, 'boss_bullet' if self.boss else 'bullet')
+            return True # プレイヤーがダメージを受けたら、他の弾との衝突はチェックしない
+        return False
+
+    def damage_player(self, player, cause):
+        if player.has_barrier:
+            player.has_barrier = False
+        else:
+            player.life -= 1
+            self.audio.play(0, 2) # プレイヤー被弾音
+            player.invincible_timer = 60 # 1秒間の無敵時間 (60フレーム)
+            # 全員やられたらゲームオーバー
+            if player.life <= 0 and all(p.life <= 0 for p in self.players):
+                self.game_over(cause)
+
+    def apply_item_effect(self, type_index, player=None):
+        self.ITEM_EFFECTS[type_index](self, player or self.player)
+
+    def effect_score(self, player):
+        self.score += 1000
+
+    def effect_speed(self, player):
+        player.speed = min(player.speed + scale_val(1), scale_val(10))
+
+    def effect_power(self, player):
+        player.shot_type = 'normal'
+        player.bullet_power = min(player.bullet_power + 1, 5)
+        player.bullet_size = min(player.bullet_size + scale_val(5), scale_val(25)) # 弾のサイズをより大きくする
+
+    def effect_3way(self, player):
+        player.shot_type = '3way'
+        player.bullet_power = 1
+        player.bullet_size = scale_val(5)
+
+    def effect_barrier(self, player):
+        player.has_barrier = True
+
+    def effect_bomb(self, player):
+        player.special_attack_stock = min(player.special_attack_stock + 1, 5)
+
+    # ITEM_TYPES と同じ並び
+    ITEM_EFFECTS = (effect_score, effect_speed, effect_power, effect_3way, effect_barrier, effect_bomb)
+
+    def first_hit(self, bullet, targets, name):
+        # grid に登録した targets のうち、bullet がこのフレームの移動で最初に当たるもののインデックス (なければ -1)
+        # 同じ時刻ならインデックスの大きい方 (元の逆順ループで先に見つかる方) を選ぶ
+        vx, vy = bullet.motion()
+        world = self.world
+        best = -1
+        best_t = 2.0
+        for j in self.grid.query(bullet):
+            if world.is_destroyed(name, j):
+                continue
+            target = targets[j]
+            t = time_of_impact(bullet, vx, vy, target, *target.motion())
+            if 0 <= t < best_t:
+                best = j
+                best_t = t
+        return best
 
     def is_colliding(self, a, b):
         # Pyxelのrectは(x, y, w, h)なので、それに合わせる
@@ -853,20 +2042,43 @@ class App:
         pyxel.text(5, 25, f"HIGH SCORE: {self.high_score}", 7)
         pyxel.text(5, 35, f"BOMB: {self.player.special_attack_stock}", 7)
 
+        # 2P の HP とボムは右上
+        for i, player in enumerate(self.players[1:], 1):
+            x = SCREEN_WIDTH - 105
+            y = 5 + (i - 1) * 25
+            pyxel.rect(x, y, 100, 5, 1)
+            pyxel.rect(x, y, (max(player.life, 0) / player.max_life) * 100, 5, 11)
+            pyxel.text(x, y + 10, f"{i + 1}P BOMB: {player.special_attack_stock}", player.color)
+
         # Add controls
         pyxel.text(5, SCREEN_HEIGHT - 40, "MOVE: ARROWS", 7)
         pyxel.text(5, SCREEN_HEIGHT - 30, "SHOT: SPACE", 7)
         pyxel.text(5, SCREEN_HEIGHT - 20, "HAMMER: Z", 7)
         pyxel.text(5, SCREEN_HEIGHT - 10, "BOMB: X", 7)
 
-    def game_over(self):
+        if self.game_phase == 'gameover':
+            pyxel.rect(0, SCREEN_HEIGHT / 2 - 20, SCREEN_WIDTH, 40, 0) # 黒い帯
+            pyxel.text(SCREEN_WIDTH / 2 - len("GAME OVER") * 4 / 2, SCREEN_HEIGHT / 2 - 10, "GAME OVER", 7)
+            pyxel.text(SCREEN_WIDTH / 2 - len("PRESS R TO RESTART") * 4 / 2, SCREEN_HEIGHT / 2 + 5, "PRESS R TO RESTART", 7)
+        elif self.game_phase == 'clear':
+            pyxel.rect(0, SCREEN_HEIGHT / 2 - 20, SCREEN_WIDTH, 40, 0) # 黒い帯
+            pyxel.text(SCREEN_WIDTH / 2 - len("GAME CLEAR") * pyxel.FONT_WIDTH / 2, SCREEN_HEIGHT / 2 - 10, "GAME CLEAR", 10)
+            pyxel.text(SCREEN_WIDTH / 2 - len("PRESS R TO RESTART") * pyxel.FONT_WIDTH / 2, SCREEN_HEIGHT / 2 + 5, "PRESS R TO RESTART", 7)
+
+    def game_over(self, cause=None):
+        # 同じフレームの別の判定から2回目が来ても、スコアは1ゲームに1回だけ記録する
+        if self.game_phase in ('gameover', 'clear'):
+            return
         self.game_phase = 'gameover'
-        if self.score > self.high_score:
-            self.save_high_score(self.score)
+        self.death_cause = cause
+        self.record_score()
 
     def game_clear(self):
+        # ボムで倒したフレームにハンマーも当たると2回呼ばれる
+        if self.game_phase in ('gameover', 'clear'):
+            return
         self.game_phase = 'clear'
-        if self.score > self.high_score:
-            self.save_high_score(self.score)
+        self.record_score()
 
-App()
+if __name__ == "__main__":
+    App()
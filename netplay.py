@@ -0,0 +1,255 @@
+# 2人協力プレイのロールバック方式のネット対戦
+# 両方の端末で同じ seed のゲームを進め、届いていない相手の入力は「最後に届いた入力がそのまま続く」と予測して進める
+# あとで届いた本当の入力が予測と違っていたら、そのフレームの直前の状態 (snapshot) に戻して今のフレームまで進め直す
+#
+#   python netplay.py host --port 7777 --seed 1          # 1P (相手からの接続を待つ)
+#   python netplay.py join 192.168.0.2 --port 7777 --seed 1  # 2P
+#
+# 自分の入力は input_delay フレーム後の入力として使うので、その分だけ相手に届くまでの余裕ができる
+# 相手の入力が max_rollback フレーム以上遅れたら、追いつくまでゲームを止める (戻る量がそれより大きくならない)
+#
+# パケットの形式 (UDP 1つ分):
+#   最初のフレーム u32 | 受け取った相手の入力の最後のフレーム u32 (なければ 0xffffffff) | 個数 u8 | マスク u8 x 個数
+#   相手が受け取ったと返してくるまで同じ入力を毎回送り直すので、パケットが落ちても次で届く
+import argparse
+import random
+import socket
+import struct
+import time
+from collections import deque
+
+import pyxel
+
+from main import App, NullAudio, PyxelAudio, PyxelInput, SCREEN_WIDTH, SCREEN_HEIGHT, SIM_FPS
+import snapshot
+
+PACKET = struct.Struct('<IIB')
+NO_FRAME = 0xffffffff
+MAX_INPUTS = 64 # 1つのパケットに入れる入力の数
+
+
+class LoopbackTransport:
+    # 同じプロセスの中でつなぐ (テスト・計測用)
+    # latency は相手が recv() を何回呼んだら届くか (ふつうは1フレームに1回)、loss は落とす割合
+    def __init__(self, latency=0, loss=0.0, seed=0):
+        self.latency = latency
+        self.loss = loss
+        self.rng = random.Random(seed)
+        self.peer = None
+        self.queue = deque() # (届く recv の回数, データ)
+        self.polls = 0
+
+    @classmethod
+    def pair(cls, latency=0, loss=0.0, seed=0):
+        a = cls(latency, loss, seed)
+        b = cls(latency, loss, seed + 1)
+        a.peer = b
+        b.peer = a
+        return a, b
+
+    def send(self, data):
+        if self.loss and self.rng.random() < self.loss:
+            return
+        peer = self.peer
+        peer.queue.append((peer.polls + self.latency, bytes(data)))
+
+    def recv(self):
+        self.polls += 1
+        packets = []
+        while self.queue and self.queue[0][0] <= self.polls:
+            packets.append(self.queue.popleft()[1])
+        return packets
+
+    def close(self):
+        pass
+
+
+class UdpTransport:
+    # address を渡さなければ port で待ち、最初に届いたパケットの送り主を相手にする
+    def __init__(self, port, address=None):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        if address is None:
+            self.sock.bind(('', port))
+            self.peer = None
+        else:
+            self.peer = (socket.gethostbyname(address), port)
+
+    def send(self, data):
+        if self.peer is None:
+            return
+        try:
+            self.sock.sendto(data, self.peer)
+        except OSError:
+            pass # 相手がまだいないなど。次のフレームで送り直す
+
+    def recv(self):
+        packets = []
+        while True:
+            try:
+                data, address = self.sock.recvfrom(2048)
+            except (BlockingIOError, ConnectionResetError):
+                return packets
+            if self.peer is None:
+                self.peer = address
+            if address == self.peer:
+                packets.append(data)
+
+    def close(self):
+        self.sock.close()
+
+
+class RollbackSession:
+    # app は players=2 で作った App。local_index は自分が操作するプレイヤー (0 か 1)
+    # poll はフレーム番号を受け取って自分の入力のマスクを返す関数 (PyxelInput().poll など)
+    def __init__(self, app, local_index, transport, poll=None, input_delay=2, max_rollback=8):
+        self.app = app
+        self.local_index = local_index
+        self.transport = transport
+        self.poll = poll or (lambda frame: 0)
+        self.input_delay = input_delay
+        self.max_rollback = max_rollback
+
+        self.frame = 0 # 次に進めるフレーム (これより前は進めた)
+        self.local = dict.fromkeys(range(input_delay), 0) # 自分の入力 (フレーム番号で引く)
+        self.local_start = 0 # これより前の自分の入力は捨てた
+        self.local_end = input_delay # 次に入れる自分の入力のフレーム
+        self.remote = {} # 届いた相手の入力
+        self.confirmed = -1 # ここまでの相手の入力はすべて届いている
+        self.peer_ack = -1 # 相手がここまでの自分の入力を受け取った
+        self.used = {} # 進めたときに使った相手の入力 (予測を含む)
+        self.states = {} # フレーム f を進める直前の状態
+        self.rollback_from = None # 予測が外れていた最初のフレーム
+
+        self.rollbacks = 0
+        self.rollback_frames = 0
+        self.max_rollback_time = 0.0
+        self.stalls = 0
+
+        for i, input in enumerate(app.inputs):
+            input.func = self.local_mask if i == local_index else self.remote_mask
+
+    def local_mask(self, frame):
+        return self.local.get(frame, 0)
+
+    def remote_mask(self, frame):
+        # 届いていなければ最後に届いた入力で予測する
+        if frame in self.remote:
+            mask = self.remote[frame]
+        else:
+            mask = self.remote.get(self.confirmed, 0)
+        self.used[frame] = mask
+        return mask
+
+    def update(self):
+        # 1フレームごとに呼ぶ。ゲームを進めたら True (相手を待っていれば False)
+        self.receive()
+        if self.rollback_from is not None:
+            self.rollback()
+        advanced = False
+        if self.frame - self.confirmed <= self.max_rollback:
+            self.local[self.local_end] = self.poll(self.frame)
+            self.local_end += 1
+            self.advance()
+            advanced = True
+        else:
+            self.stalls += 1
+        self.send()
+        return advanced
+
+    def advance(self):
+        frame = self.frame
+        self.states[frame] = snapshot.capture(self.app, level=0)
+        # これより前には戻らない (相手の入力が届いていないフレームは max_rollback 以内にある)
+        old = frame - self.max_rollback - 1
+        self.states.pop(old, None)
+        self.used.pop(old, None)
+        self.remote.pop(old, None)
+        # 自分の入力は、戻る可能性があるフレームと相手に届いていないフレームの分だけ残す
+        keep = min(old + 1, self.peer_ack + 1)
+        while self.local_start < keep:
+            self.local.pop(self.local_start, None)
+            self.local_start += 1
+        self.app.update()
+        self.frame += 1
+
+    def rollback(self):
+        start = time.perf_counter()
+        frame = self.rollback_from
+        self.rollback_from = None
+        end = self.frame
+        snapshot.restore(self.app, self.states[frame])
+        # 進め直すフレームの音はもう鳴らしたので鳴らさない
+        audio = self.app.audio
+        self.app.audio = NullAudio()
+        try:
+            self.frame = frame
+            while self.frame < end:
+                self.advance()
+        finally:
+            self.app.audio = audio
+        self.rollbacks += 1
+        self.rollback_frames += end - frame
+        self.max_rollback_time = max(self.max_rollback_time, time.perf_counter() - start)
+
+    def receive(self):
+        for data in self.transport.recv():
+            if len(data) < PACKET.size:
+                continue
+            first, ack, count = PACKET.unpack_from(data)
+            if ack != NO_FRAME:
+                self.peer_ack = max(self.peer_ack, ack)
+            masks = data[PACKET.size:PACKET.size + count]
+            for frame, mask in enumerate(masks, first):
+                if frame <= self.confirmed or frame in self.remote:
+                    continue
+                self.remote[frame] = mask
+                if frame < self.frame and self.used.get(frame) != mask:
+                    if self.rollback_from is None or frame < self.rollback_from:
+                        self.rollback_from = frame
+            while self.confirmed + 1 in self.remote:
+                self.confirmed += 1
+
+    def send(self):
+        first = self.peer_ack + 1
+        masks = bytes(self.local[frame] for frame in range(first, min(first + MAX_INPUTS, self.local_end)))
+        ack = self.confirmed if self.confirmed >= 0 else NO_FRAME
+        self.transport.send(PACKET.pack(first, ack, len(masks)) + masks)
+
+    def stats(self):
+        return {'frame': self.frame, 'confirmed': self.confirmed, 'rollbacks': self.rollbacks,
+                'rollback_frames': self.rollback_frames, 'max_rollback_ms': self.max_rollback_time * 1000,
+                'stalls': self.stalls}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    host = sub.add_parser('host')
+    join = sub.add_parser('join')
+    join.add_argument('address')
+    for p in (host, join):
+        p.add_argument('--port', type=int, default=7777)
+        p.add_argument('--seed', type=int, default=0, help="両方で同じ値にする")
+        p.add_argument('--delay', type=int, default=2, help="自分の入力を遅らせるフレーム数")
+        p.add_argument('--max-rollback', type=int, default=8)
+    args = parser.parse_args()
+
+    if args.command == 'host':
+        transport = UdpTransport(args.port)
+        local_index = 0
+    else:
+        transport = UdpTransport(args.port, args.address)
+        local_index = 1
+
+    pyxel.init(SCREEN_WIDTH, SCREEN_HEIGHT, fps=SIM_FPS)
+    pyxel.title(f"Pyxel Danmaku Game ({local_index + 1}P)")
+    # ハイスコアは保存しない (進め直しでゲームオーバーが何度も起きることがあるため)
+    app = App(headless=True, seed=args.seed, audio=PyxelAudio(), players=2, gc_policy=True)
+    app.build_assets()
+    session = RollbackSession(app, local_index, transport, PyxelInput().poll, args.delay, args.max_rollback)
+    pyxel.run(session.update, app.draw)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,424 @@
+# シミュレーションと描画を別のプロセスで並行に進める
+# GIL があるので1つのプロセスでは App.update と App.draw が1つのコアで順番に動く。このモードでは
+# 子プロセスが App.update を進めて各フレームの描画に使う値 (write_frame) を共有メモリの2つの枠に交互に書き、
+# 描画側は書き終わった新しい方の枠の配列から FrameView で描く (その間に子プロセスは次のフレームを進める)
+# ゲームの状態全体 (snapshot) は送らないので、描画側には App がなく restore もしない
+#
+#   python pipeline.py --seed 1
+#
+# 共有メモリの中身:
+#   制御用の int64 (動作中かどうか・リングバッファの読み書きの位置・各枠のヘッダ)
+#   入力のリングバッファ    描画側 → シミュレーション側 (1ステップ1行、プレイヤーごとのマスク)
+#   音のリングバッファ      シミュレーション側 → 描画側 (play / playm の引数)
+#   フレームの枠 x 2        write_frame が書く float64 の列 (ヘッダ・プレイヤー・ボス・リストごとの列)
+# リングバッファは書く側と読む側が1つずつなのでロックを使わない (それぞれ自分の位置だけを進める)
+# 枠はヘッダの番号を書き込み中は -1 にしておき、読む側はコピーの前後で番号が変わっていないことを確かめる
+#
+# 画面は入力から1フレーム遅れて表示される (フレーム N を描いている間に N+1 を進めるため)
+import argparse
+import atexit
+import multiprocessing
+import os
+import time
+from operator import attrgetter
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pyxel
+
+from main import App, BackgroundCache, Boss, Enemy, FrameGovernor, NullAudio, Player, PyxelAudio, PyxelInput, ScriptedInput, SpriteCache
+from main import ITEM_BOMB, ITEM_TYPES, SCREEN_WIDTH, SCREEN_HEIGHT, SIM_FPS
+
+SLOT_BYTES = 1 << 20 # 1枠の大きさ (1行 40 バイトで約 2.6 万行)
+INPUT_CAPACITY = 64 # 描画側が先に進めるステップ数の上限
+AUDIO_CAPACITY = 256
+IDLE_SLEEP = 0.0002 # シミュレーション側が入力を待つ間隔 (秒)
+
+# 制御用の int64 のインデックス
+RUNNING = 0
+INPUT_HEAD, INPUT_TAIL, AUDIO_HEAD, AUDIO_TAIL = 1, 2, 3, 4
+SLOT_HEADERS = 8 # 枠ごとに (番号, 長さ, フレーム, ハイスコア)
+SLOT_FIELDS = 4
+CONTROL_SIZE = SLOT_HEADERS + 2 * SLOT_FIELDS
+AUDIO_KINDS = ('play', 'playm')
+
+# 1フレーム分の描画に使う値 (write_frame / FrameView.load)
+# ヘッダ (フレーム, スコア, 場面, プレイヤーの数, ボスの有無)、プレイヤーごとの PLAYER_FIELDS、ボスがいれば BOSS_FIELDS、
+# DRAW_LISTS の行数、続けて各リストの列 (ROW 列を列ごとにまとめて並べる)
+PHASES = ('playing', 'boss_intro', 'boss', 'gameover', 'clear')
+PLAYER_FIELDS = ('x', 'y', 'w', 'h', 'life', 'max_life', 'special_attack_stock', 'invincible_timer', 'has_barrier', 'is_hammering', 'color')
+BOSS_FIELDS = ('x', 'y', 'w', 'h', 'health', 'max_health', 'color')
+FLOAT_FIELDS = 4 # 先頭の x, y, w, h 以外は整数に戻す
+HEAD_SIZE = 5
+ROW = 5
+# リストごとの1行 (x, y, w, h, 色)。描き方が違うものは列の意味を変える
+RECT_ROW = attrgetter('x', 'y', 'w', 'h', 'color')
+DRAW_LISTS = (
+    ('bullets', RECT_ROW),
+    ('enemies', RECT_ROW),
+    ('enemy_bullets', None), # 配列 (EnemyBulletStore) から列ごとに写す
+    ('clouds', lambda e: (e.x, e.y, e.w, e.h, 7)),
+    ('items', attrgetter('x', 'y', 'w', 'h', 'type_index')), # 色の列はアイテムの種類
+    ('heal_items', RECT_ROW),
+    ('explosions', lambda e: (e.x - e.size / 2, e.y - e.size / 2, e.size, e.size, e.color)), # 描く矩形
+    ('bomb_effects', lambda e: (e.x, e.y, e.radius, 0, e.color)), # (中心, 半径, -, 色)
+)
+
+
+class SpscRing:
+    # 書く側と読む側が1つずつのリングバッファ。head は書く側だけ、tail は読む側だけが進める
+    def __init__(self, control, head, tail, rows):
+        self.control = control
+        self.head = head
+        self.tail = tail
+        self.rows = rows
+
+    def push(self, row):
+        # いっぱいなら False
+        head = int(self.control[self.head])
+        if head - int(self.control[self.tail]) >= len(self.rows):
+            return False
+        self.rows[head % len(self.rows)] = row
+        self.control[self.head] = head + 1 # 行を書き終えてから位置を進める
+        return True
+
+    def pop_all(self):
+        tail = int(self.control[self.tail])
+        head = int(self.control[self.head])
+        n = len(self.rows)
+        out = [self.rows[i % n].tolist() for i in range(tail, head)]
+        self.control[self.tail] = head
+        return out
+
+
+class FrameChannel:
+    # 描画側とシミュレーション側で共有するメモリ。name を渡すと既存のものにつなぐ
+    def __init__(self, players=1, slot_bytes=SLOT_BYTES, name=None):
+        self.players = players
+        self.slot_bytes = slot_bytes
+        control_bytes = 8 * CONTROL_SIZE
+        input_bytes = 4 * INPUT_CAPACITY * players
+        audio_bytes = 4 * AUDIO_CAPACITY * 3
+        size = control_bytes + input_bytes + audio_bytes + 2 * slot_bytes
+        self.owner = name is None
+        self.shm = SharedMemory(create=True, size=size) if self.owner else SharedMemory(name=name)
+        self.name = self.shm.name
+        buf = self.shm.buf
+        self.control = np.ndarray(CONTROL_SIZE, np.int64, buffer=buf)
+        offset = control_bytes
+        inputs = np.ndarray((INPUT_CAPACITY, players), np.uint32, buffer=buf, offset=offset)
+        offset += input_bytes
+        audio = np.ndarray((AUDIO_CAPACITY, 3), np.int32, buffer=buf, offset=offset)
+        offset += audio_bytes
+        self.slots = [np.ndarray(slot_bytes // 8, np.float64, buffer=buf, offset=offset + i * slot_bytes) for i in range(2)]
+        self.inputs = SpscRing(self.control, INPUT_HEAD, INPUT_TAIL, inputs)
+        self.audio = SpscRing(self.control, AUDIO_HEAD, AUDIO_TAIL, audio)
+        self.published = 0 # 書いた枠の数 (書く側だけが使う)
+        if self.owner:
+            self.control[:] = 0
+            self.control[RUNNING] = 1
+
+    @property
+    def running(self):
+        return bool(self.control[RUNNING])
+
+    def stop(self):
+        self.control[RUNNING] = 0
+
+    def publish(self, app):
+        # app の今のフレームを次の枠に直接書く
+        self.published += 1
+        slot = self.published % 2
+        header = SLOT_HEADERS + slot * SLOT_FIELDS
+        self.control[header] = -1 # 書き込み中
+        n = write_frame(app, self.slots[slot])
+        self.control[header + 1:header + SLOT_FIELDS] = (n, app.frame_count, app.high_score)
+        self.control[header] = self.published
+
+    def latest(self, after=0):
+        # 書き終わった新しい方の枠を (番号, フレーム, ハイスコア, 配列のコピー) で返す。番号が after 以下なら None
+        for _ in range(4):
+            seqs = [int(self.control[SLOT_HEADERS + i * SLOT_FIELDS]) for i in range(2)]
+            slot = 0 if seqs[0] > seqs[1] else 1
+            header = SLOT_HEADERS + slot * SLOT_FIELDS
+            seq = seqs[slot]
+            if seq <= after:
+                return None
+            n, frame, high_score = (int(v) for v in self.control[header + 1:header + SLOT_FIELDS])
+            data = self.slots[slot][:n].copy()
+            if int(self.control[header]) == seq:
+                return seq, frame, high_score, data
+            # コピーしている間に上書きされた (描画側が2フレーム以上遅れている) ので読み直す
+        return None
+
+    def close(self):
+        # 共有メモリを閉じる前に、それを指す配列をすべて手放す
+        self.control = None
+        self.slots = None
+        self.inputs = self.audio = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def write_frame(app, out):
+    # app の描画に使う値を out (float64 の配列) の先頭に書き、書いた個数を返す
+    lists = [app.enemy_bullets if getter is None else getattr(app, name) for name, getter in DRAW_LISTS]
+    players = app.players
+    boss = app.boss
+    size = (HEAD_SIZE + len(players) * len(PLAYER_FIELDS) + (len(BOSS_FIELDS) if boss else 0)
+            + len(DRAW_LISTS) + ROW * sum(map(len, lists)))
+    if size > len(out):
+        raise ValueError(f"frame needs {size * 8} bytes (slot_bytes is {len(out) * 8})")
+    out[:HEAD_SIZE] = (app.frame_count, app.score, PHASES.index(app.game_phase), len(players), boss is not None)
+    pos = HEAD_SIZE
+    for player in players:
+        out[pos:pos + len(PLAYER_FIELDS)] = [getattr(player, f) for f in PLAYER_FIELDS]
+        pos += len(PLAYER_FIELDS)
+    if boss:
+        out[pos:pos + len(BOSS_FIELDS)] = [getattr(boss, f) for f in BOSS_FIELDS]
+        pos += len(BOSS_FIELDS)
+    counts = pos
+    pos += len(DRAW_LISTS)
+    for i, ((name, getter), entities) in enumerate(zip(DRAW_LISTS, lists)):
+        n = len(entities)
+        out[counts + i] = n
+        if n == 0:
+            continue
+        columns = out[pos:pos + n * ROW].reshape(ROW, n)
+        if getter is None:
+            for column, values in zip(columns, (entities.x, entities.y, entities.w, entities.h, entities.color)):
+                column[:] = values[:n]
+        else:
+            columns[:] = list(zip(*map(getter, entities)))
+        pos += n * ROW
+    return pos
+
+
+class PlayerView:
+    # FrameView が描くプレイヤー (Player.draw と App.draw_ui が使う値だけ)
+    __slots__ = PLAYER_FIELDS
+    draw = Player.draw
+
+
+class BossView:
+    __slots__ = BOSS_FIELDS
+    draw = Boss.draw
+
+
+class FrameView:
+    # 描画側。write_frame の配列から App.draw と同じ画面を描く
+    # 背景と UI は App のメソッドをそのまま使う (使う属性を同じ名前で持っている)
+    build_assets = App.build_assets
+    set_quality = App.set_quality
+    draw_background = App.draw_background
+    draw_ui = App.draw_ui
+
+    def __init__(self, audio=None):
+        self.audio = audio or PyxelAudio()
+        self.background = BackgroundCache()
+        self.sprites = SpriteCache()
+        self.set_quality(0)
+        self.frame_count = 0
+        self.score = 0
+        self.high_score = 0
+        self.game_phase = 'playing'
+        self.players = []
+        self.player = None
+        self.boss = None
+        self.lists = {name: np.zeros((ROW, 0)) for name, _ in DRAW_LISTS} # リストごとの (ROW, 行数) の配列
+
+    def load(self, data):
+        frame, score, phase, players, boss = data[:HEAD_SIZE].tolist()
+        self.frame_count = int(frame)
+        self.score = int(score)
+        self.game_phase = PHASES[int(phase)]
+        pos = HEAD_SIZE
+        self.players = [self.unpack(PlayerView(), PLAYER_FIELDS, data[pos + i * len(PLAYER_FIELDS):]) for i in range(int(players))]
+        self.player = self.players[0]
+        pos += int(players) * len(PLAYER_FIELDS)
+        self.boss = None
+        if boss:
+            self.boss = self.unpack(BossView(), BOSS_FIELDS, data[pos:])
+            pos += len(BOSS_FIELDS)
+        counts = data[pos:pos + len(DRAW_LISTS)].astype(int).tolist()
+        pos += len(DRAW_LISTS)
+        for (name, _), n in zip(DRAW_LISTS, counts):
+            self.lists[name] = data[pos:pos + n * ROW].reshape(ROW, n)
+            pos += n * ROW
+
+    @staticmethod
+    def unpack(view, fields, data):
+        values = data[:len(fields)].tolist()
+        for i, (field, value) in enumerate(zip(fields, values)):
+            setattr(view, field, value if i < FLOAT_FIELDS else int(value))
+        return view
+
+    def rows(self, name):
+        # リストの行を (x, y, w, h, 色) で返す (EnemyBulletStore.draw と同じく列ごとに tolist する。色は整数)
+        columns = self.lists[name]
+        return zip(*columns[:ROW - 1].tolist(), columns[ROW - 1].astype(int).tolist())
+
+    def draw(self):
+        self.draw_background()
+        self.draw_entities()
+        self.draw_effects()
+        self.draw_ui()
+
+    def draw_entities(self):
+        # App.draw_entities と同じ順番 (アイテムとボムは Item.draw / BombEffect.draw と同じ描き方)
+        for player in self.players:
+            if player.life > 0:
+                player.draw(self.sprites)
+        for x, y, w, h, color in self.rows('bullets'):
+            pyxel.rect(x, y, w, h, color)
+        for x, y, w, h, color in self.rows('enemies'):
+            self.sprites.draw(Enemy.shape, x, y, w, h, color)
+        for name in ('enemy_bullets', 'clouds'):
+            for x, y, w, h, color in self.rows(name):
+                pyxel.rect(x, y, w, h, color)
+        for x, y, w, h, type_index in self.rows('items'):
+            if type_index != ITEM_BOMB or pyxel.frame_count % 10 < 5:
+                pyxel.rect(x, y, w, h, ITEM_TYPES[type_index].color)
+        for x, y, w, h, color in self.rows('heal_items'):
+            pyxel.rect(x, y, w, h, color)
+        if self.boss:
+            self.boss.draw()
+
+    def draw_effects(self):
+        for x, y, w, h, color in self.rows('explosions'):
+            pyxel.rect(x, y, w, h, color)
+        for x, y, radius, _, color in self.rows('bomb_effects'):
+            for i in range(self.quality.bomb_rings):
+                r = radius - i * 20
+                if r > 0:
+                    pyxel.circb(x, y, r, color)
+
+
+class ChannelAudio(NullAudio):
+    # シミュレーション側の音。鳴らす代わりに音のリングバッファに書く (あふれた分は捨てる)
+    def __init__(self, channel):
+        self.channel = channel
+
+    def play(self, ch, snd):
+        self.channel.audio.push((0, ch, snd))
+
+    def playm(self, msc, loop=False):
+        self.channel.audio.push((1, msc, int(loop)))
+
+
+def run_simulation(name, players, seed, stage, save_dir):
+    # シミュレーション側のプロセス。入力の行が届くたびに1ステップ進め、届いた分を進め終えたら状態を書く
+    channel = FrameChannel(players, name=name)
+    parent = os.getppid()
+    try:
+        masks = [0] * players
+        inputs = [ScriptedInput(lambda frame, i=i: masks[i]) for i in range(players)]
+        app = App(headless=True, input_source=inputs, audio=ChannelAudio(channel), save_dir=save_dir,
+                  seed=seed, players=players, stage=stage, gc_policy=True)
+        channel.publish(app)
+        while channel.running:
+            rows = channel.inputs.pop_all()
+            if not rows:
+                if os.getppid() != parent:
+                    break # 描画側が後片付けをせずに終わった
+                time.sleep(IDLE_SLEEP)
+                continue
+            for row in rows:
+                masks[:] = row
+                app.update()
+            channel.publish(app)
+        app.scores.close()
+    finally:
+        channel.close()
+
+
+class Pipeline:
+    # 描画側。FrameGovernor からは App と同じように update() / draw() / set_quality() を呼ばれる
+    # update() は1ステップ分の入力を送るだけで、draw() は届いている中で一番新しいフレームを描く
+    def __init__(self, seed=None, stage=None, input_source=None, audio=None, save_dir=None, slot_bytes=SLOT_BYTES):
+        self.input = input_source or PyxelInput()
+        self.channel = FrameChannel(1, slot_bytes)
+        seed = seed if seed is not None else int.from_bytes(os.urandom(4), 'little')
+        # pyxel.init の後なので fork ではなく spawn で起動する (SDL のスレッドを子プロセスに持ち込まない)
+        context = multiprocessing.get_context('spawn')
+        self.process = context.Process(target=run_simulation, daemon=True,
+                                       args=(self.channel.name, 1, seed, stage, save_dir))
+        self.process.start()
+        atexit.register(self.close)
+        self.view = FrameView(audio)
+        self.view.build_assets()
+        self.seq = 0
+        self.frame = -1 # 描いているフレーム
+        self.sent = 0 # 送ったステップ数
+        self.dropped_steps = 0 # 入力のリングバッファがいっぱいで送れなかったステップ
+        self.stale_draws = 0 # 新しいフレームが届いていなかった描画
+
+    @property
+    def quality_level(self):
+        return self.view.quality_level
+
+    def set_quality(self, level):
+        self.view.set_quality(level)
+
+    def update(self):
+        self.input.begin_frame()
+        if self.channel.inputs.push((self.input.mask,)):
+            self.sent += 1
+        else:
+            self.dropped_steps += 1
+
+    def poll(self):
+        # 新しいフレームが届いていれば FrameView に読み込む
+        for kind, a, b in self.channel.audio.pop_all():
+            getattr(self.view.audio, AUDIO_KINDS[kind])(a, b)
+        latest = self.channel.latest(self.seq)
+        if latest is None:
+            if not self.process.is_alive():
+                raise RuntimeError(f"simulation process exited with status {self.process.exitcode}")
+            return False
+        self.seq, self.frame, self.view.high_score, data = latest
+        self.view.load(data)
+        return True
+
+    def wait(self, frame, timeout=5.0):
+        # frame まで進んだ状態が届くまで待つ (ベンチマーク・確認用)
+        limit = time.perf_counter() + timeout
+        while self.frame < frame:
+            if not self.poll() and time.perf_counter() > limit:
+                raise TimeoutError(f"frame {frame} did not arrive (latest {self.frame})")
+
+    def draw(self):
+        # 新しいフレームがなければ描かない (画面には前のフレームが残る)
+        if self.poll():
+            self.view.draw()
+        else:
+            self.stale_draws += 1
+
+    def stats(self):
+        return {'frame': self.frame, 'sent': self.sent, 'dropped_steps': self.dropped_steps,
+                'stale_draws': self.stale_draws}
+
+    def close(self):
+        if self.channel.control is None:
+            return
+        self.channel.stop()
+        self.process.join(timeout=5)
+        self.channel.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--stage', help="ステージの名前 (stages/<名前>.json、既定は endless)")
+    args = parser.parse_args()
+
+    pyxel.init(SCREEN_WIDTH, SCREEN_HEIGHT, fps=SIM_FPS)
+    pyxel.title("Pyxel Danmaku Game")
+    pipeline = Pipeline(args.seed, args.stage, save_dir=pyxel.user_data_dir("PyxelDanmakuGame", "HighScores"))
+    governor = FrameGovernor(pipeline)
+    pyxel.run(governor.update, governor.draw)
+
+
+if __name__ == '__main__':
+    main()
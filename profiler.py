@@ -0,0 +1,124 @@
+# フェーズごとのフレーム計測
+# App.update / App.draw の各フェーズを perf_counter_ns で測り、固定長のリングバッファに入れる
+# 無効のときは App 側で何もしない (App.profiler が None)
+#
+#   TOUHOU_PROFILE=1                 計測を有効にする
+#   TOUHOU_PROFILE_OVERLAY=1         画面右上に直近60フレームの平均を表示する
+#   TOUHOU_PROFILE_OUT=profile.csv   終了時の書き出し先 (.json なら集計結果を JSON で書く)
+#   TOUHOU_PROFILE_FRAMES=3600       リングバッファのフレーム数
+import atexit
+import json
+import os
+import time
+from array import array
+
+import pyxel
+
+OVERLAY_X = 170 # オーバーレイの左端
+ENTITY_LISTS = ('bullets', 'enemies', 'enemy_bullets', 'clouds', 'items', 'heal_items', 'explosions', 'bomb_effects')
+
+
+class FrameProfiler:
+    def __init__(self, app, size=None, overlay=None, output=None):
+        self.size = size or int(os.environ.get('TOUHOU_PROFILE_FRAMES', 3600))
+        self.overlay = overlay if overlay is not None else bool(os.environ.get('TOUHOU_PROFILE_OVERLAY'))
+        self.output = output if output is not None else os.environ.get('TOUHOU_PROFILE_OUT', 'profile.csv')
+
+        self.columns = ['update.' + name for name in app.UPDATE_PHASES] + ['draw.' + name for name in app.DRAW_PHASES]
+        self.width = len(self.columns)
+        self.n_update = len(app.UPDATE_PHASES)
+        self.times = array('q', bytes(8 * self.size * self.width)) # ns
+        self.counts = array('l', bytes(array('l').itemsize * self.size * len(ENTITY_LISTS)))
+        self.frames = array('q', bytes(8 * self.size)) # 各行のフレーム番号
+        self.row = -1
+        self.base = 0
+        self.recorded = 0
+
+        # 各フェーズを計測付きのものに差し替える
+        app.update_phases = [self.wrap(i, phase) for i, phase in enumerate(app.update_phases)]
+        app.draw_phases = [self.wrap(self.n_update + i, phase) for i, phase in enumerate(app.draw_phases)]
+
+        if self.output:
+            atexit.register(self.dump, self.output)
+
+    def wrap(self, column, phase):
+        clock = time.perf_counter_ns
+        times = self.times
+        def timed():
+            start = clock()
+            phase()
+            times[self.base + column] = clock() - start
+        return timed
+
+    def begin_frame(self, app):
+        # 次の行に進み、その時点のエンティティ数を記録する
+        self.row = (self.row + 1) % self.size
+        self.base = self.row * self.width
+        for i in range(self.width):
+            self.times[self.base + i] = 0
+        self.frames[self.row] = app.frame_count
+        k = self.row * len(ENTITY_LISTS)
+        for i, name in enumerate(ENTITY_LISTS):
+            self.counts[k + i] = len(getattr(app, name))
+        self.recorded = min(self.recorded + 1, self.size)
+
+    def rows(self):
+        # 古い順に (フレーム番号, フェーズごとの ns, エンティティ数)
+        n_counts = len(ENTITY_LISTS)
+        for k in range(self.recorded):
+            r = (self.row - self.recorded + 1 + k) % self.size
+            yield (self.frames[r],
+                   self.times[r * self.width:(r + 1) * self.width].tolist(),
+                   self.counts[r * n_counts:(r + 1) * n_counts].tolist())
+
+    def recent_means(self, frames=60):
+        # 直近 frames フレームのフェーズごとの平均 (ms)
+        n = min(frames, self.recorded)
+        totals = [0] * self.width
+        for k in range(n):
+            r = (self.row - k) % self.size
+            for i in range(self.width):
+                totals[i] += self.times[r * self.width + i]
+        return [t / max(n, 1) / 1e6 for t in totals]
+
+    def summary(self):
+        columns = {name: [] for name in self.columns}
+        peaks = dict.fromkeys(ENTITY_LISTS, 0)
+        for _, times, counts in self.rows():
+            for name, t in zip(self.columns, times):
+                columns[name].append(t)
+            for name, c in zip(ENTITY_LISTS, counts):
+                peaks[name] = max(peaks[name], c)
+        result = {'frames': self.recorded, 'phases': {}, 'peak_entities': peaks}
+        for name, samples in columns.items():
+            if not samples:
+                continue
+            samples.sort()
+            pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] / 1e6
+            result['phases'][name] = {
+                'mean': sum(samples) / len(samples) / 1e6,
+                'p50': pick(0.50),
+                'p95': pick(0.95),
+                'p99': pick(0.99),
+                'max': samples[-1] / 1e6,
+            }
+        return result
+
+    def dump(self, path):
+        if path.endswith('.json'):
+            with open(path, 'w') as f:
+                json.dump(self.summary(), f, indent=2)
+            return
+        with open(path, 'w') as f:
+            f.write(','.join(['frame'] + [c + '_ns' for c in self.columns] + list(ENTITY_LISTS)) + '\n')
+            for frame, times, counts in self.rows():
+                f.write(','.join(map(str, [frame] + times + counts)) + '\n')
+
+    def draw_overlay(self):
+        means = self.recent_means()
+        x = OVERLAY_X
+        pyxel.rect(x - 2, 2, pyxel.width - x, 6 * self.width + 4, 0)
+        for i, (name, ms) in enumerate(zip(self.columns, means)):
+            # update は白、draw は黄色
+            pyxel.text(x, 4 + i * 6, f"{name.split('.')[1][:11]:11}{ms:6.2f}", 7 if i < self.n_update else 10)
+
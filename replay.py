@@ -0,0 +1,282 @@
+# 入力の記録と再生
+# 1フレームのキー状態 (INPUT_KEYS の8キー) を1バイトのビットマスクにし、
+# 同じ値の連続をランレングスでまとめてから zlib で圧縮して保存する
+#
+# ファイル形式 (リトルエンディアン):
+#   magic b'TRPL' | version u8 | seed u64 | frames u32 | ステージ名の長さ u8 | ステージ名 (UTF-8)
+#   | 状態の数 u32 | (ステップ数 u32, state_digest 20バイト) x 状態の数 | 圧縮したランレングス列
+#   version 1 にはステージ名がない ('endless')、version 2 までは状態がない
+#   ランレングス列は (マスク u8, 連続数 varint) の並び
+#   状態は記録したときの state_digest で、DIGEST_INTERVAL ステップごと (そのステップの入力を読む時点) と最後の1つ
+#
+#   python replay.py record out.trp [--seed 1]               ウィンドウで遊んで記録 (閉じたときに保存)
+#   python replay.py record out.trp --headless --frames 3600  ランダム入力で記録
+#   python replay.py record out.trp --stage stage1            ステージを選んで記録
+#   python replay.py play out.trp                            ヘッドレスで再生して結果を表示
+#   python replay.py verify out.trp                          再生して記録したときと同じ状態になるか確認
+#   python replay.py seek out.trp 1800 [--interval 30]       キーフレームを取りながら再生し、1800 フレーム目に戻る
+import argparse
+import atexit
+import hashlib
+import os
+import random
+import struct
+import time
+import zlib
+
+import pyxel
+
+from main import App, FrameGovernor, ScriptedInput, PyxelAudio, PyxelInput, INPUT_KEYS, SCREEN_WIDTH, SCREEN_HEIGHT, SIM_FPS
+import headless
+import snapshot
+
+MAGIC = b'TRPL'
+VERSION = 3
+HEADER = struct.Struct('<4sBQI')
+DIGEST = struct.Struct('<I20s')
+DIGEST_INTERVAL = 600 # 記録中に状態を残す間隔 (ステップ)
+
+
+class Replay:
+    def __init__(self, seed, masks=None, stage='endless', digests=None):
+        self.seed = seed
+        self.masks = bytearray(masks or ())
+        self.stage = stage
+        self.digests = dict(digests or {}) # ステップ数 -> 記録したときの state_digest
+
+    def __len__(self):
+        return len(self.masks)
+
+    def to_bytes(self):
+        runs = bytearray()
+        masks = self.masks
+        i = 0
+        while i < len(masks):
+            j = i + 1
+            while j < len(masks) and masks[j] == masks[i]:
+                j += 1
+            runs.append(masks[i])
+            write_varint(runs, j - i)
+            i = j
+        stage = self.stage.encode()
+        digests = struct.pack('<I', len(self.digests))
+        digests += b''.join(DIGEST.pack(step, bytes.fromhex(digest)) for step, digest in sorted(self.digests.items()))
+        return HEADER.pack(MAGIC, VERSION, self.seed, len(masks)) + bytes((len(stage),)) + stage + digests + zlib.compress(bytes(runs), 9)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, seed, frames = HEADER.unpack_from(data)
+        if magic != MAGIC or not 1 <= version <= VERSION:
+            raise ValueError("not a replay file")
+        pos = HEADER.size
+        stage = 'endless'
+        if version >= 2:
+            stage = data[pos + 1:pos + 1 + data[pos]].decode()
+            pos += 1 + data[pos]
+        digests = {}
+        if version >= 3:
+            count, = struct.unpack_from('<I', data, pos)
+            pos += 4
+            for _ in range(count):
+                step, digest = DIGEST.unpack_from(data, pos)
+                digests[step] = digest.hex()
+                pos += DIGEST.size
+        runs = zlib.decompress(data[pos:])
+        masks = bytearray()
+        pos = 0
+        while pos < len(runs):
+            mask = runs[pos]
+            count, pos = read_varint(runs, pos + 1)
+            masks.extend(bytes((mask,)) * count)
+        if len(masks) != frames:
+            raise ValueError("corrupt replay file")
+        return cls(seed, masks, stage, digests)
+
+    def finish(self, app):
+        # 記録の最後の状態を残す (app は記録した入力をすべて進め終えていること)
+        self.digests[len(self.masks)] = state_digest(app)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, pos):
+    value = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+
+
+class RecordingInput(ScriptedInput):
+    # 別の入力 (PyxelInput など) を毎フレーム読み取ってマスクを記録する
+    # ゲーム側には記録したマスクから作った btn/btnp を返すので、再生時とまったく同じ入力になる
+    # app を渡しておくと DIGEST_INTERVAL ステップごとに、そのステップの入力を読む時点の state_digest も残す
+    def __init__(self, inner, replay, app=None):
+        super().__init__(self.poll)
+        self.inner = inner
+        self.replay = replay
+        self.app = app
+
+    def poll(self, frame):
+        steps = len(self.replay.masks)
+        if self.app is not None and steps and steps % DIGEST_INTERVAL == 0:
+            self.replay.digests[steps] = state_digest(self.app)
+        self.inner.begin_frame()
+        mask = 0
+        for i, key in enumerate(INPUT_KEYS):
+            if self.inner.btn(key):
+                mask |= 1 << i
+        self.replay.masks.append(mask)
+        return mask
+
+
+class CheckingInput(ScriptedInput):
+    # リプレイの入力を返しながら、記録したときに状態を残した位置で state_digest を比べる
+    def __init__(self, replay):
+        super().__init__(self.poll)
+        self.replay = replay
+        self.app = None
+        self.mismatch = None # 最初に食い違ったステップ数
+
+    def poll(self, frame):
+        self.check(frame)
+        return self.replay.masks[frame] if frame < len(self.replay) else 0
+
+    def check(self, steps):
+        expected = self.replay.digests.get(steps)
+        if expected is not None and self.mismatch is None and state_digest(self.app) != expected:
+            self.mismatch = steps
+
+
+def play(replay, app=None):
+    # リプレイを最後までヘッドレスで再生した App を返す (描画はしない)
+    if app is None:
+        app = App(headless=True, seed=replay.seed, input_source=ScriptedInput(replay.masks), stage=replay.stage)
+    app.step(len(replay))
+    return app
+
+
+def verify(replay):
+    # 再生して記録したときの状態と比べ、最初に食い違ったステップ数を返す (すべて一致すれば None)
+    checker = CheckingInput(replay)
+    checker.app = App(headless=True, seed=replay.seed, input_source=checker, stage=replay.stage)
+    play(replay, checker.app)
+    checker.check(len(replay))
+    return checker.mismatch
+
+
+def state_digest(app):
+    # 再生結果の比較用 (スコア・フェーズ・全プレイヤー・全エンティティの位置と乱数の状態)
+    parts = [app.frame_count, app.score, app.game_phase]
+    for p in app.players:
+        parts += [p.x, p.y, p.life, p.shot_type, p.bullet_power, p.has_barrier, p.special_attack_stock]
+    parts.append(app.rng.getstate())
+    for name in ('bullets', 'enemies', 'clouds', 'items', 'heal_items', 'explosions'):
+        parts.append([(e.x, e.y) for e in getattr(app, name)])
+    n = len(app.enemy_bullets)
+    parts.append((app.enemy_bullets.x[:n].tobytes(), app.enemy_bullets.y[:n].tobytes()))
+    if app.boss:
+        parts.append((app.boss.x, app.boss.y, app.boss.health))
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    rec = sub.add_parser('record')
+    rec.add_argument('path')
+    rec.add_argument('--seed', type=int)
+    rec.add_argument('--headless', action='store_true')
+    rec.add_argument('--frames', type=int, default=3600)
+    rec.add_argument('--policy', choices=sorted(headless.POLICIES), default='random')
+    rec.add_argument('--stage', default='endless')
+    for name in ('play', 'verify'):
+        sub.add_parser(name).add_argument('path')
+    sk = sub.add_parser('seek')
+    sk.add_argument('path')
+    sk.add_argument('frame', type=int)
+    sk.add_argument('--interval', type=int, default=30, help='キーフレームの間隔 (フレーム)')
+    sk.add_argument('--max-bytes', type=int, default=64 << 20, help='キーフレームに使うメモリの上限')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        if args.headless:
+            replay = Replay(args.seed or 0, stage=args.stage)
+            recorder = RecordingInput(ScriptedInput(headless.POLICIES[args.policy](replay.seed)), replay)
+            recorder.app = App(headless=True, seed=replay.seed, stage=replay.stage, input_source=recorder)
+            recorder.app.step(args.frames)
+            replay.finish(recorder.app)
+            replay.save(args.path)
+            print(f"recorded {len(replay)} frames -> {args.path} ({len(replay.to_bytes())} bytes)")
+        else:
+            seed = args.seed if args.seed is not None else random.getrandbits(32)
+            replay = Replay(seed, stage=args.stage)
+            path = os.path.abspath(args.path) # pyxel.init で作業ディレクトリが変わる前に
+            # 状態を残すために App への参照が要るので、ウィンドウは自分で開いてヘッドレスの App を FrameGovernor で進める
+            pyxel.init(SCREEN_WIDTH, SCREEN_HEIGHT, fps=SIM_FPS)
+            pyxel.title("Pyxel Danmaku Game")
+            recorder = RecordingInput(PyxelInput(), replay)
+            app = recorder.app = App(headless=True, seed=seed, input_source=recorder, stage=replay.stage, audio=PyxelAudio(),
+                                     save_dir=pyxel.user_data_dir("PyxelDanmakuGame", "HighScores"), gc_policy=True)
+            app.build_assets()
+            # pyxel.run から戻らないので終了時に保存する
+            atexit.register(lambda: (replay.finish(app), replay.save(path)))
+            app.governor = FrameGovernor(app)
+            pyxel.run(app.governor.update, app.governor.draw)
+    elif args.command == 'seek':
+        replay = Replay.load(args.path)
+        app = App(headless=True, seed=replay.seed, input_source=ScriptedInput(replay.masks), stage=replay.stage)
+        buffer = snapshot.RewindBuffer(app, args.interval, args.max_bytes)
+        start = time.perf_counter()
+        for _ in range(len(replay)):
+            app.update()
+            buffer.record()
+        elapsed = time.perf_counter() - start
+        stats = buffer.stats()
+        print(f"{len(replay)} frames in {elapsed:.3f}s, {stats['keyframes']} keyframes ({stats['bytes']} bytes, oldest frame {stats['oldest']})")
+        start = time.perf_counter()
+        if not buffer.seek(args.frame, keep_future=True):
+            raise SystemExit(f"no keyframe at or before frame {args.frame}")
+        elapsed = time.perf_counter() - start
+        print(f"seek to frame {app.frame_count} in {elapsed * 1000:.1f}ms")
+        print(f"phase: {app.game_phase}  score: {app.score}  state: {state_digest(app)}")
+    elif args.command == 'verify':
+        replay = Replay.load(args.path)
+        if not replay.digests:
+            # version 2 までのファイルには記録したときの状態がないので、2回再生して比べるだけ
+            if state_digest(play(replay)) != state_digest(play(replay)):
+                raise SystemExit("replay is not deterministic")
+            print("ok (no recorded state; checked that two playbacks match)")
+            return
+        mismatch = verify(replay)
+        if mismatch is not None:
+            raise SystemExit(f"state differs from the recording at step {mismatch}")
+        print(f"ok ({len(replay.digests)} recorded states match)")
+    else:
+        replay = Replay.load(args.path)
+        start = time.perf_counter()
+        app = play(replay)
+        elapsed = time.perf_counter() - start
+        print(f"{len(replay)} frames in {elapsed:.3f}s ({len(replay) / max(elapsed, 1e-9):.0f} frames/s)")
+        print(f"phase: {app.game_phase}  score: {app.score}  state: {state_digest(app)}")
+
+
+if __name__ == '__main__':
+    main()
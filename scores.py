@@ -0,0 +1,136 @@
+# ハイスコアの保存
+# 起動時に1回だけ読み込んでメモリに持ち、ゲーム中はメモリ上の表だけを見る
+# 書き込みはバックグラウンドのスレッドが行い、一時ファイルに書いてから os.replace で置き換えるので
+# フレームの処理が止まらず、書き込み中に落ちても前のファイルが残る
+#
+# scores.json:
+#   {"version": 1, "scores": [{"score": 12345, "time": 1700000000, "seed": 42, "result": "gameover"}, ...]}
+#   スコアの高い順に最大 TOP_N 件
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+VERSION = 1
+TOP_N = 10
+FILE_NAME = 'scores.json'
+LEGACY_FILE_NAME = 'highscore.txt' # 以前の形式 (スコアの整数ひとつ)。scores.json がなければここから読む
+
+
+class ScoreStore:
+    # directory が None ならメモリ上だけで持つ (ヘッドレスで save_dir を渡さないとき)
+    def __init__(self, directory=None, size=TOP_N):
+        self.directory = Path(directory) if directory is not None else None
+        self.size = size
+        self.entries = self.load()
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.pending = None # まだ書いていない最新の表 (書く前に次が来たら古い方は捨てる)
+        self.writing = False
+        self.closed = False
+        self.thread = None
+        self.errors = 0 # 書き込みに失敗した回数
+        if self.directory is not None:
+            atexit.register(self.close)
+
+    @property
+    def path(self):
+        return self.directory / FILE_NAME
+
+    def load(self):
+        if self.directory is None:
+            return []
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            entries = [e for e in data.get('scores', []) if isinstance(e.get('score'), int)]
+        except FileNotFoundError:
+            entries = self.load_legacy()
+        except (ValueError, OSError, AttributeError):
+            entries = []
+        entries.sort(key=lambda e: -e['score'])
+        return entries[:self.size]
+
+    def load_legacy(self):
+        try:
+            with open(self.directory / LEGACY_FILE_NAME) as f:
+                score = int(f.read())
+        except (ValueError, OSError):
+            return []
+        return [{'score': score, 'time': 0, 'seed': None, 'result': None}]
+
+    def best(self):
+        return self.entries[0]['score'] if self.entries else 0
+
+    def qualifies(self, score):
+        return score > 0 and (len(self.entries) < self.size or score > self.entries[-1]['score'])
+
+    def submit(self, score, seed=None, result=None):
+        # 表に入れば順位 (0 始まり) を返して書き込みを頼む。入らなければ -1
+        if not self.qualifies(score):
+            return -1
+        rank = 0
+        while rank < len(self.entries) and self.entries[rank]['score'] >= score:
+            rank += 1
+        self.entries.insert(rank, {'score': score, 'time': int(time.time()), 'seed': seed, 'result': result})
+        del self.entries[self.size:]
+        self.save()
+        return rank
+
+    def save(self):
+        if self.directory is None:
+            return
+        data = {'version': VERSION, 'scores': [dict(e) for e in self.entries]}
+        with self.lock:
+            self.pending = data
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.writer, name='ScoreStore', daemon=True)
+                self.thread.start()
+            self.changed.notify_all()
+
+    def writer(self):
+        while True:
+            with self.lock:
+                while self.pending is None and not self.closed:
+                    self.changed.wait()
+                if self.pending is None:
+                    return
+                data = self.pending
+                self.pending = None
+                self.writing = True
+            try:
+                self.write(data)
+            except OSError:
+                self.errors += 1
+            with self.lock:
+                self.writing = False
+                self.changed.notify_all()
+
+    def write(self, data):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=FILE_NAME, suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def flush(self, timeout=None):
+        # 頼んだ書き込みが終わるまで待つ (終わったら True)
+        with self.lock:
+            return self.changed.wait_for(lambda: self.pending is None and not self.writing, timeout)
+
+    def close(self):
+        self.flush(timeout=5)
+        with self.lock:
+            self.closed = True
+            self.changed.notify_all()
+        if self.thread:
+            self.thread.join(timeout=5)
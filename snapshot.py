@@ -0,0 +1,167 @@
+# ゲームの状態のスナップショットと巻き戻し
+# capture(app) でゲームの状態 (全プレイヤー・全エンティティ・ボス・タイマー・スコア・フェーズ・乱数・入力) を
+# バイト列にし、restore(app, data) でその時点に戻す。描画のキャッシュや品質、ハイスコアの表、どのステージかは含めない
+#
+# バイト列の形式:
+#   magic b'TSNP' | version u8 | frame u32 | 乱数の状態 (u32 x 625) の長さ u32 | 乱数の状態 | zlib(pickle(その他))
+#
+# RewindBuffer は interval フレームごとのスナップショット (キーフレーム) を合計 max_bytes までリングバッファに持ち、
+# rewind(n) / seek(frame) は直前のキーフレームに戻してから目的のフレームまで update() で進める
+# 進めるときの入力は ScriptedInput がフレーム番号で引けるもの (リプレイのマスク列など) でないと同じにならない
+#
+#   buffer = RewindBuffer(app, interval=30, max_bytes=8 << 20)
+#   while ...:
+#       app.update()
+#       buffer.record()
+#   buffer.rewind(120)  # 2秒前に戻る
+import pickle
+import struct
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import deque
+
+import numpy as np
+
+from main import Boss, Player, BOSS_PROGRAM, BOSS_PROGRAM_DENSE
+
+MAGIC = b'TSNP'
+VERSION = 4 # 2: プレイヤーと入力をプレイヤーの人数分持つ、3: ステージの進み具合、4: 敵・アイテム・ボスの直前の移動量
+HEADER = struct.Struct('<4sBII')
+BOSS_PROGRAMS = (BOSS_PROGRAM, BOSS_PROGRAM_DENSE) # Boss.program はこの中のインデックスで保存する
+APP_FIELDS = ('frame_count', 'score', 'game_phase', 'boss_intro_timer', 'death_cause', 'enemy_spawn_timer', 'cloud_spawn_timer',
+              'stage_frame', 'stage_cursor')
+INPUT_FIELDS = ('frame', 'mask', 'prev_mask')
+
+
+def slot_values(obj):
+    return tuple(getattr(obj, s) for s in type(obj).__slots__)
+
+
+def from_slot_values(cls, values):
+    obj = cls.__new__(cls)
+    for s, v in zip(cls.__slots__, values):
+        setattr(obj, s, v)
+    return obj
+
+
+def capture(app, level=1):
+    # level は zlib の圧縮レベル (0 なら圧縮しない)
+    boss = None
+    if app.boss:
+        boss = slot_values(app.boss)
+        i = Boss.__slots__.index('program')
+        boss = boss[:i] + (BOSS_PROGRAMS.index(app.boss.program),) + boss[i + 1:]
+    store = app.enemy_bullets
+    n = store.count
+    state = (
+        tuple(getattr(app, name) for name in APP_FIELDS),
+        tuple(tuple(getattr(input, name, None) for name in INPUT_FIELDS) for input in app.inputs),
+        tuple(slot_values(player) for player in app.players),
+        boss,
+        app.world.get_state(),
+        (n, [a[:n].tobytes() for a in store.arrays()]),
+    )
+    version, rng, gauss = app.rng.getstate()
+    rng = array('I', rng).tobytes()
+    body = pickle.dumps((version, gauss, state), pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(MAGIC, VERSION, app.frame_count, len(rng)) + rng + zlib.compress(body, level)
+
+
+def frame_of(data):
+    magic, version, frame, _ = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a snapshot")
+    return frame
+
+
+def restore(app, data):
+    frame_of(data)
+    _, _, _, rng_size = HEADER.unpack_from(data)
+    rng = array('I')
+    rng.frombytes(data[HEADER.size:HEADER.size + rng_size])
+    version, gauss, state = pickle.loads(zlib.decompress(data[HEADER.size + rng_size:]))
+    app_values, inputs, players, boss, world, (n, bullets) = state
+
+    app.rng.setstate((version, tuple(rng), gauss))
+    for name, value in zip(APP_FIELDS, app_values):
+        setattr(app, name, value)
+    for input, input_values in zip(app.inputs, inputs):
+        for name, value in zip(INPUT_FIELDS, input_values):
+            if value is not None:
+                setattr(input, name, value)
+    app.players = [from_slot_values(Player, player) for player in players]
+    app.player = app.players[0]
+    app.boss = None
+    if boss:
+        app.boss = from_slot_values(Boss, boss)
+        app.boss.program = BOSS_PROGRAMS[app.boss.program]
+    app.world.set_state(world)
+
+    store = app.enemy_bullets
+    if n > store.capacity:
+        store.grow(n)
+    for a, raw in zip(store.arrays(), bullets):
+        a[:n] = np.frombuffer(raw, dtype=a.dtype)
+    store.count = n
+
+
+class RewindBuffer:
+    def __init__(self, app, interval=30, max_bytes=8 << 20, level=1):
+        self.app = app
+        self.interval = interval # キーフレームの間隔 (フレーム)
+        self.max_bytes = max_bytes # これを超えたら古いキーフレームから捨てる
+        self.level = level
+        self.frames = deque() # キーフレームのフレーム番号 (昇順)
+        self.keyframes = deque()
+        self.bytes = 0
+        self.record() # 今の状態 (ふつうはフレーム 0) にも戻れるようにする
+
+    def __len__(self):
+        return len(self.keyframes)
+
+    def record(self):
+        # app.update() の後に毎フレーム呼ぶ (interval フレームごとにキーフレームを取る)
+        frame = self.app.frame_count
+        if frame % self.interval or (self.frames and self.frames[-1] >= frame):
+            return
+        self.push(frame, capture(self.app, self.level))
+
+    def push(self, frame, data):
+        self.frames.append(frame)
+        self.keyframes.append(data)
+        self.bytes += len(data)
+        while self.bytes > self.max_bytes and len(self.keyframes) > 1:
+            self.frames.popleft()
+            self.bytes -= len(self.keyframes.popleft())
+
+    def truncate(self, frame):
+        # frame より後のキーフレームを捨てる (戻ったあとで入力が変わると、その先の状態は使えない)
+        while self.frames and self.frames[-1] > frame:
+            self.frames.pop()
+            self.bytes -= len(self.keyframes.pop())
+
+    def oldest(self):
+        return self.frames[0] if self.frames else None
+
+    def seek(self, frame, keep_future=False):
+        # frame の直前のキーフレームに戻してから frame まで進める。戻れるキーフレームがなければ False
+        # リプレイの再生のように入力が決まっているときは keep_future=True で先のキーフレームも残す
+        i = bisect_right(self.frames, frame) - 1
+        if i < 0:
+            return False
+        restore(self.app, self.keyframes[i])
+        if not keep_future:
+            self.truncate(self.frames[i])
+        while self.app.frame_count < frame:
+            self.app.update()
+            self.record()
+        return True
+
+    def rewind(self, n):
+        # n フレーム前に戻る
+        return self.seek(max(self.app.frame_count - n, 0))
+
+    def stats(self):
+        return {'keyframes': len(self.keyframes), 'bytes': self.bytes, 'oldest': self.oldest(),
+                'mean_bytes': self.bytes // max(len(self.keyframes), 1)}
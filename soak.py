@@ -0,0 +1,166 @@
+# 長時間の連続実行でメモリやエンティティが増え続けないかを確かめる
+# ヘッドレスでランダムな入力 (ゲームオーバーになったら R ですぐにやり直す) のまま何時間分も進め、
+# interval フレームごとに RSS・tracemalloc の使用量・リストごとのエンティティ数・プールが作ったオブジェクト数を記録する
+# 最後に各系列を windows 個の区間に分け、区間ごとの中央値が毎回増えていて増え方が許容量を超えるものを「増え続けている」とし、
+# メモリが増えていれば最初と最後の tracemalloc のスナップショットの差 (確保した場所ごと) を表示する
+#
+#   python soak.py --hours 2 --seed 0                 # ゲーム内の2時間分
+#   python soak.py --hours 1 --immortal --draw 4      # やられないようにしてボスまで進め、4フレームに1回描画もする
+#   python soak.py --frames 100000 --out soak.csv     # 記録した値を CSV に書き出す
+#
+# 増え続けている系列があれば終了コード 1
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import pyxel
+
+from main import SCREEN_WIDTH, SCREEN_HEIGHT, SIM_FPS
+from gcpolicy import read_rss
+from profiler import ENTITY_LISTS
+import headless
+
+TRACE_FRAMES = 1 # tracemalloc が記録するスタックの深さ (確保した行だけ見るので 1、深くすると数倍遅くなる)
+# 系列ごとの許容量 (これ以下の増え方は揺れとみなす)
+TOLERANCE = {'rss': 4 << 20, 'traced': 1 << 20, 'pool_created': 64}
+ENTITY_TOLERANCE = 16
+TOLERANCE_RATIO = 0.05
+
+
+def keep_alive(app):
+    for player in app.players:
+        player.life = player.max_life
+
+
+def sample(app, tracing):
+    row = {'frame': app.frame_count, 'rss': read_rss() or 0,
+           'traced': tracemalloc.get_traced_memory()[0] if tracing else 0}
+    for name in ENTITY_LISTS:
+        row[name] = len(getattr(app, name))
+    row['enemy_bullets'] = len(app.enemy_bullets)
+    row['pool_created'] = sum(s['created'] for s in app.world.stats().values())
+    row['bullet_capacity'] = app.enemy_bullets.capacity
+    return row
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def growing(values, windows=4, tolerance=0):
+    # 区間ごとの中央値が毎回増えていて、最初から最後までの増え方が tolerance と TOLERANCE_RATIO を超えるか
+    size = len(values) // windows
+    if size < 1:
+        return False
+    medians = [median(values[i * size:(i + 1) * size]) for i in range(windows)]
+    if any(b <= a for a, b in zip(medians, medians[1:])):
+        return False
+    return medians[-1] - medians[0] > max(tolerance, medians[0] * TOLERANCE_RATIO)
+
+
+def find_leaks(rows, windows=4):
+    leaks = []
+    for name in rows[0]:
+        if name == 'frame':
+            continue
+        tolerance = TOLERANCE.get(name, ENTITY_TOLERANCE)
+        values = [row[name] for row in rows]
+        if growing(values, windows, tolerance):
+            leaks.append(name)
+    return leaks
+
+
+def print_top_diff(first, last, limit=15):
+    # 確保した場所 (ファイル:行) ごとの増加量が大きい順
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    stats = last.filter_traces(filters).compare_to(first.filter_traces(filters), 'lineno')
+    print(f"top {limit} allocation sites by growth:")
+    for stat in stats[:limit]:
+        frame = stat.traceback[0]
+        print(f"  {stat.size_diff / 1024:+10.1f} KiB {stat.count_diff:+8d} blocks  {frame.filename}:{frame.lineno}")
+
+
+def soak(app, frames, interval, warmup=0, immortal=False, draw_every=0, tracing=True, progress=None):
+    # app を frames フレーム進め、warmup フレーム以降は interval ごとに sample() を取る
+    # (記録した行, 最初と最後の tracemalloc のスナップショット) を返す
+    rows = []
+    first = last = None
+    if tracing and not tracemalloc.is_tracing():
+        tracemalloc.start(TRACE_FRAMES)
+    for i in range(1, frames + 1):
+        if immortal:
+            keep_alive(app)
+        app.update()
+        if draw_every and i % draw_every == 0:
+            app.draw()
+        if i < warmup or i % interval:
+            continue
+        rows.append(sample(app, tracing))
+        if tracing:
+            last = tracemalloc.take_snapshot()
+            first = first or last
+        if progress:
+            progress(rows[-1])
+    return rows, first, last
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hours', type=float, default=1.0, help="ゲーム内の時間 (60 フレーム/秒)")
+    parser.add_argument('--frames', type=int, help="--hours の代わりにフレーム数で指定する")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stage', help="ステージの名前 (stages/<名前>.json、既定は endless)")
+    parser.add_argument('--interval', type=int, default=SIM_FPS * 60, help="記録の間隔 (フレーム)")
+    parser.add_argument('--warmup', type=int, default=SIM_FPS * 300, help="記録を始めるまでのフレーム数 (プールやキャッシュが育つまで)")
+    parser.add_argument('--windows', type=int, default=4, help="増え続けているかを見る区間の数")
+    parser.add_argument('--immortal', action='store_true', help="やられないようにする (ボス・クリアまで進める)")
+    parser.add_argument('--draw', type=int, default=0, metavar='N', help="N フレームに1回描画する (0 なら描かない)")
+    parser.add_argument('--no-tracemalloc', action='store_true', help="RSS と数だけを見る (速い)")
+    parser.add_argument('--out', help="記録した値を書き出す CSV")
+    args = parser.parse_args()
+
+    frames = args.frames if args.frames is not None else int(args.hours * 3600 * SIM_FPS)
+    if args.out:
+        args.out = os.path.abspath(args.out) # pyxel.init で作業ディレクトリが変わる前に
+    if args.draw:
+        os.environ.setdefault('SDL_VIDEODRIVER', 'offscreen')
+        os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+        pyxel.init(SCREEN_WIDTH, SCREEN_HEIGHT)
+    app = headless.create_app(headless.RandomPolicy(args.seed), seed=args.seed, stage=args.stage)
+
+    start = time.perf_counter()
+    def progress(row):
+        print(f"frame {row['frame']:>9}  rss {row['rss'] / 1048576:7.1f} MiB  traced {row['traced'] / 1048576:7.2f} MiB  "
+              f"enemies {row['enemies']:4}  bullets {row['enemy_bullets']:4}  items {row['items']:3}  "
+              f"pool {row['pool_created']:5}  ({time.perf_counter() - start:.0f}s)", flush=True)
+    rows, first, last = soak(app, frames, args.interval, args.warmup, args.immortal, args.draw,
+                             not args.no_tracemalloc, progress)
+
+    if args.out and rows:
+        with open(args.out, 'w') as f:
+            f.write(','.join(rows[0]) + '\n')
+            for row in rows:
+                f.write(','.join(map(str, row.values())) + '\n')
+
+    if rows:
+        # 1ゲームの中だけで増えるもの (リスタートで消える) は増え続けているとはみなさないので、最大値も出しておく
+        print("peak: " + '  '.join(f"{name} {max(row[name] for row in rows)}" for name in rows[0]
+                                   if name not in ('frame', 'rss', 'traced')))
+    if len(rows) < args.windows * 2:
+        print(f"only {len(rows)} samples; run longer or lower --interval to check for growth")
+        return
+    leaks = find_leaks(rows, args.windows)
+    if not leaks:
+        print(f"no steady growth over {len(rows)} samples ({frames} frames)")
+        return
+    print("steady growth: " + ', '.join(leaks))
+    if first is not None and {'rss', 'traced'} & set(leaks):
+        print_top_diff(first, last)
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
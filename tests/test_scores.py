@@ -0,0 +1,30 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyxel
+
+from main import App, Boss, ScriptedInput, INPUT_BITS
+
+
+def test_bomb_kill_and_hammer_hit_in_same_frame_records_once(tmp_path):
+    # ボム (X) でボスの体力を 0 にしたフレームに、ハンマー (Z) もボスに当たる
+    mask = INPUT_BITS[pyxel.KEY_X] | INPUT_BITS[pyxel.KEY_Z]
+    app = App(headless=True, seed=0, input_source=ScriptedInput([mask]), save_dir=tmp_path)
+    app.world.clear('enemies')
+    app.game_phase = 'boss'
+    app.boss = Boss()
+    app.boss.health = 50
+    app.boss.x = app.player.x
+    app.boss.y = app.player.y - app.boss.h / 2
+    app.score = 5000
+
+    app.update()
+    app.scores.flush(timeout=5)
+
+    assert app.game_phase == 'clear'
+    with open(tmp_path / 'scores.json') as f:
+        scores = json.load(f)['scores']
+    assert [(e['score'], e['result']) for e in scores] == [(5000, 'clear')]